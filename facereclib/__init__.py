@@ -8,6 +8,7 @@ import databases
 import preprocessing
 import features
 import tools
+import trainers
 import utils
 import toolchain
 
@@ -6,24 +6,31 @@ import bob
 import numpy
 
 from .Extractor import Extractor
-from .. import utils
+from .. import utils, trainers
 
 class Eigenface (Extractor):
   """Extracts grid graphs from the images"""
 
-  def __init__(self, subspace_dimension):
+  def __init__(self, subspace_dimension, stream_training_data = False, training_threads = 1):
     # We have to register that this function will need a training step
-    Extractor.__init__(self, requires_training = True, subspace_dimension = subspace_dimension)
+    # if stream_training_data is enabled, the PCA is trained incrementally, without keeping all training images in memory
+    # if training_threads is greater than 1, the scatter matrices of the incremental PCA are accumulated by this number of processes
+    Extractor.__init__(self, requires_training = True, stream_training_data = stream_training_data, subspace_dimension = subspace_dimension, training_threads = training_threads)
     self.m_subspace_dimension = subspace_dimension
+    self.m_training_threads = training_threads
 
   def train(self, image_list, extractor_file):
     """Trains the eigenface extractor using the given list of training images"""
-    # Initializes an array for the data
-    data = numpy.vstack([image.flatten() for image in image_list])
-
-    utils.info("  -> Training LinearMachine using PCA (SVD)")
-    t = bob.trainer.PCATrainer()
-    self.m_machine, __eig_vals = t.train(data)
+    if self.stream_training_data:
+      utils.info("  -> Training LinearMachine using incremental PCA")
+      self.m_machine, __eig_vals = trainers.PCA().train(utils.streaming.split(image_list), parallel = self.m_training_threads)
+    else:
+      # Initializes an array for the data
+      data = numpy.vstack([image.flatten() for image in image_list])
+
+      utils.info("  -> Training LinearMachine using PCA (SVD)")
+      t = bob.trainer.PCATrainer()
+      self.m_machine, __eig_vals = t.train(data)
     # Machine: get shape, then resize
     self.m_machine.resize(self.m_machine.shape[0], self.m_subspace_dimension)
     self.m_machine.save(bob.io.HDF5File(extractor_file, "w"))
@@ -42,3 +49,7 @@ class Eigenface (Extractor):
     # return the projected data
     return self.m_projected_feature
 
+  def extract_batch(self, image_list):
+    """Projects all given images at once, returning a 2D array with one projected image per row"""
+    return utils.project_batch(self.m_machine, numpy.vstack([image.flatten() for image in image_list]))
+
@@ -31,12 +31,14 @@ class Extractor:
       self,
       requires_training = False, # enable, if your extractor needs training
       split_training_data_by_client = False, # enable, if your extractor needs the training files sorted by client
+      stream_training_data = False, # enable, if your extractor training can process the training data one after the other, which is then read from file only when it is accessed
       **kwargs                   # the parameters of the extractor, to be written in the __str__() method
   ):
     # Each class needs to have a constructor taking
     # all the parameters that are required for the feature extraction as arguments
     self.requires_training = requires_training
     self.split_training_data_by_client = split_training_data_by_client
+    self.stream_training_data = stream_training_data
     self._kwargs = kwargs
 
 
@@ -61,6 +63,16 @@ class Extractor:
   ### Special functions that might be overwritten on need
   ############################################################
 
+  def extract_batch(self, data_list):
+    """Extracts the features from all given data and returns an iterable of features.
+    In this base class implementation, the features are extracted one by one using the __call__ function, when they are requested.
+    Since __call__ might return the same buffer for each feature, each feature must be used (e.g. written) before the next one is requested.
+    Derived classes might overwrite this function to extract all features at once.
+    """
+    for data in data_list:
+      yield self(data)
+
+
   def save_feature(self, feature, feature_file):
     """Saves the given *extracted* feature to a file with the given name.
     In this base class implementation:
@@ -4,6 +4,7 @@
 
 
 import sys, os
+import math
 import argparse
 
 from . import ToolChainExecutor
@@ -60,7 +61,210 @@ class ToolChainExecutorZT (ToolChainExecutor.ToolChainExecutor):
     )
 
     # create the tool chain to be used to actually perform the parts of the experiments
-    self.m_tool_chain = toolchain.ToolChain(self.m_file_selector)
+    self.m_tool_chain = toolchain.ToolChain(self.m_file_selector, share_machines = args.share_machines)
+
+
+  def __index_ranges__(self, number_of_items, items_per_job):
+    """Splits the given number of items into index ranges of the given size."""
+    return [(start, min(start + items_per_job, number_of_items)) for start in range(0, number_of_items, items_per_job)]
+
+  def __file_dependencies__(self, files, file_indices, file_jobs):
+    """Returns the list of jobs that generate the given files (or lists of files, in case of probe file sets)."""
+    dependencies = set()
+    for f in files:
+      for name in (f if isinstance(f, list) else [f]):
+        if name in file_indices and file_jobs[file_indices[name]] is not None:
+          dependencies.add(file_jobs[file_indices[name]])
+    return list(dependencies)
+
+
+  def __probes_per_job__(self, number_of_probes, number_of_model_ranges, probe_files):
+    """Returns the number of probes of a scoring tile, or None if the scores are not computed in tiles.
+    Unless --probes-per-job is given, the probes are split into enough tiles to keep all --parallel processes busy when there are fewer model ranges than processes,
+    and into small enough tiles that the probes of one tile fit into --scoring-memory megabytes, where the size of a probe is estimated from the first probe file, if it exists already."""
+    if self.m_args.probes_per_job is not None:
+      return self.m_args.probes_per_job or None
+
+    number_of_tiles = 1
+    if self.m_args.parallel and 0 < number_of_model_ranges < self.m_args.parallel:
+      number_of_tiles = int(math.ceil(self.m_args.parallel / float(number_of_model_ranges)))
+    # the size of the first probe (or probe file set) on disk
+    first_files = (probe_files[0] if isinstance(probe_files[0], list) else [probe_files[0]]) if probe_files else []
+    if first_files and all(os.path.exists(str(f)) for f in first_files):
+      probe_size = sum(os.path.getsize(str(f)) for f in first_files)
+      number_of_tiles = max(number_of_tiles, int(math.ceil(number_of_probes * probe_size / (self.m_args.scoring_memory * 1024. * 1024.))))
+
+    if number_of_tiles <= 1:
+      return None
+    return int(math.ceil(number_of_probes / float(number_of_tiles)))
+
+  def __score_tiles__(self, group):
+    """Returns the list of tiles (pairs of model and probe index ranges) of the score matrix of the given group, as defined by the grid parameters."""
+    model_ranges = self.__index_ranges__(len(self.m_file_selector.model_ids(group)), self.m_grid.number_of_models_per_scoring_job)
+    probe_ranges = self.__index_ranges__(len(self.m_file_selector.probe_objects(group)), self.m_grid.number_of_probes_per_scoring_job)
+    return [(model_range, probe_range) for model_range in model_ranges for probe_range in probe_ranges]
+
+
+  def build_job_graph(self):
+    """Generates the graph of jobs that are required to execute the ZT tool chain.
+    Other than the sequential execution in execute_tool_chain(), dependencies are tracked on item level:
+    e.g., a model is enrolled as soon as the features of its enrollment files are projected,
+    and scores for a model are computed as soon as the model and the required probe files are available."""
+    graph = toolchain.JobGraph()
+    tool_chain = self.m_tool_chain
+    file_selector = self.m_file_selector
+    force = self.m_args.force
+
+    # the file lists of all stages are aligned, so that the same index ranges can be used for all stages
+    index_ranges = self.__index_ranges__(len(file_selector.original_data_list()), self.m_args.files_per_job)
+    # for each file (stage), remember the index range it is in
+    range_of_file = {}
+    for directory_type, file_list in (('preprocessed', file_selector.preprocessed_data_list()), ('features', file_selector.feature_list()), ('projected', file_selector.projected_list())):
+      range_of_file[directory_type] = dict((file_list[i], r) for r, (start, end) in enumerate(index_ranges) for i in range(start, end))
+    # for each index range, remember the job that generated the files of a specific stage (if any)
+    jobs_of_range = {'preprocessed' : [None] * len(index_ranges), 'features' : [None] * len(index_ranges), 'projected' : [None] * len(index_ranges)}
+
+    def file_dependencies(files, directory_type):
+      return self.__file_dependencies__(files, range_of_file[directory_type], jobs_of_range[directory_type])
+
+    def training_files(directory_type, step, arrange_by_client):
+      files = file_selector.training_list(directory_type, step, arrange_by_client = arrange_by_client)
+      return [f for client_files in files for f in client_files] if arrange_by_client else files
+
+    # preprocessing
+    if not self.m_args.skip_preprocessing:
+      for r, indices in enumerate(index_ranges):
+        jobs_of_range['preprocessed'][r] = graph.add_job('preprocess-%d' % r, tool_chain.preprocess_data,
+              preprocessor = self.m_preprocessor, indices = indices, force = force)
+
+    # feature extractor training
+    training_jobs = []
+    if not self.m_args.skip_extractor_training and self.m_extractor.requires_training:
+      training_jobs.append(graph.add_job('train-extractor', tool_chain.train_extractor,
+            dependencies = file_dependencies(training_files('preprocessed', 'train_extractor', self.m_extractor.split_training_data_by_client), 'preprocessed'),
+            extractor = self.m_extractor, preprocessor = self.m_preprocessor, force = force))
+
+    # feature extraction
+    if not self.m_args.skip_extraction:
+      for r, indices in enumerate(index_ranges):
+        jobs_of_range['features'][r] = graph.add_job('extract-%d' % r, tool_chain.extract_features,
+              dependencies = training_jobs + [job for job in jobs_of_range['preprocessed'][r:r+1] if job is not None],
+              extractor = self.m_extractor, preprocessor = self.m_preprocessor, indices = indices, force = force)
+
+    # feature projector training
+    if not self.m_args.skip_projector_training and self.m_tool.requires_projector_training:
+      training_jobs.append(graph.add_job('train-projector', tool_chain.train_projector,
+            dependencies = file_dependencies(training_files('features', 'train_projector', self.m_tool.split_training_features_by_client), 'features'),
+            tool = self.m_tool, extractor = self.m_extractor, force = force))
+
+    # feature projection
+    if not self.m_args.skip_projection and self.m_tool.performs_projection:
+      for r, indices in enumerate(index_ranges):
+        jobs_of_range['projected'][r] = graph.add_job('project-%d' % r, tool_chain.project_features,
+              dependencies = training_jobs + [job for job in jobs_of_range['features'][r:r+1] if job is not None],
+              tool = self.m_tool, extractor = self.m_extractor, indices = indices, force = force)
+
+    # the directory type of the features used for enrollment and scoring
+    enroll_type = 'projected' if self.m_tool.use_projected_features_for_enrollment else 'features'
+    probe_type = 'projected' if hasattr(self.m_tool, 'project') else 'features'
+
+    # model enroller training
+    if not self.m_args.skip_enroller_training and self.m_tool.requires_enroller_training:
+      training_jobs.append(graph.add_job('train-enroller', tool_chain.train_enroller,
+            dependencies = training_jobs + file_dependencies(training_files(enroll_type, 'train_enroller', True), enroll_type),
+            tool = self.m_tool, extractor = self.m_extractor, force = force))
+
+    calibrate_dependencies = []
+    for group in self.m_args.groups:
+      model_ids = file_selector.model_ids(group)
+      model_ranges = self.__index_ranges__(len(model_ids), self.m_args.models_per_job)
+      t_model_ids = file_selector.t_model_ids(group) if self.m_args.zt_norm else []
+      t_model_ranges = self.__index_ranges__(len(t_model_ids), self.m_args.models_per_job)
+
+      # model enrollment
+      enroll_jobs = [[] for r in model_ranges]
+      t_enroll_jobs = [[] for r in t_model_ranges]
+      if not self.m_args.skip_enrollment:
+        for r, indices in enumerate(model_ranges):
+          files = [f for model_id in model_ids[indices[0]:indices[1]] for f in file_selector.enroll_files(model_id, group, enroll_type)]
+          enroll_jobs[r] = [graph.add_job('enroll-%s-N-%d' % (group, r), tool_chain.enroll_models,
+                dependencies = training_jobs + file_dependencies(files, enroll_type),
+                tool = self.m_tool, extractor = self.m_extractor, compute_zt_norm = self.m_args.zt_norm, indices = indices, groups = [group], types = ['N'], force = force)]
+        for r, indices in enumerate(t_model_ranges):
+          files = [f for t_model_id in t_model_ids[indices[0]:indices[1]] for f in file_selector.t_enroll_files(t_model_id, group, enroll_type)]
+          t_enroll_jobs[r] = [graph.add_job('enroll-%s-T-%d' % (group, r), tool_chain.enroll_models,
+                dependencies = training_jobs + file_dependencies(files, enroll_type),
+                tool = self.m_tool, extractor = self.m_extractor, compute_zt_norm = self.m_args.zt_norm, indices = indices, groups = [group], types = ['T'], force = force)]
+
+      # score computation
+      concatenate_dependencies = []
+      if not self.m_args.skip_score_computation:
+        z_probe_dependencies = file_dependencies(file_selector.get_paths(file_selector.z_probe_objects(group), probe_type), probe_type) if self.m_args.zt_norm else []
+        probe_dependencies = file_dependencies(file_selector.get_paths(file_selector.probe_objects(group), probe_type), probe_type) if self.m_args.zt_norm else []
+        score_jobs = []
+        probe_objects = file_selector.probe_objects(group)
+        probes_per_job = self.__probes_per_job__(len(probe_objects), len(model_ranges), file_selector.get_paths(probe_objects[:1], probe_type))
+        if probes_per_job:
+          # compute the A scores in tiles of models x probes, and merge them afterwards
+          probe_ranges = self.__index_ranges__(len(probe_objects), probes_per_job)
+          for r, indices in enumerate(model_ranges):
+            tile_jobs = []
+            for p, probe_indices in enumerate(probe_ranges):
+              files = file_selector.get_paths(probe_objects[probe_indices[0]:probe_indices[1]], probe_type)
+              tile_jobs.append(graph.add_job('score-%s-A-%d-%d' % (group, r, p), tool_chain.compute_scores,
+                    dependencies = training_jobs + enroll_jobs[r] + file_dependencies(files, probe_type),
+                    tool = self.m_tool, compute_zt_norm = self.m_args.zt_norm, indices = indices, groups = [group], types = ['A'], preload_probes = self.m_args.preload_probes, probe_indices = probe_indices, force = force))
+            score_jobs.append(graph.add_job('merge-%s-%d' % (group, r), tool_chain.merge_score_tiles,
+                  dependencies = tile_jobs,
+                  compute_zt_norm = self.m_args.zt_norm, probe_indices = probe_ranges, indices = indices, groups = [group]))
+            if self.m_args.zt_norm:
+              score_jobs.append(graph.add_job('score-%s-B-%d' % (group, r), tool_chain.compute_scores,
+                    dependencies = training_jobs + enroll_jobs[r] + z_probe_dependencies,
+                    tool = self.m_tool, compute_zt_norm = True, indices = indices, groups = [group], types = ['B'], preload_probes = self.m_args.preload_probes, force = force))
+        else:
+          # A and B (as well as C and D) scores are computed in the same job, so that each model is read only once
+          a_types = ['A', 'B'] if self.m_args.zt_norm else ['A']
+          for r, indices in enumerate(model_ranges):
+            files = [f for model_id in model_ids[indices[0]:indices[1]] for f in file_selector.get_paths(file_selector.probe_objects_for_model(model_id, group), probe_type)]
+            score_jobs.append(graph.add_job('score-%s-%s-%d' % (group, ''.join(a_types), r), tool_chain.compute_scores,
+                  dependencies = training_jobs + enroll_jobs[r] + file_dependencies(files, probe_type) + z_probe_dependencies,
+                  tool = self.m_tool, compute_zt_norm = self.m_args.zt_norm, indices = indices, groups = [group], types = a_types, preload_probes = self.m_args.preload_probes, force = force))
+        for r, indices in enumerate(t_model_ranges):
+          score_jobs.append(graph.add_job('score-%s-CD-%d' % (group, r), tool_chain.compute_scores,
+                dependencies = training_jobs + t_enroll_jobs[r] + probe_dependencies + z_probe_dependencies,
+                tool = self.m_tool, compute_zt_norm = True, indices = indices, groups = [group], types = ['C', 'D'], preload_probes = self.m_args.preload_probes, force = force))
+        concatenate_dependencies = score_jobs
+
+        # ZT-normalization
+        if self.m_args.zt_norm:
+          concatenate_dependencies = [graph.add_job('score-%s-Z' % group, tool_chain.zt_norm,
+                dependencies = score_jobs,
+                groups = [group])]
+
+      # concatenation of scores
+      if not self.m_args.skip_concatenation:
+        calibrate_dependencies.append(graph.add_job('concatenate-%s' % group, tool_chain.concatenate,
+              dependencies = concatenate_dependencies,
+              compute_zt_norm = self.m_args.zt_norm, groups = [group]))
+      else:
+        calibrate_dependencies.extend(concatenate_dependencies)
+
+    # calibration of scores
+    if self.m_args.calibrate_scores:
+      graph.add_job('calibrate', tool_chain.calibrate_scores,
+            dependencies = calibrate_dependencies,
+            norms = ['nonorm', 'ztnorm'] if self.m_args.zt_norm else ['nonorm'], groups = self.m_args.groups)
+
+    return graph
+
+
+  def execute_job_graph(self):
+    """Executes the ZT tool chain on the local machine using several parallel processes, where jobs are started as soon as their dependencies are fulfilled."""
+    graph = self.build_job_graph()
+    if self.m_args.dry_run:
+      graph.dry_run()
+    else:
+      graph.run(parallel = self.m_args.parallel)
 
 
   def execute_tool_chain(self):
@@ -264,49 +468,60 @@ class ToolChainExecutorZT (ToolChainExecutor.ToolChainExecutor):
                   **self.m_grid.enrollment_queue)
           enroll_deps_t[group].append(job_ids['enroll_%s_T'%group])
 
-      # compute A,B,C, and D scores
+      # compute A,B,C, and D scores; A and B (as well as C and D) scores are computed in the same job, so that each model is read only once
       if not self.m_args.skip_score_computation:
-        job_ids['score_%s_A'%group] = self.submit_grid_job(
-                'compute-scores --group %s --score-type A'%group,
-                name = "score-A-%s"%group,
-                list_to_split = self.m_file_selector.model_ids(group),
-                number_of_files_per_job = self.m_grid.number_of_models_per_scoring_job,
-                dependencies = enroll_deps_n[group],
-                **self.m_grid.scoring_queue)
-        concat_deps[group] = [job_ids['score_%s_A'%group]]
-
-        if self.m_args.zt_norm:
-          job_ids['score_%s_B'%group] = self.submit_grid_job(
-                  'compute-scores --group %s --score-type B'%group,
-                  name = "score-B-%s"%group,
-                  list_to_split = self.m_file_selector.model_ids(group),
-                  number_of_files_per_job = self.m_grid.number_of_models_per_scoring_job,
+        if self.m_grid.number_of_probes_per_scoring_job:
+          # compute A scores in tiles of models x probes and merge them afterwards
+          job_ids['score_%s_A'%group] = self.submit_grid_job(
+                  'compute-scores --group %s --score-type A'%group,
+                  name = "score-A-%s"%group,
+                  list_to_split = self.__score_tiles__(group),
+                  number_of_files_per_job = 1,
                   dependencies = enroll_deps_n[group],
                   **self.m_grid.scoring_queue)
-
-          job_ids['score_%s_C'%group] = self.submit_grid_job(
-                  'compute-scores --group %s --score-type C'%group,
-                  name = "score-C-%s"%group,
-                  list_to_split = self.m_file_selector.t_model_ids(group),
+          job_ids['merge_%s'%group] = self.submit_grid_job(
+                  'merge-scores --group %s'%group,
+                  name = "merge-%s"%group,
+                  list_to_split = self.m_file_selector.model_ids(group),
                   number_of_files_per_job = self.m_grid.number_of_models_per_scoring_job,
-                  dependencies = enroll_deps_t[group],
+                  dependencies = [job_ids['score_%s_A'%group]])
+          concat_deps[group] = [job_ids['merge_%s'%group]]
+          if self.m_args.zt_norm:
+            job_ids['score_%s_B'%group] = self.submit_grid_job(
+                    'compute-scores --group %s --score-type B'%group,
+                    name = "score-B-%s"%group,
+                    list_to_split = self.m_file_selector.model_ids(group),
+                    number_of_files_per_job = self.m_grid.number_of_models_per_scoring_job,
+                    dependencies = enroll_deps_n[group],
+                    **self.m_grid.scoring_queue)
+            concat_deps[group].append(job_ids['score_%s_B'%group])
+        else:
+          a_type = 'AB' if self.m_args.zt_norm else 'A'
+          job_ids['score_%s_%s'%(group, a_type)] = self.submit_grid_job(
+                  'compute-scores --group %s --score-type %s'%(group, a_type),
+                  name = "score-%s-%s"%(a_type, group),
+                  list_to_split = self.m_file_selector.model_ids(group),
+                  number_of_files_per_job = self.m_grid.number_of_models_per_scoring_job,
+                  dependencies = enroll_deps_n[group],
                   **self.m_grid.scoring_queue)
+          concat_deps[group] = [job_ids['score_%s_%s'%(group, a_type)]]
 
-          job_ids['score_%s_D'%group] = self.submit_grid_job(
-                  'compute-scores --group %s --score-type D'%group,
-                  name = "score-D-%s"%group,
+        if self.m_args.zt_norm:
+          job_ids['score_%s_CD'%group] = self.submit_grid_job(
+                  'compute-scores --group %s --score-type CD'%group,
+                  name = "score-CD-%s"%group,
                   list_to_split = self.m_file_selector.t_model_ids(group),
                   number_of_files_per_job = self.m_grid.number_of_models_per_scoring_job,
                   dependencies = enroll_deps_t[group],
                   **self.m_grid.scoring_queue)
 
           # compute zt-norm
-          score_deps[group] = [job_ids['score_%s_A'%group], job_ids['score_%s_B'%group], job_ids['score_%s_C'%group], job_ids['score_%s_D'%group]]
+          score_deps[group] = concat_deps[group] + [job_ids['score_%s_CD'%group]]
           job_ids['score_%s_Z'%group] = self.submit_grid_job(
                   'compute-scores --group %s --score-type Z'%group,
                   name = "score-Z-%s"%group,
                   dependencies = score_deps[group])
-          concat_deps[group].extend([job_ids['score_%s_B'%group], job_ids['score_%s_C'%group], job_ids['score_%s_D'%group], job_ids['score_%s_Z'%group]])
+          concat_deps[group] = [job_ids['score_%s_Z'%group]]
       else:
         concat_deps[group] = []
 
@@ -399,29 +614,52 @@ class ToolChainExecutorZT (ToolChainExecutor.ToolChainExecutor):
 
     # compute scores
     elif self.m_args.sub_task == 'compute-scores':
-      if self.m_args.score_type in ['A', 'B']:
+      if self.m_args.score_type == 'A' and self.m_grid.number_of_probes_per_scoring_job:
+        # compute the desired tiles of the score matrix
+        tiles = self.__score_tiles__(self.m_args.group)
+        indices = self.indices(tiles, 1)
+        for model_indices, probe_indices in tiles[indices[0]:indices[1]]:
+          self.m_tool_chain.compute_scores(
+              self.m_tool,
+              self.m_args.zt_norm,
+              indices = model_indices,
+              groups = [self.m_args.group],
+              types = ['A'],
+              preload_probes = self.m_args.preload_probes,
+              probe_indices = probe_indices,
+              force = self.m_args.force)
+
+      elif self.m_args.score_type in ['A', 'B', 'AB']:
         self.m_tool_chain.compute_scores(
             self.m_tool,
             self.m_args.zt_norm,
             indices = self.indices(self.m_file_selector.model_ids(self.m_args.group), self.m_grid.number_of_models_per_scoring_job),
             groups = [self.m_args.group],
-            types = [self.m_args.score_type],
+            types = list(self.m_args.score_type),
             preload_probes = self.m_args.preload_probes,
             force = self.m_args.force)
 
-      elif self.m_args.score_type in ['C', 'D']:
+      elif self.m_args.score_type in ['C', 'D', 'CD']:
         self.m_tool_chain.compute_scores(
             self.m_tool,
             self.m_args.zt_norm,
             indices = self.indices(self.m_file_selector.t_model_ids(self.m_args.group), self.m_grid.number_of_models_per_scoring_job),
             groups = [self.m_args.group],
-            types = [self.m_args.score_type],
+            types = list(self.m_args.score_type),
             preload_probes = self.m_args.preload_probes,
             force = self.m_args.force)
 
       else:
         self.m_tool_chain.zt_norm(groups = [self.m_args.group])
 
+    # merge the tiles of the scores
+    elif self.m_args.sub_task == 'merge-scores':
+      self.m_tool_chain.merge_score_tiles(
+          self.m_args.zt_norm,
+          probe_indices = self.__index_ranges__(len(self.m_file_selector.probe_objects(self.m_args.group)), self.m_grid.number_of_probes_per_scoring_job),
+          indices = self.indices(self.m_file_selector.model_ids(self.m_args.group), self.m_grid.number_of_models_per_scoring_job),
+          groups = [self.m_args.group])
+
     # concatenate
     elif self.m_args.sub_task == 'concatenate':
       self.m_tool_chain.concatenate(
@@ -473,15 +711,27 @@ def parse_args(command_line_parameters):
       help = 'Preload probe files during score computation (needs more memory, but is faster and requires fewer file accesses). WARNING! Use this flag with care!')
   other_group.add_argument('--groups', metavar = 'GROUP', nargs = '+', default = ['dev'],
       help = "The group (i.e., 'dev' or  'eval') for which the models and scores should be generated")
+  other_group.add_argument('-j', '--parallel', metavar = 'N', type = int,
+      help = 'Execute the tool chain on the local machine using N parallel processes; jobs are started as soon as the files that they depend on are generated (ignored when --grid is specified)')
+  other_group.add_argument('--share-machines', action='store_true',
+      help = 'Share the parameters of the trained projector and enroller between all processes on one machine using memory-mapped files (only supported by some tools)')
+  other_group.add_argument('--files-per-job', metavar = 'N', type = int, default = 100,
+      help = 'The number of files that one preprocessing, extraction or projection job handles (only used with --parallel)')
+  other_group.add_argument('--models-per-job', metavar = 'N', type = int, default = 1,
+      help = 'The number of models that one enrollment or scoring job handles (only used with --parallel)')
+  other_group.add_argument('--probes-per-job', metavar = 'N', type = int,
+      help = 'The scores are computed in tiles of --models-per-job models times N probes, which are merged afterwards; by default, N is derived from the number of models and probes and from --scoring-memory, and 0 disables the tiling (only used with --parallel)')
+  other_group.add_argument('--scoring-memory', metavar = 'MB', type = float, default = 1000.,
+      help = 'The approximate memory in megabytes that the probes of one automatically sized score tile may occupy (only used with --parallel, when --probes-per-job is not given)')
 
   #######################################################################################
   #################### sub-tasks being executed by this script ##########################
   parser.add_argument('--sub-task',
-      choices = ('preprocess', 'train-extractor', 'extract', 'train-projector', 'project', 'train-enroller', 'enroll', 'compute-scores', 'concatenate', 'calibrate'),
+      choices = ('preprocess', 'train-extractor', 'extract', 'train-projector', 'project', 'train-enroller', 'enroll', 'compute-scores', 'merge-scores', 'concatenate', 'calibrate'),
       help = argparse.SUPPRESS) #'Executes a subtask (FOR INTERNAL USE ONLY!!!)'
   parser.add_argument('--model-type', choices = ['N', 'T'],
       help = argparse.SUPPRESS) #'Which type of models to generate (Normal or TModels)'
-  parser.add_argument('--score-type', choices = ['A', 'B', 'C', 'D', 'Z'],
+  parser.add_argument('--score-type', choices = ['A', 'B', 'C', 'D', 'AB', 'CD', 'Z'],
       help = argparse.SUPPRESS) #'The type of scores that should be computed'
   parser.add_argument('--group',
       help = argparse.SUPPRESS) #'The group for which the current action should be performed'
@@ -515,7 +765,10 @@ def face_verify(args, command_line_parameters, external_dependencies = [], exter
 
     executor.write_info(command_line_parameters)
 
-    executor.execute_tool_chain()
+    if args.parallel:
+      executor.execute_job_graph()
+    else:
+      executor.execute_tool_chain()
 
     if args.timer:
       end_time = os.times()
@@ -25,7 +25,7 @@ import bob
 import numpy
 
 from . import ToolChainExecutor
-from .. import toolchain, tools, utils
+from .. import toolchain, tools, trainers, utils
 
 
 class ToolChainExecutorISV (ToolChainExecutor.ToolChainExecutor, tools.ParallelUBMGMM):
@@ -45,6 +45,9 @@ class ToolChainExecutorISV (ToolChainExecutor.ToolChainExecutor, tools.ParallelU
       self.m_database.protocol = args.protocol
 
     self.m_configuration.normalized_directory = os.path.join(self.m_configuration.temp_directory, 'normalized_features')
+    self.m_configuration.normalization_stats_file = os.path.join(self.m_configuration.normalized_directory, 'stats_%05d-%05d.hdf5')
+    self.m_configuration.normalization_file = os.path.join(self.m_configuration.normalized_directory, 'std.hdf5')
+    self.m_configuration.training_cache_file = os.path.join(self.m_configuration.temp_directory, 'training_cache', 'data_%05d-%05d.npy')
     self.m_configuration.kmeans_file = os.path.join(self.m_configuration.temp_directory, 'k_means.hdf5')
     self.m_configuration.kmeans_intermediate_file = os.path.join(self.m_configuration.temp_directory, 'kmeans_temp', 'i_%05d', 'k_means.hdf5')
     self.m_configuration.kmeans_stats_file = os.path.join(self.m_configuration.temp_directory, 'kmeans_temp', 'i_%05d', 'stats_%05d-%05d.hdf5')
@@ -52,6 +55,8 @@ class ToolChainExecutorISV (ToolChainExecutor.ToolChainExecutor, tools.ParallelU
     self.m_configuration.gmm_intermediate_file = os.path.join(self.m_configuration.temp_directory, 'gmm_temp', 'i_%05d', 'gmm.hdf5')
     self.m_configuration.gmm_stats_file = os.path.join(self.m_configuration.temp_directory, 'gmm_temp', 'i_%05d', 'stats_%05d-%05d.hdf5')
     self.m_tool.m_isv_filename = os.path.join(self.m_configuration.temp_directory, 'isv.hdf5')
+    self.m_configuration.isv_intermediate_file = os.path.join(self.m_configuration.temp_directory, 'isv_temp', 'i_%05d', 'isv.hdf5')
+    self.m_configuration.isv_stats_file = os.path.join(self.m_configuration.temp_directory, 'isv_temp', 'i_%05d', 'stats_%05d-%05d.hdf5')
     self.m_tool.m_projected_toreplace = 'projected'
     self.m_tool.m_projected_gmm = 'projected_gmm'
     self.m_tool.m_projected_isv = 'projected_isv'
@@ -103,8 +108,13 @@ class ToolChainExecutorISV (ToolChainExecutor.ToolChainExecutor, tools.ParallelU
 ####################  Functions that will be executed in the grid  ####################
 #######################################################################################
 
+  def isv_client_list(self):
+    """Returns the list of projected training files arranged by client, which is required for the ISV training"""
+    return self.m_file_selector.training_list('projected', 'train_projector', arrange_by_client = True)
+
+
   def isv_training(self, force=False):
-    """Finally, the UBM is used to train the ISV projector/enroller."""
+    """Trains the ISV subspace with the bob.trainer.ISVTrainer in a single job (non-parallel)."""
     if self.m_tool_chain.__check_file__(self.m_tool.m_isv_filename, force, 800):
       utils.info("ISV training: Skipping ISV training since '%s' already exists" % self.m_tool.m_isv_filename)
     else:
@@ -112,8 +122,7 @@ class ToolChainExecutorISV (ToolChainExecutor.ToolChainExecutor, tools.ParallelU
       self.m_tool.m_ubm = bob.machine.GMMMachine(bob.io.HDF5File(self.m_tool.m_gmm_filename))
 
       # read training data
-      training_list = self.m_file_selector.training_list('projected', 'train_projector', arrange_by_client = True)
-      train_features = self.m_tool_chain.__read_features_by_client__(training_list, self.m_tool)
+      train_features = self.m_tool_chain.__read_features_by_client__(self.isv_client_list(), self.m_tool)
 
       # perform ISV training
       utils.info("ISV training: training ISV with %d clients" % len(train_features))
@@ -124,6 +133,78 @@ class ToolChainExecutorISV (ToolChainExecutor.ToolChainExecutor, tools.ParallelU
       self.m_tool._save_projector_together(self.m_configuration.projector_file)
 
 
+  def __isv_trainer__(self):
+    """Returns the map-reduce trainer of the ISV subspace, using the UBM that was trained before."""
+    # read UBM into the ISV class
+    self.m_tool.m_ubm = bob.machine.GMMMachine(bob.io.HDF5File(self.m_tool.m_gmm_filename))
+    return trainers.ISV(self.m_tool.m_ubm, self.m_tool.m_subspace_dimension_of_u, self.m_tool.m_isv_training_iterations, self.m_tool.m_relevance_factor, seed = self.m_tool.m_init_seed)
+
+
+  def isv_initialize(self, force=False):
+    """Initializes the U subspace of the ISV training (non-parallel)."""
+    output_file = self.m_configuration.isv_intermediate_file % 0
+
+    if self.m_tool_chain.__check_file__(output_file, force, 800):
+      utils.info("ISV training: Skipping ISV initialization since the file '%s' already exists" % output_file)
+    else:
+      trainer = self.__isv_trainer__()
+      utils.ensure_dir(os.path.dirname(output_file))
+      trainer.save_machine(trainer.initialize(None), output_file)
+      utils.info("ISV training: Wrote initial ISV machine '%s'" % output_file)
+
+
+  def isv_estep(self, indices, force=False):
+    """Performs a single E-step of the ISV training on the clients with the given indices (parallel)."""
+    stats_file = self.m_configuration.isv_stats_file % (self.m_args.iteration, indices[0], indices[1])
+
+    if self.m_tool_chain.__check_file__(stats_file, force, 1000):
+      utils.info("ISV training: Skipping ISV E-Step since the file '%s' already exists" % stats_file)
+    else:
+      machine_file = self.m_configuration.isv_intermediate_file % self.m_args.iteration
+      trainer = self.__isv_trainer__()
+      train_features = self.m_tool_chain.__read_features_by_client__(self.isv_client_list()[indices[0]:indices[1]], self.m_tool)
+      utils.info("ISV training: E-step %d with %d clients" % (self.m_args.iteration, len(train_features)))
+      utils.ensure_dir(os.path.dirname(stats_file))
+      trainer.map_to_file(machine_file, train_features, stats_file)
+      utils.info("ISV training: Wrote ISV stats '%s'" % stats_file)
+
+
+  def isv_mstep(self, counts, force=False):
+    """Performs a single M-step of the ISV training (non-parallel); after the last iteration, the ISV base is written."""
+    old_machine_file = self.m_configuration.isv_intermediate_file % self.m_args.iteration
+    new_machine_file = self.m_configuration.isv_intermediate_file % (self.m_args.iteration + 1)
+    last_iteration = self.m_args.iteration == self.m_tool.m_isv_training_iterations - 1
+
+    if self.m_tool_chain.__check_file__(new_machine_file, force, 800):
+      utils.info("ISV training: Skipping ISV M-Step since the file '%s' already exists" % new_machine_file)
+    else:
+      # reduce the statistics of the E-step jobs and perform the M-step
+      client_list = self.isv_client_list()
+      stats_files = [self.m_configuration.isv_stats_file % (self.m_args.iteration, 0, len(client_list))]
+      if not os.path.exists(stats_files[0]):
+        # use the files of the job array
+        job_ids = range(self._generate_job_array(client_list, counts)[1])
+        stats_files = [self.m_configuration.isv_stats_file % (self.m_args.iteration, counts * job_id, min(counts * (job_id+1), len(client_list))) for job_id in job_ids]
+      trainer = self.__isv_trainer__()
+      norm = trainer.reduce_files(old_machine_file, stats_files, new_machine_file)
+      utils.info("ISV training: Performed M step %d; the norm of U is %f" % (self.m_args.iteration, norm))
+
+      if last_iteration:
+        self.m_tool.m_isvbase = trainer.bob_machine(trainer.load_machine(new_machine_file))
+        utils.ensure_dir(os.path.dirname(self.m_tool.m_isv_filename))
+        self.m_tool._save_projector_isv_resolved(self.m_tool.m_isv_filename)
+        utils.info("ISV training: saved ISV matrix to '%s'" % self.m_tool.m_isv_filename)
+        self.m_tool._save_projector_together(self.m_configuration.projector_file)
+
+    if self.m_args.clean_intermediate and self.m_args.iteration > 0:
+      old_file = self.m_configuration.isv_intermediate_file % (self.m_args.iteration-1)
+      utils.info("Removing old intermediate directory '%s'" % os.path.dirname(old_file))
+      shutil.rmtree(os.path.dirname(old_file))
+    if self.m_args.clean_intermediate and last_iteration:
+      utils.info("Removing intermediate directory '%s'" % os.path.dirname(old_machine_file))
+      shutil.rmtree(os.path.dirname(old_machine_file))
+
+
   def isv_project(self, indices, force=False):
     """Performs ISV projection"""
     # read UBM into the ISV class
@@ -141,20 +222,15 @@ class ToolChainExecutorISV (ToolChainExecutor.ToolChainExecutor, tools.ParallelU
       index_range = range(len(projected_files))
 
     utils.info("- Projection: projecting %d gmm stats from directory '%s' to directory '%s'" % (len(index_range), self.m_tool._resolve_projected_gmm(self.m_file_selector.projected_directory), self.m_tool._resolve_projected_isv(self.m_file_selector.projected_directory)))
-    # extract the features
-    for i in index_range:
-      projected_file = projected_files[i]
-      projected_file_gmm_resolved = self.m_tool._resolve_projected_gmm(projected_file)
-      projected_file_isv_resolved = self.m_tool._resolve_projected_isv(projected_file)
-
-      if not self.m_tool_chain.__check_file__(projected_file_isv_resolved, force):
-        # load feature
-        feature = self.m_tool.read_feature(str(projected_file))
-        # project feature
-        projected = self.m_tool._project_isv(feature)
+    # only the features that are not projected yet need to be processed
+    index_range = [i for i in index_range if not self.m_tool_chain.__check_file__(self.m_tool._resolve_projected_isv(projected_files[i]), force)]
+    for batch in self.m_tool_chain.__batches__(index_range):
+      # load a chunk of GMM statistics and compute their Ux vectors at once
+      features = [self.m_tool.read_feature(str(projected_files[i])) for i in batch]
+      for i, projected in zip(batch, self.m_tool._project_isv_batch(features)):
         # write it
-        utils.ensure_dir(os.path.dirname(projected_file_isv_resolved))
-        self.m_tool._save_feature_isv(projected, str(projected_file))
+        utils.ensure_dir(os.path.dirname(self.m_tool._resolve_projected_isv(projected_files[i])))
+        self.m_tool._save_feature_isv(projected, str(projected_files[i]))
 
 #######################################################################################
 ##############  Functions dealing with submission and execution of jobs  ##############
@@ -286,14 +362,47 @@ class ToolChainExecutorISV (ToolChainExecutor.ToolChainExecutor, tools.ParallelU
 
     # feature projection training
     if not self.m_args.skip_isv:
-      # check if we have a special queue for the ISV training (which usually needs a lot of memory)
+      # check if we have a special queue for the ISV M-steps (which usually need a lot of memory)
       queue = self.m_grid.isv_training_queue if hasattr(self.m_grid, 'isv_training_queue') else self.m_grid.training_queue
-      job_ids['isv_training'] = self.submit_grid_job(
-              'train-isv',
-              name="isv",
-              dependencies = deps,
-              **queue)
-      deps.append(job_ids['isv_training'])
+      if not self.m_args.parallel_isv_training:
+        # the exact ISV training of bob in a single job
+        job_ids['isv-training'] = self.submit_grid_job(
+                'isv-training',
+                name = 'i-train',
+                dependencies = deps,
+                **queue)
+        deps.append(job_ids['isv-training'])
+
+      else:
+        # initialization
+        if not self.m_args.isv_start_iteration:
+          job_ids['isv-init'] = self.submit_grid_job(
+                  'isv-init',
+                  name = 'i-init',
+                  dependencies = deps,
+                  **self.m_grid.training_queue)
+          deps.append(job_ids['isv-init'])
+
+        # several iterations of E and M steps
+        for iteration in range(self.m_args.isv_start_iteration, self.m_tool.m_isv_training_iterations):
+          # E-step
+          job_ids['isv-e-step'] = self.submit_grid_job(
+                  'isv-e-step --iteration %d' % iteration,
+                  name='i-e-%d' % iteration,
+                  list_to_split = self.isv_client_list(),
+                  number_of_files_per_job = self.m_grid.number_of_training_clients_per_job,
+                  dependencies = [job_ids['isv-m-step']] if iteration != self.m_args.isv_start_iteration else deps,
+                  **self.m_grid.projection_queue)
+
+          # M-step
+          job_ids['isv-m-step'] = self.submit_grid_job(
+                  'isv-m-step --iteration %d' % iteration,
+                  name='i-m-%d' % iteration,
+                  dependencies = [job_ids['isv-e-step']],
+                  **queue)
+
+        # add dependence to the last m step
+        deps.append(job_ids['isv-m-step'])
 
     # isv projection
     if not self.m_args.skip_isv_projection:
@@ -334,49 +443,34 @@ class ToolChainExecutorISV (ToolChainExecutor.ToolChainExecutor, tools.ParallelU
                   **self.m_grid.enrollment_queue)
           enroll_deps_t[group].append(job_ids['enroll_%s_T'%group])
 
-      # compute A,B,C, and D scores
+      # compute A,B,C, and D scores; A and B (as well as C and D) scores are computed in the same job, so that each model is read only once
       if not self.m_args.skip_score_computation:
-        job_ids['score_%s_A'%group] = self.submit_grid_job(
-                'compute-scores --group %s --score-type A'%group,
-                name = "score-A-%s"%group,
+        a_type = 'AB' if self.m_args.zt_norm else 'A'
+        job_ids['score_%s_%s'%(group, a_type)] = self.submit_grid_job(
+                'compute-scores --group %s --score-type %s'%(group, a_type),
+                name = "score-%s-%s"%(a_type, group),
                 list_to_split = self.m_file_selector.model_ids(group),
                 number_of_files_per_job = self.m_grid.number_of_models_per_scoring_job,
                 dependencies = enroll_deps_n[group],
                 **self.m_grid.scoring_queue)
-        concat_deps[group] = [job_ids['score_%s_A'%group]]
+        concat_deps[group] = [job_ids['score_%s_%s'%(group, a_type)]]
 
         if self.m_args.zt_norm:
-          job_ids['score_%s_B'%group] = self.submit_grid_job(
-                  'compute-scores --group %s --score-type B'%group,
-                  name = "score-B-%s"%group,
-                  list_to_split = self.m_file_selector.model_ids(group),
-                  number_of_files_per_job = self.m_grid.number_of_models_per_scoring_job,
-                  dependencies = enroll_deps_n[group],
-                  **self.m_grid.scoring_queue)
-
-          job_ids['score_%s_C'%group] = self.submit_grid_job(
-                  'compute-scores --group %s --score-type C'%group,
-                  name = "score-C-%s"%group,
-                  list_to_split = self.m_file_selector.t_model_ids(group),
-                  number_of_files_per_job = self.m_grid.number_of_models_per_scoring_job,
-                  dependencies = enroll_deps_t[group],
-                  **self.m_grid.scoring_queue)
-
-          job_ids['score_%s_D'%group] = self.submit_grid_job(
-                  'compute-scores --group %s --score-type D'%group,
-                  name = "score-D-%s"%group,
+          job_ids['score_%s_CD'%group] = self.submit_grid_job(
+                  'compute-scores --group %s --score-type CD'%group,
+                  name = "score-CD-%s"%group,
                   list_to_split = self.m_file_selector.t_model_ids(group),
                   number_of_files_per_job = self.m_grid.number_of_models_per_scoring_job,
                   dependencies = enroll_deps_t[group],
                   **self.m_grid.scoring_queue)
 
           # compute zt-norm
-          score_deps[group] = [job_ids['score_%s_A'%group], job_ids['score_%s_B'%group], job_ids['score_%s_C'%group], job_ids['score_%s_D'%group]]
+          score_deps[group] = [job_ids['score_%s_AB'%group], job_ids['score_%s_CD'%group]]
           job_ids['score_%s_Z'%group] = self.submit_grid_job(
                   'compute-scores --group %s --score-type Z'%group,
                   name = "score-Z-%s"%group,
                   dependencies = score_deps[group])
-          concat_deps[group].extend([job_ids['score_%s_B'%group], job_ids['score_%s_C'%group], job_ids['score_%s_D'%group], job_ids['score_%s_Z'%group]])
+          concat_deps[group].extend([job_ids['score_%s_CD'%group], job_ids['score_%s_Z'%group]])
       else:
         concat_deps[group] = []
 
@@ -461,10 +555,27 @@ class ToolChainExecutorISV (ToolChainExecutor.ToolChainExecutor, tools.ParallelU
           force = self.m_args.force)
 
     # train the feature projector
-    elif self.m_args.sub_task == 'train-isv':
+    elif self.m_args.sub_task == 'isv-training':
       self.isv_training(
           force = self.m_args.force)
 
+    # train the feature projector
+    elif self.m_args.sub_task == 'isv-init':
+      self.isv_initialize(
+          force = self.m_args.force)
+
+    # train the feature projector
+    elif self.m_args.sub_task == 'isv-e-step':
+      self.isv_estep(
+          indices = self.indices(self.isv_client_list(), self.m_grid.number_of_training_clients_per_job),
+          force = self.m_args.force)
+
+    # train the feature projector
+    elif self.m_args.sub_task == 'isv-m-step':
+      self.isv_mstep(
+          counts = self.m_grid.number_of_training_clients_per_job,
+          force = self.m_args.force)
+
     # project using isv
     elif self.m_args.sub_task == 'isv-project':
       self.isv_project(
@@ -495,23 +606,23 @@ class ToolChainExecutorISV (ToolChainExecutor.ToolChainExecutor, tools.ParallelU
 
     # compute scores
     elif self.m_args.sub_task == 'compute-scores':
-      if self.m_args.score_type in ['A', 'B']:
+      if self.m_args.score_type in ['A', 'B', 'AB']:
         self.m_tool_chain.compute_scores(
             self.m_tool,
             self.m_args.zt_norm,
             indices = self.indices(self.m_file_selector.model_ids(self.m_args.group), self.m_grid.number_of_models_per_scoring_job),
             groups = [self.m_args.group],
-            types = [self.m_args.score_type],
+            types = list(self.m_args.score_type),
             preload_probes = self.m_args.preload_probes,
             force = self.m_args.force)
 
-      elif self.m_args.score_type in ['C', 'D']:
+      elif self.m_args.score_type in ['C', 'D', 'CD']:
         self.m_tool_chain.compute_scores(
             self.m_tool,
             self.m_args.zt_norm,
             indices = self.indices(self.m_file_selector.t_model_ids(self.m_args.group), self.m_grid.number_of_models_per_scoring_job),
             groups = [self.m_args.group],
-            types = [self.m_args.score_type],
+            types = list(self.m_args.score_type),
             preload_probes = self.m_args.preload_probes,
             force = self.m_args.force)
 
@@ -579,10 +690,16 @@ def parse_args(command_line_parameters):
       help = 'Specify the number of training iterations for the GMM training')
   other_group.add_argument('-m', '--gmm-start-iteration', type=int, default=0,
       help = 'Specify the first iteration for the GMM training (i.e. to restart)')
+  other_group.add_argument('--parallel-isv-training', action='store_true',
+      help = 'Split the ISV training into E- and M-step jobs of the map-reduce trainer, which re-estimates the latent factors in each iteration and hence approximates the bob.trainer.ISVTrainer; by default, the exact bob training runs in a single job')
+  other_group.add_argument('--isv-start-iteration', type=int, default=0,
+      help = 'Specify the first iteration for the parallel ISV training (i.e. to restart)')
   other_group.add_argument('-n', '--normalize-features', action='store_true',
-      help = 'Normalize features before ISV training?')
+      help = 'Normalize features to unit variance for the UBM training?')
   other_group.add_argument('-C', '--clean-intermediate', action='store_true',
       help = 'Clean up temporary files of older iterations?')
+  other_group.add_argument('--training-cache-dtype', choices = ('float64', 'float32'), default = 'float64',
+      help = 'The data type of the cached (normalized) training data of the UBM training; float32 halves the memory and I/O of the E-step jobs')
 
   skip_group.add_argument('--skip-normalization', '--non', action='store_true',
       help = "Skip the feature normalization step")
@@ -600,13 +717,13 @@ def parse_args(command_line_parameters):
   #######################################################################################
   #################### sub-tasks being executed by this script ##########################
   parser.add_argument('--sub-task',
-      choices = ('preprocess', 'train-extractor', 'extract', 'normalize-features', 'kmeans-init', 'kmeans-e-step', 'kmeans-m-step', 'gmm-init', 'gmm-e-step', 'gmm-m-step', 'gmm-project', 'train-isv', 'isv-project', 'enroll', 'compute-scores', 'concatenate'),
+      choices = ('preprocess', 'train-extractor', 'extract', 'normalize-features', 'kmeans-init', 'kmeans-e-step', 'kmeans-m-step', 'gmm-init', 'gmm-e-step', 'gmm-m-step', 'gmm-project', 'isv-training', 'isv-init', 'isv-e-step', 'isv-m-step', 'isv-project', 'enroll', 'compute-scores', 'concatenate'),
       help = argparse.SUPPRESS) #'Executes a subtask (FOR INTERNAL USE ONLY!!!)'
   parser.add_argument('--iteration', type=int,
-      help = argparse.SUPPRESS) #'The current iteration of KMeans or GMM training'
+      help = argparse.SUPPRESS) #'The current iteration of KMeans, GMM or ISV training'
   parser.add_argument('--model-type', choices = ['N', 'T'],
       help = argparse.SUPPRESS) #'Which type of models to generate (Normal or TModels)'
-  parser.add_argument('--score-type', choices = ['A', 'B', 'C', 'D', 'Z'],
+  parser.add_argument('--score-type', choices = ['A', 'B', 'C', 'D', 'AB', 'CD', 'Z'],
       help = argparse.SUPPRESS) #'The type of scores that should be computed'
   parser.add_argument('--group',
       help = argparse.SUPPRESS) #'The group for which the current action should be performed'
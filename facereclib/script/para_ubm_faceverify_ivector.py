@@ -25,7 +25,7 @@ import bob
 import numpy
 
 from . import ToolChainExecutor
-from .. import toolchain, tools, utils
+from .. import toolchain, tools, utils, trainers
 
 
 class ToolChainExecutorIVector (ToolChainExecutor.ToolChainExecutor, tools.ParallelUBMGMM):
@@ -45,6 +45,9 @@ class ToolChainExecutorIVector (ToolChainExecutor.ToolChainExecutor, tools.Paral
       self.m_database.protocol = args.protocol
 
     self.m_configuration.normalized_directory = os.path.join(self.m_configuration.temp_directory, 'normalized_features')
+    self.m_configuration.normalization_stats_file = os.path.join(self.m_configuration.normalized_directory, 'stats_%05d-%05d.hdf5')
+    self.m_configuration.normalization_file = os.path.join(self.m_configuration.normalized_directory, 'std.hdf5')
+    self.m_configuration.training_cache_file = os.path.join(self.m_configuration.temp_directory, 'training_cache', 'data_%05d-%05d.npy')
     self.m_configuration.kmeans_file = os.path.join(self.m_configuration.temp_directory, 'k_means.hdf5')
     self.m_configuration.kmeans_intermediate_file = os.path.join(self.m_configuration.temp_directory, 'kmeans_temp', 'i_%05d', 'k_means.hdf5')
     self.m_configuration.kmeans_stats_file = os.path.join(self.m_configuration.temp_directory, 'kmeans_temp', 'i_%05d', 'stats_%05d-%05d.hdf5')
@@ -124,7 +127,7 @@ class ToolChainExecutorIVector (ToolChainExecutor.ToolChainExecutor, tools.Paral
 
       # Load data
       training_list = self.m_file_selector.training_list('projected', 'train_projector')
-      data = [self.m_tool.read_feature(str(training_list[index])) for index in range(indices[0], indices[1])]
+      data = [self.m_tool._read_gmm_stats(str(training_list[index])) for index in range(indices[0], indices[1])]
 
       # Creates the IVectorTrainer and call the initialization procedure
       ivector_trainer = bob.trainer.IVectorTrainer(update_sigma=self.m_tool.m_update_sigma, max_iterations=self.m_tool.m_tv_training_iterations)
@@ -174,7 +177,7 @@ class ToolChainExecutorIVector (ToolChainExecutor.ToolChainExecutor, tools.Paral
         acc_nij_wij2, acc_fnormij_wij, acc_nij, acc_snormij = self._read_stats(stats_file)
       else:
         # load several files
-        job_ids = range(self.__generate_job_array__(training_list, counts)[1])
+        job_ids = range(self._generate_job_array(training_list, counts)[1])
         job_indices = [(counts * job_id, min(counts * (job_id+1), len(training_list))) for job_id in job_ids]
         stats_files = [self.m_configuration.ivector_stats_file % (self.m_args.iteration, indices[0], indices[1]) for indices in job_indices]
 
@@ -238,20 +241,21 @@ class ToolChainExecutorIVector (ToolChainExecutor.ToolChainExecutor, tools.Paral
       index_range = range(len(projected_files))
 
     utils.info("- Projection: projecting %d gmm stats from directory '%s' to directory '%s'" % (len(index_range), self.m_tool._resolve_projected_gmm(self.m_file_selector.projected_directory), self.m_tool._resolve_projected_ivector(self.m_file_selector.projected_directory)))
-    # extract the features
-    for i in index_range:
-      projected_file = projected_files[i]
-      projected_file_gmm_resolved = self.m_tool._resolve_projected_gmm(projected_file)
-      projected_file_ivec_resolved = self.m_tool._resolve_projected_ivector(projected_file)
-
-      if not self.m_tool_chain.__check_file__(projected_file_ivec_resolved, force):
-        # load feature
-        feature = self.m_tool.read_feature(str(projected_file))
-        # project feature
-        projected = self.m_tool._project_ivector(feature)
-        # write it
-        utils.ensure_dir(os.path.dirname(projected_file_ivec_resolved))
-        self.m_tool._save_feature_ivector(projected, str(projected_file))
+    # only the features that are not projected yet need to be processed
+    index_range = [i for i in index_range if not self.m_tool_chain.__check_file__(self.m_tool._resolve_projected_ivector(projected_files[i]), force)]
+    # extract the batches (in worker processes, which inherit the executor and the file list)
+    batches = self.m_tool_chain.__batches__(index_range)
+    trainers.Projection(lambda batch: self.__project_ivector_batch__(projected_files, batch)).map_chunks(None, [[batch] for batch in batches], parallel = self.m_args.projection_processes)
+
+
+  def __project_ivector_batch__(self, projected_files, batch):
+    """Extracts the i-vectors of the projected files with the given indices at once, and writes them"""
+    # load a batch of GMM statistics
+    features = [self.m_tool._read_gmm_stats(str(projected_files[i])) for i in batch]
+    for i, projected in zip(batch, self.m_tool._project_ivector_batch(features)):
+      # write it
+      utils.ensure_dir(os.path.dirname(self.m_tool._resolve_projected_ivector(projected_files[i])))
+      self.m_tool._save_feature_ivector(projected, str(projected_files[i]))
 
 #######################################################################################
 ##############  Functions dealing with submission and execution of jobs  ##############
@@ -562,14 +566,18 @@ def parse_args(command_line_parameters):
   other_group.add_argument('-m', '--gmm-start-iteration', type=int, default=0,
       help = 'Specify the first iteration for the GMM training (i.e. to restart)')
   other_group.add_argument('-n', '--normalize-features', action='store_true',
-      help = 'Normalize features before IVector training?')
+      help = 'Normalize features to unit variance for the UBM training?')
   other_group.add_argument('-C', '--clean-intermediate', action='store_true',
       help = 'Clean up temporary files of older iterations?')
+  other_group.add_argument('--training-cache-dtype', choices = ('float64', 'float32'), default = 'float64',
+      help = 'The data type of the cached (normalized) training data of the UBM training; float32 halves the memory and I/O of the E-step jobs')
 
   other_group.add_argument('-Q', '--ivector-training-iterations', type=int, default=25,
       help = 'Specify the number of training iterations for the IVector training')
   other_group.add_argument('-q', '--ivector-start-iteration', type=int, default=0,
       help = 'Specify the first iteration for the IVector training (i.e. to restart)')
+  other_group.add_argument('--projection-processes', type=int, default=1,
+      help = 'The number of worker processes that extract the i-vectors of the files handled by one i-vector projection job')
 
   skip_group.add_argument('--skip-normalization', '--non', action='store_true',
       help = "Skip the feature normalization step")
@@ -148,6 +148,66 @@ class ScriptTest (unittest.TestCase):
     self.__face_verify__(parameters, test_dir, 'test_c')
 
 
+  def test01d_faceverify_job_graph(self):
+    test_dir = tempfile.mkdtemp(prefix='frltest_')
+    # define dummy parameters
+    parameters = [
+        '-d', os.path.join(base_dir, 'scripts', 'atnt_Test.py'),
+        '-p', 'face-crop',
+        '-f', 'facereclib.features.Eigenface(subspace_dimension', '=', '100)',
+        '-t', 'facereclib.tools.Dummy()',
+        '--zt-norm',
+        '-b', 'test_d',
+        '--temp-directory', test_dir,
+        '--user-directory', test_dir,
+        '--parallel', '4', '--files-per-job', '5'
+    ]
+
+    print ' '.join(parameters)
+
+    self.__face_verify__(parameters, test_dir, 'test_d')
+
+
+  def test01e_faceverify_score_tiles(self):
+    test_dir = tempfile.mkdtemp(prefix='frltest_')
+    # define dummy parameters
+    parameters = [
+        '-d', os.path.join(base_dir, 'scripts', 'atnt_Test.py'),
+        '-p', 'face-crop',
+        '-f', 'facereclib.features.Eigenface(subspace_dimension', '=', '100)',
+        '-t', 'facereclib.tools.Dummy()',
+        '--zt-norm',
+        '-b', 'test_e',
+        '--temp-directory', test_dir,
+        '--user-directory', test_dir,
+        '--parallel', '2', '--models-per-job', '2', '--probes-per-job', '7'
+    ]
+
+    print ' '.join(parameters)
+
+    self.__face_verify__(parameters, test_dir, 'test_e')
+
+
+  def test01f_faceverify_automatic_score_tiles(self):
+    test_dir = tempfile.mkdtemp(prefix='frltest_')
+    # define dummy parameters; with only one range of models, the probes are split into one tile per process
+    parameters = [
+        '-d', os.path.join(base_dir, 'scripts', 'atnt_Test.py'),
+        '-p', 'face-crop',
+        '-f', 'facereclib.features.Eigenface(subspace_dimension', '=', '100)',
+        '-t', 'facereclib.tools.Dummy()',
+        '--zt-norm',
+        '-b', 'test_f',
+        '--temp-directory', test_dir,
+        '--user-directory', test_dir,
+        '--parallel', '3', '--models-per-job', '100'
+    ]
+
+    print ' '.join(parameters)
+
+    self.__face_verify__(parameters, test_dir, 'test_f')
+
+
   def test01m_faceverify_calibrate(self):
     test_dir = tempfile.mkdtemp(prefix='frltest_')
     # define dummy parameters
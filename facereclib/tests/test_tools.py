@@ -53,6 +53,22 @@ class ToolTest(unittest.TestCase):
     self.assertTrue((numpy.abs(bob.io.load(self.reference_dir(reference)) - feature) < 1e-5).all())
 
 
+  def shared_copy(self, reference):
+    # copies the given reference machine file to a temporary file, which can be shared by tools
+    fd, t = tempfile.mkstemp(os.path.basename(reference), prefix='frltest_')
+    os.close(fd)
+    import shutil
+    shutil.copy2(self.reference_dir(reference), t)
+    return t
+
+  def remove_shared(self, filename):
+    # removes the given temporary machine file and its shared arrays
+    import shutil
+    os.remove(filename)
+    if os.path.exists(facereclib.utils.shared.shared_directory(filename)):
+      shutil.rmtree(facereclib.utils.shared.shared_directory(filename))
+
+
   def train_gmm_stats(self, feature_file, count = 50, minimum = 0, maximum = 1):
     # generate a random sequence of GMM-Stats features
     numpy.random.seed(42)
@@ -142,10 +158,31 @@ class ToolTest(unittest.TestCase):
       self.assertTrue(numpy.abs(tool.m_machine.weights[:,i] - new_machine.weights[:,i] < 1e-5).all() or numpy.abs(tool.m_machine.weights[:,i] + new_machine.weights[:,i] < 1e-5).all())
     os.remove(t)
 
+    # the incremental PCA training (with the map-reduce trainer in two processes) needs to give the same results
+    streaming_tool = facereclib.tools.PCA(10, stream_training_features = True, training_threads = 2)
+    streaming_tool.train_projector(facereclib.utils.tests.random_training_set(feature.shape, count=400, minimum=0., maximum=255.), t)
+    os.remove(t)
+    self.assertEqual(streaming_tool.m_variances.shape, new_variances.shape)
+    self.assertTrue(numpy.allclose(streaming_tool.m_variances, new_variances))
+    for i in range(10):
+      self.assertTrue(numpy.allclose(streaming_tool.m_machine.weights[:,i], new_machine.weights[:,i]) or numpy.allclose(streaming_tool.m_machine.weights[:,i], -new_machine.weights[:,i]))
+
     # project feature
     projected = tool.project(feature)
     self.compare(projected, 'pca_feature.hdf5')
     self.assertTrue(len(projected.shape) == 1)
+    # projecting several features at once needs to give the same results
+    batch = tool.project_batch([feature, feature])
+    self.assertEqual(batch.shape, (2, projected.shape[0]))
+    self.assertTrue(numpy.allclose(batch[0], projected) and numpy.allclose(batch[1], projected))
+
+    # the shared projector needs to give the same results
+    t = self.shared_copy('pca_projector.hdf5')
+    shared_tool = facereclib.tools.PCA(10)
+    shared_tool.load_shared_projector(t)
+    self.assertTrue(facereclib.utils.shared.is_exported(t))
+    self.compare(shared_tool.project(feature), 'pca_feature.hdf5')
+    self.remove_shared(t)
 
     # enroll model
     model = tool.enroll([projected])
@@ -206,6 +243,13 @@ class ToolTest(unittest.TestCase):
       self.assertTrue(numpy.abs(tool.m_machine.weights[:,i] - new_machine.weights[:,i] < 1e-5).all() or numpy.abs(tool.m_machine.weights[:,i] + new_machine.weights[:,i] < 1e-5).all())
     os.remove(t)
 
+    # the incremental training of the scatter matrices needs to give the same eigenvalues
+    streaming_tool = facereclib.tools.LDA(5, 10, scipy.spatial.distance.seuclidean, True, True, stream_training_features = True, training_threads = 2)
+    streaming_tool.train_projector(facereclib.utils.tests.random_training_set_by_id(feature.shape, count=20, minimum=0., maximum=255.), t)
+    os.remove(t)
+    self.assertEqual(streaming_tool.m_machine.shape, new_machine.shape)
+    self.assertTrue(numpy.allclose(streaming_tool.m_variances, new_variances))
+
     # project feature
     projected = tool.project(feature)
     self.compare(projected, 'pca+lda_feature.hdf5')
@@ -246,6 +290,13 @@ class ToolTest(unittest.TestCase):
     self.assertFalse(tool.performs_projection)
     self.assertTrue(tool.requires_enroller_training)
 
+    # the pairs are computed from their numbers in the same order as nested loops would enumerate them
+    sizes = [3, 1, 4, 2]
+    offsets = numpy.cumsum([0] + sizes)
+    intra_pairs, extra_pairs = facereclib.tools.BIC(numpy.subtract).__intra_extra_pairs__([[None] * size for size in sizes])
+    self.assertEqual(zip(*intra_pairs), [(offsets[k] + c, offsets[k] + c2) for k in range(4) for c in range(sizes[k]) for c2 in range(c+1, sizes[k])])
+    self.assertEqual(zip(*extra_pairs), [(offsets[k] + c, offsets[j] + i) for k in range(4) for c in range(sizes[k]) for j in range(4) if j != k for i in range(sizes[j])])
+
     # train the enroller
     t = tempfile.mkstemp('bic.hdf5', prefix='frltest_')[1]
     tool.train_enroller(facereclib.utils.tests.random_training_set_by_id(feature.shape, count=10, minimum=0., maximum=255.), t)
@@ -324,6 +375,42 @@ class ToolTest(unittest.TestCase):
     self.assertTrue(tool.m_ubm.is_similar_to(new_machine))
     os.remove(t)
 
+    # the multi-threaded training needs to work as well
+    threaded_tool = facereclib.tools.UBMGMM(
+        number_of_gaussians = 2,
+        k_means_training_iterations = 1,
+        gmm_training_iterations = 1,
+        training_threads = 2,
+        INIT_SEED = seed_value,
+    )
+    threaded_tool.train_projector(facereclib.utils.tests.random_training_set(feature.shape, count=5, minimum=-5., maximum=5.), t)
+    os.remove(t)
+    self.assertEqual(threaded_tool.m_ubm.means.shape, tool.m_ubm.means.shape)
+    self.assertAlmostEqual(numpy.sum(threaded_tool.m_ubm.weights), 1.)
+    self.assertTrue((threaded_tool.m_ubm.variances >= 5e-4).all())
+
+    # the mini-batch training reads the training features one mini-batch after the other
+    mini_batch_tool = facereclib.tools.UBMGMM(
+        number_of_gaussians = 2,
+        mini_batch_size = 2 * feature.shape[0],
+        mini_batch_passes = 1,
+        INIT_SEED = seed_value,
+    )
+    self.assertTrue(mini_batch_tool.stream_training_features)
+    training_set = facereclib.utils.tests.random_training_set(feature.shape, count=5, minimum=-5., maximum=5.)
+    self.assertEqual([len(batch) for batch in mini_batch_tool.__split_features__(training_set)], [2, 2, 1])
+    mini_batch_tool.train_projector(facereclib.utils.streaming.LazyList(range(5), lambda index: training_set[int(index)]), t)
+    os.remove(t)
+    self.assertEqual(mini_batch_tool.m_ubm.means.shape, tool.m_ubm.means.shape)
+    self.assertAlmostEqual(numpy.sum(mini_batch_tool.m_ubm.weights), 1.)
+
+    # the vectorized normalization needs to be invertible
+    data = numpy.vstack(facereclib.utils.tests.random_training_set(feature.shape, count=5, minimum=-5., maximum=5.))
+    normalized, std = facereclib.utils.normalization.normalize_std_array(data, dtype = numpy.float32)
+    self.assertEqual(normalized.dtype, numpy.float32)
+    self.assertTrue(numpy.allclose(std, numpy.std(data, axis=0)))
+    self.assertTrue(numpy.allclose(facereclib.utils.normalization.multiply_by_factors(normalized, std), data, atol = 1e-5))
+
     # project the feature
     projected = tool.project(feature)
     if regenerate_refs:
@@ -342,6 +429,45 @@ class ToolTest(unittest.TestCase):
     sim = tool.score(reference_model, probe)
     self.assertAlmostEqual(sim, 0.25472347774)
     self.assertAlmostEqual(tool.score_for_multiple_probes(model, [probe, probe]), sim)
+    # the block scoring needs to compute the same scores for all models and probes
+    self.assertTrue(tool.block_scoring)
+    scores = tool.score_block([reference_model, model], [probe, probe])
+    self.assertEqual(scores.shape, (2,2))
+    self.assertTrue(numpy.allclose(scores, sim))
+    scores = tool.score_block_for_multiple_probes([reference_model, model], [[probe, probe], [probe]])
+    self.assertEqual(scores.shape, (2,2))
+    self.assertTrue(numpy.allclose(scores, sim))
+
+    # the shared UBM needs to give the same statistics, models and scores
+    t = self.shared_copy('gmm_projector.hdf5')
+    shared_tool = facereclib.tools.UBMGMM(number_of_gaussians = 2)
+    shared_tool.load_shared_projector(t)
+    self.assertTrue(isinstance(shared_tool.m_ubm, facereclib.utils.shared.SharedGMMMachine))
+    shared_projected = shared_tool.project(feature)
+    self.assertTrue(numpy.allclose(shared_projected.n, probe.n))
+    self.assertTrue(numpy.allclose(shared_projected.sum_px, probe.sum_px))
+    self.assertAlmostEqual(shared_projected.log_likelihood, probe.log_likelihood)
+    self.assertAlmostEqual(shared_tool.score(reference_model, probe), sim)
+    self.assertTrue(shared_tool.enroll([feature]).is_similar_to(reference_model))
+    self.remove_shared(t)
+
+    # the top-k statistics using all Gaussians need to be identical to the full statistics
+    top_k_tool = facereclib.tools.UBMGMM(number_of_gaussians = 2, top_k_gaussians = 2)
+    top_k_tool.load_projector(self.reference_dir('gmm_projector.hdf5'))
+    top_k = top_k_tool.project(feature)
+    self.assertTrue(numpy.allclose(top_k.n, probe.n))
+    self.assertTrue(numpy.allclose(top_k.sum_px, probe.sum_px))
+    self.assertAlmostEqual(top_k.log_likelihood, probe.log_likelihood)
+    # with a single Gaussian per feature vector, the statistics are written sparsely and need to be read transparently
+    top_k_tool = facereclib.tools.UBMGMM(number_of_gaussians = 2, top_k_gaussians = 1)
+    top_k_tool.load_projector(self.reference_dir('gmm_projector.hdf5'))
+    top_k = top_k_tool.project(feature)
+    self.assertAlmostEqual(numpy.sum(top_k.n), feature.shape[0])
+    t = tempfile.mkstemp('gmm_stats.hdf5', prefix='frltest_')[1]
+    top_k_tool.save_feature(top_k, t)
+    sparse = tool.read_probe(t)
+    os.remove(t)
+    self.assertTrue(top_k.is_similar_to(sparse))
 
 
   def test06a_gmm_regular(self):
@@ -377,6 +503,11 @@ class ToolTest(unittest.TestCase):
     sim = tool.score(reference_model, probe)
 
     self.assertAlmostEqual(sim, 0.143875716)
+    # the batch scoring of several models needs to give the same scores
+    scores = tool.score_models([reference_model, model], probe)
+    self.assertEqual(scores.shape, (2,))
+    self.assertAlmostEqual(scores[0], sim)
+    self.assertAlmostEqual(scores[1], tool.score(model, probe))
 
 
   def notest06b_gmm_video(self):
@@ -432,6 +563,25 @@ class ToolTest(unittest.TestCase):
     self.assertTrue(tool.m_isvbase.is_similar_to(enroller_reference))
     os.remove(t)
 
+    # the streaming training with parallel statistics accumulation needs to work as well, also with an existing UBM
+    for ubm_file in (None, self.reference_dir('gmm_projector.hdf5')):
+      streaming_tool = facereclib.tools.ISV(
+          number_of_gaussians = 2,
+          subspace_dimension_of_u = 160,
+          k_means_training_iterations = 1,
+          gmm_training_iterations = 1,
+          isv_training_iterations = 1,
+          training_threads = 2,
+          stream_training_features = True,
+          ubm_file = ubm_file,
+          INIT_SEED = seed_value
+      )
+      self.assertTrue(streaming_tool.stream_training_features)
+      streaming_tool.train_projector(facereclib.utils.tests.random_training_set_by_id(feature.shape, count=5, minimum=-5., maximum=5.), t)
+      os.remove(t)
+      self.assertEqual(streaming_tool.m_isvbase.u.shape, tool.m_isvbase.u.shape)
+    self.assertTrue(streaming_tool.m_ubm.is_similar_to(bob.machine.GMMMachine(bob.io.HDF5File(self.reference_dir('gmm_projector.hdf5')))))
+
     # project the feature
     projected = tool.project(feature)
     if regenerate_refs:
@@ -441,6 +591,15 @@ class ToolTest(unittest.TestCase):
     projected_reference = tool.read_feature(self.reference_dir('isv_feature.hdf5'))
     self.assertTrue(projected[0].is_similar_to(projected_reference))
 
+    # the cached Ux estimation needs to be identical to the one of bob
+    ux = numpy.ndarray((tool.m_ubm.dim_c * tool.m_ubm.dim_d,), numpy.float64)
+    bob.machine.ISVMachine(tool.m_isvbase).estimate_ux(projected[0], ux)
+    self.assertTrue(numpy.allclose(projected[1], ux))
+    batch = tool.project_batch([feature, feature])
+    self.assertEqual(len(batch), 2)
+    self.assertTrue(batch[1][0].is_similar_to(projected[0]))
+    self.assertTrue(numpy.allclose(batch[1][1], ux))
+
     # enroll model with the projected feature
     model = tool.enroll([projected[0]])
     if regenerate_refs:
@@ -460,6 +619,27 @@ class ToolTest(unittest.TestCase):
 
     # score with a concatenation of the probe
     self.assertAlmostEqual(tool.score_for_multiple_probes(model, [probe, probe]), sim, places=5)
+    # the Ux of the accumulated statistics needs to be the one that the enrolled model estimates
+    gmmstats_acc = bob.machine.GMMStats(probe[0])
+    gmmstats_acc += probe[0]
+    ux_acc = numpy.ndarray((tool.m_ubm.dim_c * tool.m_ubm.dim_d,), numpy.float64)
+    model.estimate_ux(gmmstats_acc, ux_acc)
+    self.assertTrue(numpy.allclose(tool.m_ux_estimator.estimate_ux([gmmstats_acc])[0], ux_acc))
+    self.assertAlmostEqual(tool.score_for_multiple_probes(model, [probe, probe]), model.forward_ux(gmmstats_acc, ux_acc))
+
+    # the shared UBM and ISV base need to give the same projections and scores
+    t = self.shared_copy('isv_projector.hdf5')
+    shared_tool = facereclib.tools.ISV(number_of_gaussians = 2, subspace_dimension_of_u = 160)
+    shared_tool.load_shared_projector(t)
+    self.assertTrue(shared_tool.m_isvbase is None)
+    shared_projected = shared_tool.project(feature)
+    self.assertTrue(numpy.allclose(shared_projected[0].sum_px, projected[0].sum_px))
+    self.assertTrue(numpy.allclose(shared_projected[1], ux))
+    shared_model = shared_tool.read_model(self.reference_dir('isv_model.hdf5'))
+    self.assertAlmostEqual(shared_tool.score(shared_model, probe), sim)
+    self.assertAlmostEqual(shared_tool.score_for_multiple_probes(shared_model, [probe, probe]), sim, places=5)
+    self.assertTrue(shared_tool.enroll([projected[0]]).is_similar_to(reference_model))
+    self.remove_shared(t)
 
 
   def notest07a_isv_video(self):
@@ -527,6 +707,22 @@ class ToolTest(unittest.TestCase):
     self.assertTrue(tool.m_jfabase.is_similar_to(enroller_reference))
     os.remove(t)
 
+    # the parallel training of the JFA subspaces needs to work as well
+    parallel_tool = facereclib.tools.JFA(
+        number_of_gaussians = 2,
+        subspace_dimension_of_u = 2,
+        subspace_dimension_of_v = 2,
+        jfa_training_iterations = 1,
+        training_threads = 2,
+        INIT_SEED = seed_value
+    )
+    parallel_tool.load_projector(self.reference_dir('jfa_projector.hdf5'))
+    parallel_tool.train_enroller(self.train_gmm_stats(self.reference_dir('jfa_feature.hdf5'), count=5, minimum=-5., maximum=5.), t)
+    os.remove(t)
+    self.assertEqual(parallel_tool.m_jfabase.u.shape, tool.m_jfabase.u.shape)
+    self.assertEqual(parallel_tool.m_jfabase.v.shape, tool.m_jfabase.v.shape)
+    self.assertEqual(parallel_tool.m_jfabase.d.shape, tool.m_jfabase.d.shape)
+
     # enroll model with the projected feature
     model = tool.enroll([projected])
     if regenerate_refs:
@@ -542,6 +738,25 @@ class ToolTest(unittest.TestCase):
     # score with projected feature and compare to the weird reference score ...
     sim = tool.score(model, probe)
     self.assertAlmostEqual(sim, 0.25456327196005185)
+    # the block scoring needs to compute the same scores
+    scores = tool.score_block([reference_model, reference_model], [probe])
+    self.assertEqual(scores.shape, (2,1))
+    self.assertTrue(numpy.allclose(scores, sim))
+
+    # the shared UBM and JFA base need to give the same scores
+    projector, enroller = self.shared_copy('jfa_projector.hdf5'), self.shared_copy('jfa_enroller.hdf5')
+    shared_tool = facereclib.tools.JFA(number_of_gaussians = 2, subspace_dimension_of_u = 2, subspace_dimension_of_v = 2)
+    shared_tool.load_shared_projector(projector)
+    shared_tool.load_shared_enroller(enroller)
+    self.assertTrue(shared_tool.m_jfabase is None)
+    self.assertTrue(numpy.allclose(shared_tool.project(feature).sum_px, projected.sum_px))
+    shared_model = shared_tool.read_model(self.reference_dir('jfa_model.hdf5'))
+    self.assertAlmostEqual(shared_tool.score(shared_model, probe), sim)
+    self.assertTrue(numpy.allclose(shared_tool.score_block([shared_model, shared_model], [probe, probe]), sim))
+    self.assertTrue(shared_tool.enroll([projected]).is_similar_to(reference_model))
+    self.remove_shared(projector)
+    self.remove_shared(enroller)
+
     # score with a concatenation of the probe
     # self.assertAlmostEqual(tool.score_for_multiple_probes(model, [probe, probe]), sim)
 
@@ -596,8 +811,34 @@ class ToolTest(unittest.TestCase):
     # score
     sim = tool.score(model, feature)
     self.assertAlmostEqual(sim, 0.)
+    # the vectorized log-likelihood ratio needs to be identical to the one of bob
+    projected = facereclib.utils.project_batch(tool.m_pca_machine, feature.flatten()[None, :])
+    self.assertAlmostEqual(sim, model.forward(projected[0]))
+    # the block scoring needs to compute the same scores
+    scores = tool.score_block([model, model], [feature, feature, feature])
+    self.assertEqual(scores.shape, (2,3))
+    self.assertTrue(numpy.allclose(scores, sim))
     # score with a concatenation of the probe
     self.assertAlmostEqual(tool.score_for_multiple_probes(model, [feature, feature]), 0.)
+    scores = tool.score_block_for_multiple_probes([model, model], [[feature, feature], [feature]])
+    self.assertEqual(scores.shape, (2,2))
+    self.assertTrue(numpy.allclose(scores, [tool.score_for_multiple_probes(model, [feature, feature]), tool.score_for_multiple_probes(model, [feature])]))
+
+    # the shared PCA and PLDA terms need to give the same scores for the enrolled model
+    enroller = self.shared_copy('pca+plda_enroller.hdf5')
+    fd, t = tempfile.mkstemp('pca+plda_model.hdf5', prefix='frltest_')
+    os.close(fd)
+    model.save(bob.io.HDF5File(t, 'w'))
+    shared_tool = facereclib.tools.PLDA(subspace_dimension_of_f = 2, subspace_dimension_of_g = 2, subspace_dimension_pca = 10)
+    shared_tool.load_shared_enroller(enroller)
+    self.assertTrue(shared_tool.m_plda_base is None)
+    shared_model = shared_tool.read_model(t)
+    self.assertTrue(isinstance(shared_model, facereclib.utils.plda.PLDAModel))
+    self.assertTrue(numpy.allclose(shared_tool.score_block([shared_model], [feature, feature]), scores[:1,:2]))
+    # the enrollment loads the PLDA base on demand
+    self.assertTrue(shared_tool.enroll([feature]).n_samples == model.n_samples)
+    os.remove(t)
+    self.remove_shared(enroller)
 
 
   def test10_ivector(self):
@@ -621,7 +862,7 @@ class ToolTest(unittest.TestCase):
     self.assertTrue(tool.requires_projector_training)
     self.assertTrue(tool.use_projected_features_for_enrollment)
     self.assertFalse(tool.split_training_features_by_client)
-    self.assertFalse(tool.requires_enroller_training)
+    self.assertTrue(tool.requires_enroller_training)
 
     # train the projector
     t = tempfile.mkstemp('ubm.hdf5', prefix='frltest_')[1]
@@ -647,34 +888,105 @@ class ToolTest(unittest.TestCase):
     self.assertTrue(tool.m_tv.is_similar_to(enroller_reference))
     os.remove(t)
 
+    # the parallel training of the total variability matrix needs to work as well
+    parallel_tool = facereclib.tools.IVector(
+        number_of_gaussians = 2,
+        subspace_dimension_of_t = 2,
+        update_sigma = True,
+        tv_training_iterations = 1,
+        variance_threshold = 1e-5,
+        training_threads = 2,
+        INIT_SEED = seed_value
+    )
+    parallel_tool.m_ubm = tool.m_ubm
+    parallel_tool._load_train_ivector(facereclib.utils.tests.random_training_set(feature.shape, count=5, minimum=-5., maximum=5.))
+    self.assertEqual(parallel_tool.m_tv.t.shape, tool.m_tv.t.shape)
+    self.assertTrue((parallel_tool.m_tv.sigma >= 1e-5).all())
+
     # project the feature
     projected = tool.project(feature)
     if regenerate_refs:
       tool.save_feature(projected, self.reference_dir('ivector_feature.hdf5'))
 
     # compare the projected feature with the reference
-    projected_reference = tool.read_feature(self.reference_dir('ivector_feature.hdf5'))
+    projected_reference = tool._read_gmm_stats(self.reference_dir('ivector_feature.hdf5'))
     self.assertTrue(projected[0].is_similar_to(projected_reference))
-
-    # enroll model with the projected feature
-    # This is not yet supported
-    # model = tool.enroll([projected[0]])
-    # if regenerate_refs:
-    #  model.save(bob.io.HDF5File(self.reference_dir('ivector_model.hdf5'), 'w'))
-    #reference_model = tool.read_model(self.reference_dir('ivector_model.hdf5'))
-    # compare the IVector model with the reference
-    #self.assertTrue(model.is_similar_to(reference_model))
+    # the cached i-vector extraction needs to be identical to the one of bob
+    self.assertTrue(numpy.allclose(projected[1], tool.m_tv.forward(projected[0])))
+    batch = tool.project_batch([feature, feature])
+    self.assertEqual(len(batch), 2)
+    self.assertTrue(batch[1][0].is_similar_to(projected[0]))
+    self.assertTrue(numpy.allclose(batch[1][1], projected[1]))
+
+    # the shared UBM and total variability terms need to give the same projection
+    projector = self.shared_copy('ivector_projector.hdf5')
+    shared_tool = facereclib.tools.IVector(number_of_gaussians = 2, subspace_dimension_of_t = 2, variance_threshold = 1e-5)
+    shared_tool.load_shared_projector(projector)
+    self.assertTrue(shared_tool.m_tv is None)
+    shared_projected = shared_tool.project(feature)
+    self.assertTrue(numpy.allclose(shared_projected[0].sum_px, projected[0].sum_px))
+    self.assertTrue(numpy.allclose(shared_projected[1], projected[1]))
+    self.remove_shared(projector)
+
+    # the i-vector is read as the feature for enrollment
+    self.assertTrue(numpy.allclose(tool.read_feature(self.reference_dir('ivector_feature.hdf5')), projected[1]))
+
+    # train the backend with whitening, LDA and WCCN on random i-vectors of several clients
+    backend_tool = facereclib.tools.IVector(
+        number_of_gaussians = 2,
+        subspace_dimension_of_t = 2,
+        use_whitening = True,
+        use_lda = True,
+        use_wccn = True,
+        INIT_SEED = seed_value
+    )
+    t = tempfile.mkstemp('enroll.hdf5', prefix='frltest_')[1]
+    training_set = facereclib.utils.tests.random_training_set_by_id((2,), count=5, minimum=-5., maximum=5.)
+    backend_tool.train_enroller(training_set, t)
+    backend_tool.load_enroller(t)
+    self.assertEqual([name for name, machine in backend_tool.m_backend], ['Whitening', 'LDA', 'WCCN'])
+    # the shared backend needs to give the same projections
+    shared_tool.load_shared_enroller(t)
+    self.assertEqual([name for name, machine in shared_tool.m_backend], ['Whitening', 'LDA', 'WCCN'])
+    self.assertTrue(numpy.allclose(shared_tool._backend_project(projected[1][None,:]), backend_tool._backend_project(projected[1][None,:])))
+    self.remove_shared(t)
+
+    # the whitened training i-vectors need to have identity covariance
+    clients = [numpy.vstack(client) for client in training_set]
+    ivectors = numpy.vstack(clients)
+    whitened = facereclib.utils.project_batch(backend_tool._train_whitening(ivectors), ivectors)
+    self.assertTrue(numpy.allclose(numpy.mean(whitened, axis = 0), 0.))
+    self.assertTrue(numpy.allclose(numpy.cov(whitened.T), numpy.eye(2)))
+    # the WCCN needs to give identity within-class covariance (up to the ridge term)
+    wccn = backend_tool._train_wccn(clients)
+    within_covariance = numpy.mean([numpy.cov(facereclib.utils.project_batch(wccn, client).T, bias = 1) for client in clients], axis = 0)
+    self.assertTrue(numpy.allclose(within_covariance, numpy.eye(2), atol = 1e-4))
+    # clients with a single i-vector are ignored, and a singular within-class covariance is regularized
+    self.assertTrue(numpy.allclose(backend_tool._train_wccn(clients + [clients[0][:1]]).weights, wccn.weights))
+    self.assertTrue(numpy.isfinite(backend_tool._train_wccn([numpy.vstack([client[0], client[0]]) for client in clients]).weights).all())
+    self.assertRaises(ValueError, backend_tool._train_wccn, [client[:1] for client in clients])
+
+    # enroll model with the projected feature; the model is the length-normalized average of the projected i-vectors
+    model = backend_tool.enroll([projected[1], projected[1]])
+    self.assertAlmostEqual(numpy.linalg.norm(model), 1.)
 
     # check that the read_probe function reads the correct values
     probe = tool.read_probe(self.reference_dir('ivector_feature.hdf5'))
     self.assertTrue(probe[0].is_similar_to(projected[0]))
     self.assertEqual(probe[1].any(), projected[1].any())
 
-    # score with projected feature and compare to the weird reference score ...
-    # This in not implemented yet
-
+    # score with projected feature; the cosine similarity to the model of the same i-vector is 1
+    sim = backend_tool.score(model, probe)
+    self.assertAlmostEqual(sim, 1.)
     # score with a concatenation of the probe
-    # This is not implemented yet
+    self.assertAlmostEqual(backend_tool.score_for_multiple_probes(model, [probe, probe]), sim)
+    # the block scoring needs to compute the same scores
+    scores = backend_tool.score_block([model, model], [probe, probe, probe])
+    self.assertEqual(scores.shape, (2,3))
+    self.assertTrue(numpy.allclose(scores, sim))
+    scores = backend_tool.score_block_for_multiple_probes([model, model], [[probe, probe], [probe]])
+    self.assertEqual(scores.shape, (2,2))
+    self.assertTrue(numpy.allclose(scores, sim))
 
 
 
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+import unittest
+import os
+import numpy
+import tempfile
+import shutil
+import facereclib
+import bob
+
+class TrainerTest(unittest.TestCase):
+
+  def training_chunks(self, count = 4, size = 100, dimension = 5):
+    # generate a random training set with three clusters, split into chunks
+    numpy.random.seed(42)
+    data = numpy.vstack([numpy.random.randn(count * size / 3 + 1, dimension) + offset for offset in (0., 5., 10.)])
+    numpy.random.shuffle(data)
+    return [data[i * size : (i+1) * size] for i in range(count)]
+
+
+  def test01_kmeans(self):
+    chunks = self.training_chunks()
+    trainer = facereclib.trainers.KMeans(3, number_of_iterations = 10)
+    means = trainer.train(chunks)
+    # the parallel execution needs to give the same results
+    self.assertTrue(numpy.allclose(means, trainer.train(chunks, parallel = 2)))
+    # the means need to be close to the cluster centers
+    self.assertTrue(numpy.allclose(sorted(numpy.mean(means, axis=1)), [0., 5., 10.], atol = 0.5))
+
+    # the k-means++ initialization on a subset of the data needs to find the clusters as well
+    plus_plus = facereclib.trainers.KMeans(3, number_of_iterations = 10, initialization = 'k-means++', initialization_samples = 50)
+    self.assertTrue(numpy.allclose(sorted(numpy.mean(plus_plus.train(chunks), axis=1)), [0., 5., 10.], atol = 0.5))
+    from facereclib.trainers.KMeans import reservoir_sample
+    sample = reservoir_sample(chunks, 50, numpy.random.RandomState(42))
+    self.assertEqual(sample.shape, (50, 5))
+
+    # the grid execution writes the statistics and the machine to file
+    temp_dir = tempfile.mkdtemp(prefix='frltest_')
+    machine_file = os.path.join(temp_dir, 'kmeans_0.hdf5')
+    trainer.save_machine(means, machine_file)
+    stats_files = [os.path.join(temp_dir, 'stats_%d.hdf5' % i) for i in range(len(chunks))]
+    for chunk, stats_file in zip(chunks, stats_files):
+      trainer.map_to_file(machine_file, chunk, stats_file)
+    trainer.reduce_files(machine_file, stats_files, os.path.join(temp_dir, 'kmeans_1.hdf5'))
+    expected = trainer.update(means, trainer.reduce([trainer.map(means, chunk) for chunk in chunks]))[0]
+    self.assertTrue(numpy.allclose(trainer.load_machine(os.path.join(temp_dir, 'kmeans_1.hdf5')), expected))
+    shutil.rmtree(temp_dir)
+
+
+  def test02_gmm(self):
+    chunks = self.training_chunks()
+    trainer = facereclib.trainers.GMM(3, number_of_iterations = 5)
+    machine = trainer.initialize_from_means(facereclib.trainers.KMeans(3).train(chunks), chunks)
+
+    # the E-step needs to compute the same statistics as the bob trainer
+    data = numpy.vstack(chunks)
+    statistics = trainer.reduce([trainer.map(machine, chunk) for chunk in chunks])
+    gmm = trainer.bob_machine(machine)
+    bob_trainer = bob.trainer.ML_GMMTrainer(True, True, True)
+    bob_trainer.initialize(gmm, data)
+    bob_trainer.e_step(gmm, data)
+    self.assertTrue(numpy.allclose(statistics['n'], bob_trainer.gmm_statistics.n))
+    self.assertTrue(numpy.allclose(statistics['sum_px'], bob_trainer.gmm_statistics.sum_px))
+    self.assertTrue(numpy.allclose(statistics['sum_pxx'], bob_trainer.gmm_statistics.sum_pxx))
+    self.assertAlmostEqual(float(statistics['log_likelihood']), bob_trainer.gmm_statistics.log_likelihood, 5)
+
+    # the parallel execution needs to give the same results
+    local = trainer.train(chunks, machine = machine)
+    parallel = trainer.train(chunks, parallel = 2, machine = machine)
+    for key in local:
+      self.assertTrue(numpy.allclose(local[key], parallel[key]))
+
+
+  def test03_pca_lda(self):
+    chunks = self.training_chunks()
+    (machine, eigen_values) = facereclib.trainers.PCA().train(chunks, parallel = 2)
+    bob_machine, bob_eigen_values = bob.trainer.PCATrainer().train(numpy.vstack(chunks))
+    self.assertTrue(numpy.allclose(eigen_values, bob_eigen_values))
+
+    # for LDA, each chunk contains the data of one client
+    (machine, eigen_values) = facereclib.trainers.LDA().train(chunks, parallel = 2)
+    self.assertEqual(machine.shape, (5, 3))
+    self.assertEqual(eigen_values.shape, (3,))
+
+
+  def test04_mini_batch(self):
+    chunks = self.training_chunks(count = 20, size = 30)
+    # the stepwise EM needs to find the cluster centers as well
+    means = facereclib.trainers.KMeans(3).train_mini_batch(chunks, 2, check_interval = 10)
+    self.assertTrue(numpy.allclose(sorted(numpy.mean(means, axis=1)), [0., 5., 10.], atol = 0.5))
+    trainer = facereclib.trainers.GMM(3)
+    machine = trainer.train_mini_batch(chunks, 2, check_interval = 10, parallel = 2, machine = trainer.initialize_from_means(means, chunks))
+    self.assertTrue(numpy.allclose(sorted(numpy.mean(machine['means'], axis=1)), [0., 5., 10.], atol = 0.5))
+    self.assertTrue(numpy.allclose(machine['weights'], 1./3., atol = 0.1))
+
+
+  def test05_checkpoint(self):
+    chunks = self.training_chunks()
+    machine = facereclib.trainers.GMM(3).initialize_from_means(facereclib.trainers.KMeans(3).train(chunks), chunks)
+    expected = facereclib.trainers.GMM(3, number_of_iterations = 6, convergence_threshold = None).train(chunks, machine = machine)
+
+    # a training that is interrupted after 3 iterations leaves its checkpoint behind
+    temp_dir = tempfile.mkdtemp(prefix='frltest_')
+    checkpoint_file = os.path.join(temp_dir, 'gmm_checkpoint.hdf5')
+    facereclib.trainers.GMM(3, number_of_iterations = 3, convergence_threshold = None).train(chunks, machine = machine, checkpoint_file = checkpoint_file, checkpoint_interval = 2)
+    trainer = facereclib.trainers.GMM(3, number_of_iterations = 6, convergence_threshold = None)
+    self.assertEqual(trainer.load_checkpoint(checkpoint_file, trainer.__fingerprint__(chunks))[1], 3)
+    # a training with different parameters or different data does not resume from it
+    other = facereclib.trainers.GMM(3, number_of_iterations = 6, convergence_threshold = None, update_variances = False)
+    self.assertTrue(other.load_checkpoint(checkpoint_file, other.__fingerprint__(chunks)) is None)
+    self.assertTrue(trainer.load_checkpoint(checkpoint_file, trainer.__fingerprint__(chunks[1:])) is None)
+
+    # the restarted training resumes after the third iteration and gives the same result as the uninterrupted training
+    resumed = trainer.train(chunks, machine = machine, checkpoint_file = checkpoint_file, checkpoint_interval = 2)
+    for key in expected:
+      self.assertTrue(numpy.allclose(expected[key], resumed[key]))
+    self.assertEqual(trainer.load_checkpoint(checkpoint_file)[1], 6)
+    shutil.rmtree(temp_dir)
+
+
+  def gmm_statistics(self, clients = 4, files = 3):
+    # computes the GMM statistics of the training files of several clients, using a UBM trained on the same data
+    chunks = self.training_chunks(count = clients * files, size = 20)
+    trainer = facereclib.trainers.GMM(3, number_of_iterations = 5)
+    ubm = trainer.bob_machine(trainer.train(chunks, machine = trainer.initialize_from_means(facereclib.trainers.KMeans(3).train(chunks), chunks)))
+    statistics = []
+    for chunk in chunks:
+      gmm_stats = bob.machine.GMMStats(ubm.dim_c, ubm.dim_d)
+      ubm.acc_statistics(chunk, gmm_stats)
+      statistics.append(gmm_stats)
+    return ubm, [statistics[i * files : (i+1) * files] for i in range(clients)]
+
+
+  def test06_isv(self):
+    ubm, clients = self.gmm_statistics()
+    # start from the initial subspace of the bob.trainer.ISVTrainer
+    isv_base = bob.machine.ISVBase(ubm, 2)
+    bob_trainer = bob.trainer.ISVTrainer(1, 4.)
+    bob_trainer.initialize(isv_base, clients)
+    machine = {'u' : isv_base.u.copy(), 'd' : isv_base.d.copy()}
+    self.assertTrue(numpy.allclose(machine['d'], numpy.sqrt(ubm.variance_supervector / 4.)))
+
+    # with a single estimation of the latent factors, one EM iteration needs to give the same U as the bob trainer
+    bob_trainer.e_step(isv_base, clients)
+    bob_trainer.m_step(isv_base, clients)
+    trainer = facereclib.trainers.ISV(ubm, 2, number_of_iterations = 1, relevance_factor = 4., latent_iterations = 1)
+    updated = trainer.train([clients[:2], clients[2:]], parallel = 2, machine = machine)
+    self.assertTrue(numpy.allclose(updated['u'], isv_base.u))
+    self.assertTrue(numpy.allclose(updated['d'], isv_base.d))
+
+
+  def test07_jfa(self):
+    ubm, clients = self.gmm_statistics()
+    # create statistics of clients whose means are shifted along one direction of the supervector space
+    random = numpy.random.RandomState(42)
+    direction = random.randn(ubm.dim_c * ubm.dim_d)
+    direction /= numpy.linalg.norm(direction)
+    shifted_clients = []
+    for client in range(10):
+      offset = random.randn() * 3. * direction
+      shifted_clients.append([])
+      for session in range(3):
+        gmm_stats = bob.machine.GMMStats(ubm.dim_c, ubm.dim_d)
+        gmm_stats.n = numpy.array([20.] * ubm.dim_c)
+        gmm_stats.t = int(numpy.sum(gmm_stats.n))
+        means = ubm.mean_supervector + offset + random.randn(direction.shape[0]) * 0.1
+        gmm_stats.sum_px = (means.reshape((ubm.dim_c, ubm.dim_d)) * gmm_stats.n[:, None])
+        shifted_clients[-1].append(gmm_stats)
+
+    # the V subspace needs to find the direction of the client offsets
+    trainer = facereclib.trainers.JFA(ubm, 1, 1, stage = 'v', number_of_iterations = 5)
+    machine = trainer.train([shifted_clients[:5], shifted_clients[5:]], parallel = 2)
+    v = machine['v'][:, 0]
+    self.assertTrue(abs(numpy.dot(v, direction)) / numpy.linalg.norm(v) > 0.95)
+
+
+  def test08_ivector(self):
+    ubm, clients = self.gmm_statistics()
+    statistics = [gmm_stats for client in clients for gmm_stats in client]
+    # start from the initial subspace of the bob.trainer.IVectorTrainer
+    ivector_machine = bob.machine.IVectorMachine(ubm, 2)
+    ivector_machine.variance_threshold = 1e-5
+    bob_trainer = bob.trainer.IVectorTrainer(update_sigma = True, max_iterations = 1)
+    bob_trainer.initialize(ivector_machine, statistics)
+    machine = {'t' : ivector_machine.t.copy(), 'sigma' : ivector_machine.sigma.copy()}
+
+    # one EM iteration needs to give the same T and variances as the bob trainer
+    bob_trainer.e_step(ivector_machine, statistics)
+    bob_trainer.m_step(ivector_machine, statistics)
+    trainer = facereclib.trainers.IVector(ubm, 2, number_of_iterations = 1, update_sigma = True)
+    updated = trainer.train([statistics[:6], statistics[6:]], parallel = 2, machine = machine)
+    self.assertTrue(numpy.allclose(updated['t'], ivector_machine.t))
+    self.assertTrue(numpy.allclose(updated['sigma'], ivector_machine.sigma))
+
+
+  def test09_projection(self):
+    chunks = self.training_chunks(count = 3, size = 10)
+    # the results of each chunk are returned unreduced, in the order of the chunks, also when they are computed in worker processes
+    trainer = facereclib.trainers.Projection(lambda feature: numpy.mean(feature, axis = 0))
+    features = [[chunk[:5], chunk[5:]] for chunk in chunks]
+    results = trainer.map_chunks(None, features, parallel = 2)
+    self.assertEqual(len(results), 3)
+    for chunk, result in zip(chunks, results):
+      self.assertEqual(len(result), 2)
+      self.assertTrue(numpy.allclose(result[0], numpy.mean(chunk[:5], axis = 0)))
+      self.assertTrue(numpy.allclose(result[1], numpy.mean(chunk[5:], axis = 0)))
+    self.assertEqual(len(trainer.map_chunks(None, features)), 3)
+
+
+  def test10_streaming_reduce(self):
+    chunks = self.training_chunks(count = 10, size = 20)
+
+    class CountingPCA (facereclib.trainers.PCA):
+      """Counts the scatter matrices that have been computed by 'map', but not yet merged by 'reduce'."""
+      def __init__(self):
+        facereclib.trainers.PCA.__init__(self)
+        self.held = 0
+        self.max_held = 0
+      def map(self, machine, data):
+        self.held += 1
+        self.max_held = max(self.max_held, self.held)
+        return facereclib.trainers.PCA.map(self, machine, data)
+      def reduce(self, statistics):
+        def merged():
+          for other in statistics:
+            yield other
+            self.held -= 1
+        return facereclib.trainers.PCA.reduce(self, merged())
+
+    # the scatter matrix of each chunk is merged before the next one is computed
+    trainer = CountingPCA()
+    (machine, eigen_values) = trainer.train(chunks)
+    self.assertEqual(trainer.max_held, 1)
+    self.assertEqual(trainer.held, 0)
+    expected = numpy.sort(numpy.linalg.eigvalsh(numpy.cov(numpy.vstack(chunks).T)))[::-1]
+    self.assertTrue(numpy.allclose(eigen_values, expected))
+    # the statistics computed in parallel are merged as they arrive, with the same result
+    self.assertTrue(numpy.allclose(facereclib.trainers.PCA().train(chunks, parallel = 2)[1], expected))
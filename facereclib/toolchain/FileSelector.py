@@ -222,6 +222,12 @@ class FileSelector:
     utils.ensure_dir(no_norm_dir)
     return os.path.join(no_norm_dir, str(model_id) + ".txt")
 
+  def no_norm_tile_file(self, model_id, group, probe_indices):
+    """Returns the file that stores the scores of the given model id for the probes in the given index range, before they are merged into the no_norm_file."""
+    tile_dir = os.path.join(self.score_directories[0], group, "tiles")
+    utils.ensure_dir(tile_dir)
+    return os.path.join(tile_dir, "%s-%d-%d.txt" % (str(model_id), probe_indices[0], probe_indices[1]))
+
   def no_norm_result_file(self, group):
     """Returns the resulting score text file for the given group."""
     no_norm_dir = self.score_directories[0]
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+import time
+import traceback
+import collections
+import multiprocessing
+
+from .. import utils
+
+class JobGraph:
+  """This class stores the jobs of a tool chain together with the dependencies between them.
+  Other than the stage-by-stage execution, a job can be started as soon as all jobs that it depends on are finished,
+  so that jobs of different stages of the tool chain can be run at the same time."""
+
+  def __init__(self):
+    """Creates an empty job graph."""
+    self.m_jobs = {}
+    self.m_order = []
+
+
+  def add_job(self, name, function, dependencies = [], **kwargs):
+    """Adds the job with the given (unique) name to the graph.
+    When executed, the job calls function(**kwargs).
+    All dependencies need to be added to the graph beforehand, which makes sure that the graph stays acyclic.
+    The name of the job is returned, so that it can be used as a dependency for other jobs."""
+    if name in self.m_jobs:
+      raise ValueError("The job '%s' has already been added to the job graph." % name)
+    for dependency in dependencies:
+      if dependency not in self.m_jobs:
+        raise ValueError("The dependency '%s' of job '%s' is not part of the job graph." % (dependency, name))
+    self.m_jobs[name] = (function, kwargs, sorted(set(dependencies)))
+    self.m_order.append(name)
+    return name
+
+
+  def jobs(self):
+    """Returns the names of all jobs in the order in which they were added."""
+    return self.m_order[:]
+
+  def dependencies(self, name):
+    """Returns the names of the jobs that the job with the given name depends on."""
+    return self.m_jobs[name][2][:]
+
+  def __len__(self):
+    return len(self.m_order)
+
+
+  def dry_run(self):
+    """Prints the jobs that would have been executed, including their dependencies."""
+    for name in self.m_order:
+      print "would have executed job", name, "with dependencies", self.m_jobs[name][2]
+
+
+  def __run_job__(self, name):
+    """Executes the job with the given name in the current process."""
+    function, kwargs, dependencies = self.m_jobs[name]
+    utils.debug("- Job graph: executing job '%s'" % name)
+    function(**kwargs)
+
+
+  def __worker__(self, connection):
+    """The main loop of a worker process.
+    The worker receives the names of the jobs to execute through the given connection and reports back whether the job succeeded.
+    Since the worker is kept alive until all jobs are finished, machines loaded by one job (e.g. the projector) stay available for the next job."""
+    while True:
+      name = connection.recv()
+      if name is None:
+        break
+      try:
+        self.__run_job__(name)
+        connection.send((name, True))
+      except Exception:
+        traceback.print_exc()
+        connection.send((name, False))
+    connection.close()
+
+
+  def __start_worker__(self):
+    """Starts a new worker process and returns the process and the connection to it."""
+    connection, worker_connection = multiprocessing.Pipe()
+    process = multiprocessing.Process(target = self.__worker__, args = (worker_connection,))
+    process.daemon = True
+    process.start()
+    worker_connection.close()
+    return [process, connection, None]
+
+
+  def run(self, parallel = 1, sleep_time = 0.1):
+    """Executes all jobs of the graph.
+    If parallel is 1, all jobs are executed sequentially in the current process in the order in which they were added.
+    Otherwise, the given number of worker processes is started, which are kept alive until all jobs are finished.
+    Each job is sent to an idle worker as soon as all of its dependencies have finished successfully.
+    Jobs that depend on a failed job are not executed.
+    A RuntimeError is raised at the end if any job failed."""
+    if parallel <= 1:
+      for name in self.m_order:
+        self.__run_job__(name)
+      return
+
+    # count the unfinished dependencies of each job and store the inverse dependencies
+    missing = {}
+    dependents = collections.defaultdict(list)
+    for name in self.m_order:
+      missing[name] = len(self.m_jobs[name][2])
+      for dependency in self.m_jobs[name][2]:
+        dependents[dependency].append(name)
+
+    ready = collections.deque([name for name in self.m_order if not missing[name]])
+    failed = set()
+    succeeded = 0
+
+    utils.info("- Job graph: executing %d jobs using %d parallel processes" % (len(self.m_order), parallel))
+    # each worker is stored as [process, connection, current job]
+    workers = [self.__start_worker__() for i in range(min(parallel, len(self.m_order)))]
+    try:
+      while ready or any(worker[2] is not None for worker in workers):
+        # send ready jobs to the idle workers
+        for worker in workers:
+          if worker[2] is None and ready:
+            worker[2] = ready.popleft()
+            worker[1].send(worker[2])
+
+        time.sleep(sleep_time)
+
+        # collect the jobs that have finished in the meantime
+        for i, worker in enumerate(workers):
+          if worker[2] is None:
+            continue
+          result = None
+          if worker[1].poll():
+            try:
+              result = worker[1].recv()
+            except EOFError:
+              pass
+          elif worker[0].is_alive():
+            continue
+          worker[2], name = None, worker[2]
+          if result is not None:
+            success = result[1]
+          else:
+            # the worker died while executing the job; replace it by a new one
+            success = False
+            worker[0].join()
+            utils.error("The worker process died with exit code %s while executing job '%s'" % (worker[0].exitcode, name))
+            workers[i] = self.__start_worker__()
+
+          if success:
+            succeeded += 1
+            for dependent in dependents[name]:
+              missing[dependent] -= 1
+              if not missing[dependent]:
+                ready.append(dependent)
+          else:
+            utils.error("The job '%s' failed; jobs depending on it will not be executed" % name)
+            # mark all direct and indirect dependent jobs as failed
+            stack = [name]
+            while stack:
+              job = stack.pop()
+              if job not in failed:
+                failed.add(job)
+                stack.extend(dependents[job])
+
+    finally:
+      # stop the workers
+      for process, connection, name in workers:
+        if process.is_alive():
+          connection.send(None)
+        process.join()
+
+    utils.info("- Job graph: successfully finished %d of %d jobs" % (succeeded, len(self.m_order)))
+    if failed:
+      raise RuntimeError("The jobs %s of the job graph did not finish successfully." % sorted(failed))
@@ -3,6 +3,8 @@
 # Manuel Guenther <Manuel.Guenther@idiap.ch>
 
 import os
+import glob
+import itertools
 import numpy
 import bob
 from .. import utils
@@ -10,9 +12,15 @@ from .. import utils
 class ToolChain:
   """This class includes functionalities for a default tool chain to produce verification scores"""
 
-  def __init__(self, file_selector):
-    """Initializes the tool chain object with the current file selector."""
+  def __init__(self, file_selector, share_machines = False, batch_size = 100):
+    """Initializes the tool chain object with the current file selector.
+    If share_machines is enabled, the projector and the enroller are loaded such that their parameters are shared between processes.
+    The batch_size defines, how many features are read and extracted or projected at once."""
     self.m_file_selector = file_selector
+    self.m_share_machines = share_machines
+    self.m_batch_size = batch_size
+    # the files that are currently loaded into the extractor and the tool
+    self.m_loaded_files = {}
 
 
 
@@ -29,6 +37,39 @@ class ToolChain:
         return True
     return False
 
+  def __remove_checkpoints__(self, machine_file):
+    """Removes the checkpoints that an interrupted training of the given projector or enroller file has left behind, so that a forced training starts from scratch.
+    The tools write their checkpoints next to the trained file, e.g., the GMM checkpoint of 'Projector.hdf5' is 'Projector_gmm_checkpoint.hdf5'."""
+    for filename in glob.glob(os.path.splitext(machine_file)[0] + '_*_checkpoint.hdf5*'):
+      utils.debug("  .. Removing old checkpoint '%s'." % filename)
+      os.remove(filename)
+
+
+  def __load__(self, obj, key, load_function, filename):
+    """Calls the given load function with the given file name, unless this file was already loaded into the given object and it did not change since then.
+    This keeps the extractor and the tool warm when several jobs are executed by the same process.
+    Returns True if the file was (re-)loaded."""
+    stamp = (filename, os.path.getmtime(filename) if os.path.exists(filename) else None)
+    if self.m_loaded_files.get((id(obj), key)) == stamp:
+      return False
+    load_function(filename)
+    self.m_loaded_files[(id(obj), key)] = stamp
+    return True
+
+  def __load_extractor__(self, extractor):
+    """Loads the extractor file into the given extractor, if required."""
+    self.__load__(extractor, 'extractor', extractor.load, str(self.m_file_selector.extractor_file))
+
+  def __load_projector__(self, tool):
+    """Loads the projector file into the given tool, if required."""
+    if self.__load__(tool, 'projector', tool.load_shared_projector if self.m_share_machines else tool.load_projector, str(self.m_file_selector.projector_file)):
+      # the enroller is always loaded after the projector, so it has to be re-loaded as well
+      self.m_loaded_files.pop((id(tool), 'enroller'), None)
+
+  def __load_enroller__(self, tool):
+    """Loads the enroller file into the given tool, if required."""
+    self.__load__(tool, 'enroller', tool.load_shared_enroller if self.m_share_machines else tool.load_enroller, str(self.m_file_selector.enroller_file))
+
 
 
   def preprocess_data(self, preprocessor, indices=None, force=False):
@@ -67,17 +108,20 @@ class ToolChain:
 
 
 
-  def __read_data__(self, files, preprocessor):
-    """Reads the preprocessed data from file using the given reader."""
+  def __read_data__(self, files, preprocessor, stream = False):
+    """Reads the preprocessed data from file using the given reader.
+    If stream is enabled, the data is read only when it is accessed."""
+    if stream:
+      return utils.streaming.LazyList(files, preprocessor.read_data)
     return [preprocessor.read_data(str(f)) for f in files]
 
-  def __read_data_by_client__(self, files, preprocessor):
+  def __read_data_by_client__(self, files, preprocessor, stream = False):
     """Reads the preprocessed data from file using the given reader.
     In this case, the data is grouped by clients."""
     retval = []
     for client_files in files:
       # data for the client
-      retval.append([preprocessor.read_data(str(f)) for f in client_files])
+      retval.append(self.__read_data__(client_files, preprocessor, stream))
     return retval
 
   def train_extractor(self, extractor, preprocessor, force = False):
@@ -91,11 +135,11 @@ class ToolChain:
         # read training files
         if extractor.split_training_data_by_client:
           train_files = self.m_file_selector.training_list('preprocessed', 'train_extractor', arrange_by_client = True)
-          train_data = self.__read_data_by_client__(train_files, preprocessor)
+          train_data = self.__read_data_by_client__(train_files, preprocessor, extractor.stream_training_data)
           utils.info("- Extraction: training extractor '%s' using %d identities: " %(extractor_file, len(train_files)))
         else:
           train_files = self.m_file_selector.training_list('preprocessed', 'train_extractor')
-          train_data = self.__read_data__(train_files, preprocessor)
+          train_data = self.__read_data__(train_files, preprocessor, extractor.stream_training_data)
           utils.info("- Extraction: training extractor '%s' using %d training files: " %(extractor_file, len(train_files)))
         # train model
         extractor.train(train_data, extractor_file)
@@ -104,7 +148,7 @@ class ToolChain:
 
   def extract_features(self, extractor, preprocessor, indices = None, force=False):
     """Extracts the features from the preprocessed data using the given extractor."""
-    extractor.load(str(self.m_file_selector.extractor_file))
+    self.__load_extractor__(extractor)
     data_files = self.m_file_selector.preprocessed_data_list()
     feature_files = self.m_file_selector.feature_list()
 
@@ -117,32 +161,37 @@ class ToolChain:
 
     utils.ensure_dir(self.m_file_selector.features_directory)
     utils.info("- Extraction: extracting %d features from directory '%s' to directory '%s'" % (len(index_range), self.m_file_selector.preprocessed_directory, self.m_file_selector.features_directory))
-    for i in index_range:
-      data_file = data_files[i]
-      feature_file = feature_files[i]
-
-      if not self.__check_file__(feature_file, force):
-        # load data
-        data = preprocessor.read_data(str(data_file))
-        # extract feature
-        feature = extractor(data)
-        # Save feature
+    # only the features that do not exist yet need to be extracted
+    index_range = [i for i in index_range if not self.__check_file__(feature_files[i], force)]
+    for batch in self.__batches__(index_range):
+      # load a chunk of data
+      data_list = [preprocessor.read_data(str(data_files[i])) for i in batch]
+      # extract the features of the chunk and save them
+      for i, feature in itertools.izip(batch, extractor.extract_batch(data_list)):
+        feature_file = feature_files[i]
         utils.ensure_dir(os.path.dirname(feature_file))
         extractor.save_feature(feature, str(feature_file))
 
 
 
-  def __read_features__(self, files, reader):
-    """Reads all features from file using the given reader."""
+  def __batches__(self, index_range):
+    """Splits the given list of indices into chunks of at most m_batch_size indices."""
+    return [index_range[i : i + self.m_batch_size] for i in range(0, len(index_range), self.m_batch_size)]
+
+  def __read_features__(self, files, reader, stream = False):
+    """Reads all features from file using the given reader.
+    If stream is enabled, the features are read only when they are accessed."""
+    if stream:
+      return utils.streaming.LazyList(files, reader.read_feature)
     return [reader.read_feature(str(file)) for file in files]
 
-  def __read_features_by_client__(self, files, reader):
+  def __read_features_by_client__(self, files, reader, stream = False):
     """Reads all features from file using the given reader.
     In this case, the features are split up by the according client."""
     retval = []
     for client_files in files:
       # features for the client
-      retval.append([reader.read_feature(str(feature)) for feature in client_files])
+      retval.append(self.__read_features__(client_files, reader, stream))
     return retval
 
   def train_projector(self, tool, extractor, force=False):
@@ -154,14 +203,16 @@ class ToolChain:
         utils.info("- Projection: projector '%s' already exists." % projector_file)
       else:
         utils.ensure_dir(os.path.dirname(projector_file))
+        if force:
+          self.__remove_checkpoints__(projector_file)
         # train projector
         if tool.split_training_features_by_client:
           train_files = self.m_file_selector.training_list('features', 'train_projector', arrange_by_client = True)
-          train_features = self.__read_features_by_client__(train_files, extractor)
+          train_features = self.__read_features_by_client__(train_files, extractor, tool.stream_training_features)
           utils.info("- Projection: training projector '%s' using %d identities: " %(projector_file, len(train_files)))
         else:
           train_files = self.m_file_selector.training_list('features', 'train_projector')
-          train_features = self.__read_features__(train_files, extractor)
+          train_features = self.__read_features__(train_files, extractor, tool.stream_training_features)
           utils.info("- Projection: training projector '%s' using %d training files: " %(projector_file, len(train_files)))
 
         # perform training
@@ -173,7 +224,7 @@ class ToolChain:
     """Projects the features for all files of the database."""
     # load the projector file
     if tool.performs_projection:
-      tool.load_projector(str(self.m_file_selector.projector_file))
+      self.__load_projector__(tool)
 
       feature_files = self.m_file_selector.feature_list()
       projected_files = self.m_file_selector.projected_list()
@@ -187,17 +238,14 @@ class ToolChain:
 
       utils.ensure_dir(self.m_file_selector.projected_directory)
       utils.info("- Projection: projecting %d features from directory '%s' to directory '%s'" % (len(index_range), self.m_file_selector.features_directory, self.m_file_selector.projected_directory))
-      # extract the features
-      for i in index_range:
-        feature_file = feature_files[i]
-        projected_file = projected_files[i]
-
-        if not self.__check_file__(projected_file, force):
-          # load feature
-          feature = extractor.read_feature(str(feature_file))
-          # project feature
-          projected = tool.project(feature)
-          # write it
+      # only the features that are not projected yet need to be processed
+      index_range = [i for i in index_range if not self.__check_file__(projected_files[i], force)]
+      for batch in self.__batches__(index_range):
+        # load a chunk of features
+        features = [extractor.read_feature(str(feature_files[i])) for i in batch]
+        # project the features of the chunk and write them
+        for i, projected in itertools.izip(batch, tool.project_batch(features)):
+          projected_file = projected_files[i]
           utils.ensure_dir(os.path.dirname(projected_file))
           tool.save_feature(projected, str(projected_file))
 
@@ -213,11 +261,13 @@ class ToolChain:
         utils.info("- Enrollment: enroller '%s' already exists." % enroller_file)
       else:
         utils.ensure_dir(os.path.dirname(enroller_file))
+        if force:
+          self.__remove_checkpoints__(enroller_file)
         # first, load the projector
-        tool.load_projector(str(self.m_file_selector.projector_file))
+        self.__load_projector__(tool)
         # training models
         train_files = self.m_file_selector.training_list('projected' if tool.use_projected_features_for_enrollment else 'features', 'train_enroller', arrange_by_client = True)
-        train_features = self.__read_features_by_client__(train_files, reader)
+        train_features = self.__read_features_by_client__(train_files, reader, tool.stream_training_features)
 
         # perform training
         utils.info("- Enrollment: training enroller '%s' using %d identities: " %(enroller_file, len(train_features)))
@@ -231,9 +281,9 @@ class ToolChain:
        depending on your setup of the base class Tool."""
 
     # read the projector file, if needed
-    tool.load_projector(self.m_file_selector.projector_file)
+    self.__load_projector__(tool)
     # read the model enrollment file
-    tool.load_enroller(self.m_file_selector.enroller_file)
+    self.__load_enroller__(tool)
 
     # which tool to use to read the features...
     reader = tool if tool.use_projected_features_for_enrollment else extractor
@@ -322,7 +372,10 @@ class ToolChain:
       # take pre-loaded probe
       probe = preloaded_probes[i]
       # compute score
-      scores[0,i] = self.m_tool.score(model, probe)
+      if self.m_file_selector.uses_probe_file_sets():
+        scores[0,i] = self.m_tool.score_for_multiple_probes(model, probe)
+      else:
+        scores[0,i] = self.m_tool.score(model, probe)
 
     # Returns the scores
     return scores
@@ -350,161 +403,337 @@ class ToolChain:
         probe_object = probe_objects[i]
         f.write(str(client_id) + " " + str(probe_object.client_id) + " " + str(probe_object.path) + " " + str(scores[0,i]) + "\n")
 
+
+  def __probe_files__(self, probe_objects):
+    """Returns the list of probe files (or probe file sets) for the given probe objects."""
+    return self.m_file_selector.get_paths(probe_objects, 'projected' if self.m_use_projected_dir else 'features')
+
+  def __preload_probes__(self, probe_files):
+    """Reads all given probe files (or probe file sets) into memory."""
+    if self.m_file_selector.uses_probe_file_sets():
+      return [[self.m_tool.read_probe(str(probe_file)) for probe_file in file_set] for file_set in probe_files]
+    else:
+      return [self.m_tool.read_probe(str(probe_file)) for probe_file in probe_files]
+
+  def __probes__(self, group, preload_probes):
+    """Returns the probe objects of the given group and, if desired, the preloaded probes."""
+    probe_objects = self.m_file_selector.probe_objects(group)
+    if preload_probes:
+      utils.info("- Scoring: preloading probe files of group '%s'" % group)
+      return probe_objects, self.__preload_probes__(self.__probe_files__(probe_objects))
+    return probe_objects, None
+
+  def __z_probes__(self, group, preload_probes):
+    """Returns the Z-probe objects of the given group and, if desired, the preloaded Z-probes."""
+    z_probe_objects = self.m_file_selector.z_probe_objects(group)
+    if preload_probes:
+      utils.info("- Scoring: preloading Z-probe files of group '%s'" % group)
+      return z_probe_objects, self.__preload_probes__(self.__probe_files__(z_probe_objects))
+    return z_probe_objects, None
+
+
+  def __score_a__(self, model, model_id, group, compute_zt_norm, all_probe_objects, all_preloaded_probes, block_scores = None):
+    """Computes and writes the A scores for the given model.
+    If given, the block_scores contain the (precomputed) scores of the model with the probes of this model."""
+    # get the probe split
+    current_probe_objects = self.m_file_selector.probe_objects_for_model(model_id, group)
+    if block_scores is not None:
+      a = block_scores
+    elif all_preloaded_probes is not None:
+      # select the probe files for this model from all probes
+      current_preloaded_probes = self.__probe_split__(current_probe_objects, all_probe_objects, all_preloaded_probes)
+      # compute A matrix
+      a = self.__scores_preloaded__(model, current_preloaded_probes)
+    else:
+      a = self.__scores__(model, self.__probe_files__(current_probe_objects))
+
+    if compute_zt_norm:
+      # write A matrix only when you want to compute zt norm afterwards
+      bob.io.save(a, self.m_file_selector.a_file(model_id, group))
+
+    # Save scores to text file
+    self.__save_scores__(self.m_file_selector.no_norm_file(model_id, group), a, current_probe_objects, self.m_file_selector.client_id(model_id))
+
+  def __score_b__(self, model, model_id, group, z_probe_objects, preloaded_z_probes, block_scores = None):
+    """Computes and writes the B scores for the given model."""
+    if block_scores is not None:
+      b = block_scores
+    elif preloaded_z_probes is not None:
+      b = self.__scores_preloaded__(model, preloaded_z_probes)
+    else:
+      b = self.__scores__(model, self.__probe_files__(z_probe_objects))
+    bob.io.save(b, self.m_file_selector.b_file(model_id, group))
+
+  def __score_c__(self, t_model, t_model_id, group, probe_objects, preloaded_probes, block_scores = None):
+    """Computes and writes the C scores for the given T-model."""
+    if block_scores is not None:
+      c = block_scores
+    elif preloaded_probes is not None:
+      c = self.__scores_preloaded__(t_model, preloaded_probes)
+    else:
+      c = self.__scores__(t_model, self.__probe_files__(probe_objects))
+    bob.io.save(c, self.m_file_selector.c_file(t_model_id, group))
+
+  def __score_d__(self, t_model, t_model_id, group, z_probe_objects, preloaded_z_probes, block_scores = None):
+    """Computes and writes the D scores for the given T-model."""
+    if block_scores is not None:
+      d = block_scores
+    elif preloaded_z_probes is not None:
+      d = self.__scores_preloaded__(t_model, preloaded_z_probes)
+    else:
+      d = self.__scores__(t_model, self.__probe_files__(z_probe_objects))
+    bob.io.save(d, self.m_file_selector.d_file(t_model_id, group))
+
+    # Gets the Z-Norm impostor samples
+    z_probe_ids = [z_probe_object.client_id for z_probe_object in z_probe_objects]
+    t_client_id = [self.m_file_selector.client_id(t_model_id)]
+    d_same_value_tm = bob.machine.ztnorm_same_value(t_client_id, z_probe_ids)
+    bob.io.save(d_same_value_tm, self.m_file_selector.d_same_value_file(t_model_id, group))
+
+
+  def __block_scores__(self, models, model_probe_objects, all_probe_objects, all_preloaded_probes):
+    """Computes the scores of the given models with their lists of probe objects in a single call to 'score_block' (or 'score_block_for_multiple_probes' for probe file sets).
+    Only the union of the probes of all models is scored; these probes are taken from the preloaded probes, if given, or read from file otherwise.
+    Returns a list containing the 1 x N array of scores of each model with its probes."""
+    required_ids = set([probe_object.id for probe_objects in model_probe_objects for probe_object in probe_objects])
+    indices = [i for i in range(len(all_probe_objects)) if all_probe_objects[i].id in required_ids]
+    if not indices:
+      return [numpy.ndarray((1,0), numpy.float64) for model in models]
+    probe_objects = [all_probe_objects[i] for i in indices]
+    if all_preloaded_probes is not None:
+      probes = [all_preloaded_probes[i] for i in indices]
+    else:
+      probes = self.__preload_probes__(self.__probe_files__(probe_objects))
+
+    if self.m_file_selector.uses_probe_file_sets():
+      block = self.m_tool.score_block_for_multiple_probes(models, probes)
+    else:
+      block = self.m_tool.score_block(models, probes)
+    # select the scores of the probes of each model
+    columns = dict((probe_objects[i].id, i) for i in range(len(probe_objects)))
+    return [block[i:i+1, [columns[probe_object.id] for probe_object in model_probe_objects[i]]] for i in range(len(models))]
+
+  def __models__(self, model_ids, model_file_function, group, *probe_sources):
+    """Reads the models with the given ids and yields the model id, the model and a list of block scores (or None) for each of the given probe sources.
+    Each probe source is a tuple of all probe objects, the preloaded probes (or None) and a function returning the probe objects to score for a given model id.
+    If the tool supports block scoring, the models are read in batches, and the scores of each batch of models with the probes of each source are computed at once (see __block_scores__)."""
+    if not self.m_tool.block_scoring:
+      for model_id in model_ids:
+        yield model_id, self.m_tool.read_model(model_file_function(model_id, group)), [None] * len(probe_sources)
+      return
+
+    for batch in self.__batches__(model_ids):
+      models = [self.m_tool.read_model(model_file_function(model_id, group)) for model_id in batch]
+      blocks = [self.__block_scores__(models, [probes_for_model(model_id) for model_id in batch], all_probe_objects, all_preloaded_probes) for (all_probe_objects, all_preloaded_probes, probes_for_model) in probe_sources]
+      for i in range(len(batch)):
+        yield batch[i], models[i], [block[i] for block in blocks]
+
+
+  def __model_probes__(self, group, all_probe_objects, all_preloaded_probes):
+    """Returns the probe source for __models__, where each model is scored with its own probes of the given group."""
+    return (all_probe_objects, all_preloaded_probes, lambda model_id: self.m_file_selector.probe_objects_for_model(model_id, group))
+
+  def __all_probes__(self, probe_objects, preloaded_probes):
+    """Returns the probe source for __models__, where each model is scored with all given probes."""
+    return (probe_objects, preloaded_probes, lambda model_id: probe_objects)
+
+
+  def __needs_scores__(self, score_file, force):
+    """Checks if the given score file needs to be (re-)computed."""
+    if self.__check_file__(score_file, force):
+      utils.warn("score file '%s' already exists." % (score_file))
+      return False
+    return True
+
   def __scores_a__(self, model_ids, group, compute_zt_norm, force, preload_probes):
     """Computes A scores. For non-ZT-norm, these are the only scores that are actually computed."""
     # preload the probe files for a faster access (and fewer network load)
-    if preload_probes:
-      utils.info("- Scoring: preloading probe files of group '%s'" % group)
-      all_probe_objects = self.m_file_selector.probe_objects(group)
-      all_probe_files = self.m_file_selector.get_paths(self.m_file_selector.probe_objects(group), 'projected' if self.m_use_projected_dir else 'features')
-      # read all probe files into memory
-      if self.m_file_selector.uses_probe_file_sets():
-        all_preloaded_probes = [[self.m_tool.read_probe(str(probe_file)) for probe_file in file_set] for file_set in all_probe_files]
-      else:
-        all_preloaded_probes = [self.m_tool.read_probe(str(probe_file)) for probe_file in all_probe_files]
+    all_probe_objects, all_preloaded_probes = self.__probes__(group, preload_probes)
 
     if compute_zt_norm:
       utils.info("- Scoring: computing score matrix A for group '%s'" % group)
     else:
       utils.info("- Scoring: computing scores for group '%s'" % group)
 
-    # Computes the raw scores for each model
-    for model_id in model_ids:
-      # test if the file is already there
-      score_file = self.m_file_selector.a_file(model_id, group) if compute_zt_norm else self.m_file_selector.no_norm_file(model_id, group)
-      if self.__check_file__(score_file, force):
-        utils.warn("score file '%s' already exists." % (score_file))
-      else:
-        # get the probe split
-        current_probe_objects = self.m_file_selector.probe_objects_for_model(model_id, group)
-        model = self.m_tool.read_model(self.m_file_selector.model_file(model_id, group))
-        if preload_probes:
-          # select the probe files for this model from all probes
-          current_preloaded_probes = self.__probe_split__(current_probe_objects, all_probe_objects, all_preloaded_probes)
-          # compute A matrix
-          a = self.__scores_preloaded__(model, current_preloaded_probes)
-        else:
-          current_probe_files = self.m_file_selector.get_paths(current_probe_objects, 'projected' if self.m_use_projected_dir else 'features')
-          a = self.__scores__(model, current_probe_files)
-
-        if compute_zt_norm:
-          # write A matrix only when you want to compute zt norm afterwards
-          bob.io.save(a, self.m_file_selector.a_file(model_id, group))
+    # test which of the files are already there
+    score_file = self.m_file_selector.a_file if compute_zt_norm else self.m_file_selector.no_norm_file
+    model_ids = [model_id for model_id in model_ids if self.__needs_scores__(score_file(model_id, group), force)]
 
-        # Save scores to text file
-        self.__save_scores__(self.m_file_selector.no_norm_file(model_id, group), a, current_probe_objects, self.m_file_selector.client_id(model_id))
+    # Computes the raw scores for each model
+    for model_id, model, (a,) in self.__models__(model_ids, self.m_file_selector.model_file, group, self.__model_probes__(group, all_probe_objects, all_preloaded_probes)):
+      self.__score_a__(model, model_id, group, compute_zt_norm, all_probe_objects, all_preloaded_probes, a)
 
   def __scores_b__(self, model_ids, group, force, preload_probes):
     """Computes B scores."""
-    # probe files:
-    z_probe_objects = self.m_file_selector.z_probe_objects(group)
-    z_probe_files = self.m_file_selector.get_paths(z_probe_objects, 'projected' if self.m_use_projected_dir else 'features')
     # preload the probe files for a faster access (and fewer network load)
-    if preload_probes:
-      utils.info("- Scoring: preloading Z-probe files of group '%s'" % group)
-      # read all probe files into memory
-      if self.m_file_selector.uses_probe_file_sets():
-        preloaded_z_probes = [[self.m_tool.read_probe(str(z_probe_file)) for z_probe_file in file_set] for file_set in z_probe_files]
-      else:
-        preloaded_z_probes = [self.m_tool.read_probe(str(z_probe_file)) for z_probe_file in z_probe_files]
+    z_probe_objects, preloaded_z_probes = self.__z_probes__(group, preload_probes)
 
     utils.info("- Scoring: computing score matrix B for group '%s'" % group)
 
+    # test which of the files are already there
+    model_ids = [model_id for model_id in model_ids if self.__needs_scores__(self.m_file_selector.b_file(model_id, group), force)]
+
     # Loads the models
-    for model_id in model_ids:
-      # test if the file is already there
-      score_file = self.m_file_selector.b_file(model_id, group)
-      if self.__check_file__(score_file, force):
-        utils.warn("score file '%s' already exists." % (score_file))
-      else:
-        model = self.m_tool.read_model(self.m_file_selector.model_file(model_id, group))
-        if preload_probes:
-          b = self.__scores_preloaded__(model, preloaded_z_probes)
-        else:
-          b = self.__scores__(model, z_probe_files)
-        bob.io.save(b, score_file)
+    for model_id, model, (b,) in self.__models__(model_ids, self.m_file_selector.model_file, group, self.__all_probes__(z_probe_objects, preloaded_z_probes)):
+      self.__score_b__(model, model_id, group, z_probe_objects, preloaded_z_probes, b)
+
+  def __scores_ab__(self, model_ids, group, force, preload_probes):
+    """Computes A and B scores in one pass, so that each model is read only once."""
+    # preload the probe files for a faster access (and fewer network load)
+    all_probe_objects, all_preloaded_probes = self.__probes__(group, preload_probes)
+    z_probe_objects, preloaded_z_probes = self.__z_probes__(group, preload_probes)
+
+    utils.info("- Scoring: computing score matrices A and B for group '%s'" % group)
+
+    # test which of the files are already there
+    compute_a = dict((model_id, self.__needs_scores__(self.m_file_selector.a_file(model_id, group), force)) for model_id in model_ids)
+    compute_b = dict((model_id, self.__needs_scores__(self.m_file_selector.b_file(model_id, group), force)) for model_id in model_ids)
+    model_ids = [model_id for model_id in model_ids if compute_a[model_id] or compute_b[model_id]]
+
+    for model_id, model, (a, b) in self.__models__(model_ids, self.m_file_selector.model_file, group, self.__model_probes__(group, all_probe_objects, all_preloaded_probes), self.__all_probes__(z_probe_objects, preloaded_z_probes)):
+      if compute_a[model_id]:
+        self.__score_a__(model, model_id, group, True, all_probe_objects, all_preloaded_probes, a)
+      if compute_b[model_id]:
+        self.__score_b__(model, model_id, group, z_probe_objects, preloaded_z_probes, b)
 
   def __scores_c__(self, t_model_ids, group, force, preload_probes):
     """Computes C scores."""
-    # probe files:
-    probe_objects = self.m_file_selector.probe_objects(group)
-    probe_files = self.m_file_selector.get_paths(probe_objects, 'projected' if self.m_use_projected_dir else 'features')
-
     # preload the probe files for a faster access (and fewer network load)
-    if preload_probes:
-      utils.info("- Scoring: preloading probe files of group '%s'" % group)
-      # read all probe files into memory
-      if self.m_file_selector.uses_probe_file_sets():
-        preloaded_probes = [[self.m_tool.read_probe(str(probe_file)) for probe_file in file_set] for file_set in all_probe_files]
-      else:
-        preloaded_probes = [self.m_tool.read_probe(str(probe_file)) for probe_file in probe_files]
+    probe_objects, preloaded_probes = self.__probes__(group, preload_probes)
 
     utils.info("- Scoring: computing score matrix C for group '%s'" % group)
 
+    # test which of the files are already there
+    t_model_ids = [t_model_id for t_model_id in t_model_ids if self.__needs_scores__(self.m_file_selector.c_file(t_model_id, group), force)]
+
     # Computes the raw scores for the T-Norm model
-    for t_model_id in t_model_ids:
-      # test if the file is already there
-      score_file = self.m_file_selector.c_file(t_model_id, group)
-      if self.__check_file__(score_file, force):
-        utils.warn("score file '%s' already exists." % (score_file))
-      else:
-        t_model = self.m_tool.read_model(self.m_file_selector.t_model_file(t_model_id, group))
-        if preload_probes:
-          c = self.__scores_preloaded__(t_model, preloaded_probes)
-        else:
-          c = self.__scores__(t_model, probe_files)
-        bob.io.save(c, score_file)
+    for t_model_id, t_model, (c,) in self.__models__(t_model_ids, self.m_file_selector.t_model_file, group, self.__all_probes__(probe_objects, preloaded_probes)):
+      self.__score_c__(t_model, t_model_id, group, probe_objects, preloaded_probes, c)
 
   def __scores_d__(self, t_model_ids, group, force, preload_probes):
     """Computes D scores."""
-    # probe files:
-    z_probe_objects = self.m_file_selector.z_probe_objects(group)
-    z_probe_files = self.m_file_selector.get_paths(z_probe_objects, 'projected' if self.m_use_projected_dir else 'features')
-
     # preload the probe files for a faster access (and fewer network load)
-    if preload_probes:
-      utils.info("- Scoring: preloading Z-probe files of group '%s'" % group)
-      # read all probe files into memory
-      if self.m_file_selector.uses_probe_file_sets():
-        preloaded_z_probes = [[self.m_tool.read_probe(str(z_probe_file)) for z_probe_file in file_set] for file_set in z_probe_files]
-      else:
-        preloaded_z_probes = [self.m_tool.read_probe(str(z_probe_file)) for z_probe_file in z_probe_files]
+    z_probe_objects, preloaded_z_probes = self.__z_probes__(group, preload_probes)
 
     utils.info("- Scoring: computing score matrix D for group '%s'" % group)
 
-    # Gets the Z-Norm impostor samples
-    z_probe_ids = []
-    for z_probe_object in z_probe_objects:
-      z_probe_ids.append(z_probe_object.client_id)
+    # test which of the files are already there
+    t_model_ids = [t_model_id for t_model_id in t_model_ids if self.__needs_scores__(self.m_file_selector.d_same_value_file(t_model_id, group), force)]
 
     # Loads the T-Norm models
-    for t_model_id in t_model_ids:
-      # test if the file is already there
-      score_file = self.m_file_selector.d_same_value_file(t_model_id, group)
-      if self.__check_file__(score_file, force):
+    for t_model_id, t_model, (d,) in self.__models__(t_model_ids, self.m_file_selector.t_model_file, group, self.__all_probes__(z_probe_objects, preloaded_z_probes)):
+      self.__score_d__(t_model, t_model_id, group, z_probe_objects, preloaded_z_probes, d)
+
+  def __scores_cd__(self, t_model_ids, group, force, preload_probes):
+    """Computes C and D scores in one pass, so that each T-model is read only once."""
+    # preload the probe files for a faster access (and fewer network load)
+    probe_objects, preloaded_probes = self.__probes__(group, preload_probes)
+    z_probe_objects, preloaded_z_probes = self.__z_probes__(group, preload_probes)
+
+    utils.info("- Scoring: computing score matrices C and D for group '%s'" % group)
+
+    # test which of the files are already there
+    compute_c = dict((t_model_id, self.__needs_scores__(self.m_file_selector.c_file(t_model_id, group), force)) for t_model_id in t_model_ids)
+    compute_d = dict((t_model_id, self.__needs_scores__(self.m_file_selector.d_same_value_file(t_model_id, group), force)) for t_model_id in t_model_ids)
+    t_model_ids = [t_model_id for t_model_id in t_model_ids if compute_c[t_model_id] or compute_d[t_model_id]]
+
+    for t_model_id, t_model, (c, d) in self.__models__(t_model_ids, self.m_file_selector.t_model_file, group, self.__all_probes__(probe_objects, preloaded_probes), self.__all_probes__(z_probe_objects, preloaded_z_probes)):
+      if compute_c[t_model_id]:
+        self.__score_c__(t_model, t_model_id, group, probe_objects, preloaded_probes, c)
+      if compute_d[t_model_id]:
+        self.__score_d__(t_model, t_model_id, group, z_probe_objects, preloaded_z_probes, d)
+
+
+  def __scores_a_tile__(self, model_ids, group, compute_zt_norm, probe_indices, force, preload_probes):
+    """Computes the A scores of the given models for the probes, whose indices in the list of all probes of the group are in the given range.
+    The scores are written to temporary tile files, which are merged by merge_score_tiles()."""
+    all_probe_objects = self.m_file_selector.probe_objects(group)
+    tile_probe_objects = all_probe_objects[probe_indices[0]:probe_indices[1]]
+    tile_probe_ids = set([probe_object.id for probe_object in tile_probe_objects])
+    # preload only the probe files of this tile
+    tile_preloaded_probes = None
+    if preload_probes:
+      utils.info("- Scoring: preloading probe files %s of group '%s'" % (str(probe_indices), group))
+      tile_preloaded_probes = self.__preload_probes__(self.__probe_files__(tile_probe_objects))
+
+    utils.info("- Scoring: computing scores for probes %s of group '%s'" % (str(probe_indices), group))
+    # the probes of each model that are part of this tile
+    current_probe_objects = {}
+    for model_id in model_ids:
+      # test if the merged score file or the tile file is already there
+      score_file = self.m_file_selector.a_file(model_id, group) if compute_zt_norm else self.m_file_selector.no_norm_file(model_id, group)
+      if not force and os.path.exists(score_file):
         utils.warn("score file '%s' already exists." % (score_file))
-      else:
-        t_model = self.m_tool.read_model(self.m_file_selector.t_model_file(t_model_id, group))
+        continue
+      tile_file = self.m_file_selector.no_norm_tile_file(model_id, group, probe_indices)
+      if self.__needs_scores__(tile_file, force):
+        current_probe_objects[model_id] = [probe_object for probe_object in self.m_file_selector.probe_objects_for_model(model_id, group) if probe_object.id in tile_probe_ids]
+        if not current_probe_objects[model_id]:
+          # the model has no probes in this tile, so it is not read
+          self.__save_score_tile__(tile_file, numpy.ndarray((1,0), numpy.float64))
+
+    # compute the scores of the models with probes in this tile
+    tile_model_ids = [model_id for model_id in model_ids if current_probe_objects.get(model_id)]
+    for model_id, model, (scores,) in self.__models__(tile_model_ids, self.m_file_selector.model_file, group, (tile_probe_objects, tile_preloaded_probes, current_probe_objects.get)):
+      if scores is None:
         if preload_probes:
-          d = self.__scores_preloaded__(t_model, preloaded_z_probes)
+          scores = self.__scores_preloaded__(model, self.__probe_split__(current_probe_objects[model_id], tile_probe_objects, tile_preloaded_probes))
         else:
-          d = self.__scores__(t_model, z_probe_files)
-        bob.io.save(d, self.m_file_selector.d_file(t_model_id, group))
+          scores = self.__scores__(model, self.__probe_files__(current_probe_objects[model_id]))
+      self.__save_score_tile__(self.m_file_selector.no_norm_tile_file(model_id, group, probe_indices), scores)
+
+  def __save_score_tile__(self, tile_file, scores):
+    """Writes the given 1 x N scores of a score tile with full precision."""
+    with open(tile_file, 'w') as f:
+      f.writelines(["%r\n" % score for score in scores[0]])
+
+
+  def merge_score_tiles(self, compute_zt_norm, probe_indices, indices = None, groups = ['dev', 'eval']):
+    """Merges the score tiles that were computed for the given list of probe index ranges into the A and no-norm score files."""
+    for group in groups:
+      model_ids = self.m_file_selector.model_ids(group)
+      if indices != None:
+        model_ids = model_ids[indices[0]:indices[1]]
+        utils.info("- Scoring: splitting of index range %s" % str(indices))
+
+      utils.info("- Scoring: merging score tiles of group '%s'" % group)
+      for model_id in model_ids:
+        tile_files = [self.m_file_selector.no_norm_tile_file(model_id, group, tile) for tile in probe_indices]
+        if not all(os.path.exists(tile_file) for tile_file in tile_files):
+          # either the scores are already merged, or some tiles are missing
+          score_file = self.m_file_selector.a_file(model_id, group) if compute_zt_norm else self.m_file_selector.no_norm_file(model_id, group)
+          if os.path.exists(score_file):
+            continue
+          raise IOError("The score tiles for model '%s' cannot be found. Aborting!" % str(model_id))
+
+        scores = []
+        for tile_file in tile_files:
+          with open(tile_file) as f:
+            scores.extend([float(line) for line in f])
+        probe_objects = self.m_file_selector.probe_objects_for_model(model_id, group)
+        assert len(scores) == len(probe_objects)
+        a = numpy.array(scores, numpy.float64).reshape((1, len(scores)))
+
+        if compute_zt_norm:
+          bob.io.save(a, self.m_file_selector.a_file(model_id, group))
+        self.__save_scores__(self.m_file_selector.no_norm_file(model_id, group), a, probe_objects, self.m_file_selector.client_id(model_id))
 
-        t_client_id = [self.m_file_selector.client_id(t_model_id)]
-        d_same_value_tm = bob.machine.ztnorm_same_value(t_client_id, z_probe_ids)
-        bob.io.save(d_same_value_tm, score_file)
+        for tile_file in tile_files:
+          os.remove(tile_file)
 
 
-  def compute_scores(self, tool, compute_zt_norm, force = False, indices = None, groups = ['dev', 'eval'], types = ['A', 'B', 'C', 'D'], preload_probes = False):
-    """Computes the scores for the given groups (by default 'dev' and 'eval')."""
+  def compute_scores(self, tool, compute_zt_norm, force = False, indices = None, groups = ['dev', 'eval'], types = ['A', 'B', 'C', 'D'], preload_probes = False, probe_indices = None):
+    """Computes the scores for the given groups (by default 'dev' and 'eval').
+    When both A and B (or C and D) scores are requested, they are computed in a single pass, so that each model is read only once.
+    If probe_indices are given, the A scores are computed only for the probes in the given index range (i.e., for one tile of the score matrix),
+    and they need to be merged afterwards using merge_score_tiles()."""
     # save tool for internal use
     self.m_tool = tool
     self.m_use_projected_dir = hasattr(tool, 'project')
 
     # load the projector and the enroller, if needed
-    tool.load_projector(self.m_file_selector.projector_file)
-    tool.load_enroller(self.m_file_selector.enroller_file)
+    self.__load_projector__(tool)
+    self.__load_enroller__(tool)
 
     for group in groups:
       # get model ids
@@ -512,42 +741,39 @@ class ToolChain:
       if compute_zt_norm:
         t_model_ids = self.m_file_selector.t_model_ids(group)
 
-      # compute A scores
-      if 'A' in types:
-        if indices != None:
-          model_ids_short = model_ids[indices[0]:indices[1]]
-          utils.info("- Scoring: splitting of index range %s" % str(indices))
-        else:
-          model_ids_short = model_ids
-        self.__scores_a__(model_ids_short, group, compute_zt_norm, force, preload_probes)
+      if indices != None:
+        utils.info("- Scoring: splitting of index range %s" % str(indices))
+        model_ids = model_ids[indices[0]:indices[1]]
+        if compute_zt_norm:
+          t_model_ids = t_model_ids[indices[0]:indices[1]]
 
-      if compute_zt_norm:
+      if probe_indices is not None:
+        # compute one tile of the A scores
+        if 'A' in types:
+          self.__scores_a_tile__(model_ids, group, compute_zt_norm, probe_indices, force, preload_probes)
+        if compute_zt_norm and 'B' in types:
+          self.__scores_b__(model_ids, group, force, preload_probes)
+      elif compute_zt_norm and 'A' in types and 'B' in types:
+        # compute A and B scores together
+        self.__scores_ab__(model_ids, group, force, preload_probes)
+      else:
+        # compute A scores
+        if 'A' in types:
+          self.__scores_a__(model_ids, group, compute_zt_norm, force, preload_probes)
         # compute B scores
-        if 'B' in types:
-          if indices != None:
-            model_ids_short = model_ids[indices[0]:indices[1]]
-            utils.info("- Scoring: splitting of index range %s" % str(indices))
-          else:
-            model_ids_short = model_ids
-          self.__scores_b__(model_ids_short, group, force, preload_probes)
+        if compute_zt_norm and 'B' in types:
+          self.__scores_b__(model_ids, group, force, preload_probes)
 
+      if compute_zt_norm and 'C' in types and 'D' in types:
+        # compute C and D scores together
+        self.__scores_cd__(t_model_ids, group, force, preload_probes)
+      elif compute_zt_norm:
         # compute C scores
         if 'C' in types:
-          if indices != None:
-            t_model_ids_short = t_model_ids[indices[0]:indices[1]]
-            utils.info("- Scoring: splitting of index range %s" % str(indices))
-          else:
-            t_model_ids_short = t_model_ids
-          self.__scores_c__(t_model_ids_short, group, force, preload_probes)
-
+          self.__scores_c__(t_model_ids, group, force, preload_probes)
         # compute D scores
         if 'D' in types:
-          if indices != None:
-            t_model_ids_short = t_model_ids[indices[0]:indices[1]]
-            utils.info("- Scoring: splitting of index range %s" % str(indices))
-          else:
-            t_model_ids_short = t_model_ids
-          self.__scores_d__(t_model_ids_short, group, force, preload_probes)
+          self.__scores_d__(t_model_ids, group, force, preload_probes)
 
 
 
@@ -6,3 +6,4 @@
 
 from FileSelector import FileSelector
 from ToolChain import ToolChain
+from JobGraph import JobGraph
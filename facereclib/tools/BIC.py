@@ -54,43 +54,63 @@ class BIC (Tool):
   def __compare__(self, feature_1, feature_2):
     """Computes a vector of similarities"""
     assert feature_1.shape == feature_2.shape
+    if isinstance(self.m_distance_function, numpy.ufunc):
+      # element-wise distance functions like numpy.subtract compare all nodes with one call
+      return numpy.asarray(self.m_distance_function(feature_1, feature_2), dtype = numpy.float64)
     sim = numpy.ndarray((feature_1.shape[0],), dtype = numpy.float64)
     for i in range(feature_1.shape[0]):
       sim[i] = self.m_distance_function(feature_1[i], feature_2[i])
     return sim
 
+  def __select_pairs__(self, number_of_pairs, name):
+    """Returns the indices of the pairs that are used for training, out of the given number of pairs.
+    If there are more pairs than the maximum training pair count, they are limited by quasi-random selection."""
+    if self.m_maximum_pair_count != None and number_of_pairs > self.m_maximum_pair_count:
+      utils.info("  -> Limiting %s pairs from %d to %d" % (name, number_of_pairs, self.m_maximum_pair_count))
+      return numpy.array(utils.quasi_random_indices(number_of_pairs, self.m_maximum_pair_count), dtype = numpy.int64)
+    return numpy.arange(number_of_pairs, dtype = numpy.int64)
+
   def __intra_extra_pairs__(self, train_features):
-    """Computes intrapersonal and extrapersonal pairs of features from given training files"""
-    # generate intrapersonal pairs
-    intra_pairs = []
-    for client in range(len(train_features)):
-      for c in range(len(train_features[client])-1):
-        for c2 in range (c+1, len(train_features[client])):
-          intra_pairs.append((train_features[client][c], train_features[client][c2]))
-
-    # generate extrapersonal pairs
-    extra_pairs = []
-    for client in range(len(train_features)):
-      for c in range(len(train_features[client])):
-        for impostor in range(len(train_features)):
-          if client != impostor:
-            for i in range(len(train_features[impostor])):
-              extra_pairs.append((train_features[client][c], train_features[impostor][i]))
-
-    # limit the number of pairs by random selection
-    if self.m_maximum_pair_count != None:
-      if len(intra_pairs) > self.m_maximum_pair_count:
-        utils.info("  -> Limiting intrapersonal pairs from %d to %d" %(len(intra_pairs),self.m_maximum_pair_count))
-        intra_pairs = [intra_pairs[i] for i in utils.quasi_random_indices(len(intra_pairs), self.m_maximum_pair_count)]
-      if len(extra_pairs) > self.m_maximum_pair_count:
-        utils.info("  -> Limiting extrapersonal pairs from %d to %d" %(len(extra_pairs), self.m_maximum_pair_count))
-        extra_pairs = [extra_pairs[i] for i in utils.quasi_random_indices(len(extra_pairs), self.m_maximum_pair_count)]
+    """Computes the intrapersonal and extrapersonal pairs of features from given training files.
+    The pairs are returned as two arrays of indices into the list of all training features (client after client).
+    The pairs are numbered in the order of nested loops over the clients and their features:
+    intrapersonal pairs (c, c2) with c < c2 of each client, and extrapersonal pairs of each feature with all features of all other clients.
+    Only the pairs that are selected by '__select_pairs__' are computed from their numbers, so that the list of all pairs is never generated."""
+    counts = numpy.array([len(client) for client in train_features], dtype = numpy.int64)
+    starts = numpy.cumsum(counts) - counts
+
+    # intrapersonal pairs: pair number l of a client with n features is the l'th element of the strict upper triangle of the n x n matrix
+    intra_counts = counts * (counts - 1) // 2
+    intra_ends = numpy.cumsum(intra_counts)
+    indices = self.__select_pairs__(int(intra_ends[-1]), "intrapersonal")
+    client = numpy.searchsorted(intra_ends, indices, 'right')
+    n = counts[client]
+    l = indices - (intra_ends[client] - intra_counts[client])
+    first = n - 2 - numpy.floor(numpy.sqrt(4. * n * (n - 1) - 8. * l - 7.) / 2. - 0.5).astype(numpy.int64)
+    second = l + first + 1 - n * (n - 1) // 2 + (n - first) * (n - first - 1) // 2
+    intra_pairs = (starts[client] + first, starts[client] + second)
+
+    # extrapersonal pairs: each feature is paired with all features except for the ones of its own client
+    feature_clients = numpy.repeat(numpy.arange(len(counts)), counts)
+    extra_counts = numpy.sum(counts) - counts[feature_clients]
+    extra_ends = numpy.cumsum(extra_counts)
+    indices = self.__select_pairs__(int(extra_ends[-1]), "extrapersonal")
+    first = numpy.searchsorted(extra_ends, indices, 'right')
+    r = indices - (extra_ends[first] - extra_counts[first])
+    client = feature_clients[first]
+    extra_pairs = (first, numpy.where(r < starts[client], r, r + counts[client]))
 
     return (intra_pairs, extra_pairs)
 
-  def __trainset_for__(self, pairs):
-    """Computes the array containing the comparison results for the given set of image pairs."""
-    comparison_results = numpy.vstack([self.__compare__(f1, f2) for (f1, f2) in pairs])
+  def __trainset_for__(self, features, pairs, maximum_block_size = 10000):
+    """Computes the array containing the comparison results for the given pairs of indices into the given features.
+    If the distance function is element-wise (a numpy.ufunc like numpy.subtract), the comparison results of a whole block of pairs are computed with one call."""
+    first, second = pairs
+    if not isinstance(self.m_distance_function, numpy.ufunc):
+      return numpy.vstack([self.__compare__(features[i], features[j]) for (i, j) in zip(first, second)])
+    comparison_results = numpy.ndarray((len(first),) + features.shape[1:], dtype = numpy.float64)
+    for b in range(0, len(first), maximum_block_size):
+      comparison_results[b : b + maximum_block_size] = self.m_distance_function(features[first[b : b + maximum_block_size]], features[second[b : b + maximum_block_size]])
     return comparison_results
 
   def train_enroller(self, train_features, enroller_file):
@@ -98,12 +118,15 @@ class BIC (Tool):
 
     # compute intrapersonal and extrapersonal pairs
     intra_pairs, extra_pairs = self.__intra_extra_pairs__(train_features)
+    features = [feature for client in train_features for feature in client]
+    if isinstance(self.m_distance_function, numpy.ufunc):
+      features = numpy.array(features)
 
     # train the BIC Machine with these pairs
-    utils.info("  -> Computing %d intrapersonal results" % len(intra_pairs))
-    intra_vectors = self.__trainset_for__(intra_pairs)
-    utils.info("  -> Computing %d extrapersonal results" % len(extra_pairs))
-    extra_vectors = self.__trainset_for__(extra_pairs)
+    utils.info("  -> Computing %d intrapersonal results" % len(intra_pairs[0]))
+    intra_vectors = self.__trainset_for__(features, intra_pairs)
+    utils.info("  -> Computing %d extrapersonal results" % len(extra_pairs[0]))
+    extra_vectors = self.__trainset_for__(features, extra_pairs)
 
     utils.info("  -> Training BIC machine")
     trainer = bob.trainer.BICTrainer(self.m_M_I, self.m_M_E) if self.m_M_I != None else bob.trainer.BICTrainer()
@@ -8,8 +8,7 @@ import types
 
 from .Tool import Tool
 from .UBMGMM import UBMGMM, UBMGMMVideo
-from .. import utils
-
+from .. import utils, trainers
 
 class ISV (UBMGMM):
   """Tool for computing Unified Background Models and Gaussian Mixture Models of the features"""
@@ -30,6 +29,9 @@ class ISV (UBMGMM):
       projector_toreplace = 'Projector.hdf5', # 'Magic' string in path that will be replaced by the GMM or ISV one
       gmm_filename = 'gmm.hdf5', # filename for the GMM model
       isv_filename = 'isv.hdf5', # filename for the ISV model
+      # Parameters of the training
+      stream_training_features = False, # if enabled, the training features are read from file when needed, and never stacked into one array
+      ubm_file = None, # if given, the UBM is read from this file instead of being trained
       # parameters of the GMM
       **kwargs
   ):
@@ -55,6 +57,8 @@ class ISV (UBMGMM):
         projector_toreplace = projector_toreplace,
         gmm_filename = gmm_filename,
         isv_filename = isv_filename,
+        stream_training_features = stream_training_features,
+        ubm_file = ubm_file,
 
         multiple_model_scoring = None,
         multiple_probe_scoring = None,
@@ -72,44 +76,77 @@ class ISV (UBMGMM):
     self.m_projector_toreplace = projector_toreplace
     self.m_gmm_filename = gmm_filename
     self.m_isv_filename = isv_filename
+    self.m_ubm_file = ubm_file
 
   def _train_isv(self, data):
     """Train the ISV model given a dataset"""
     utils.info("  -> Training ISV enroller")
+    if self.m_training_threads > 1:
+      # the E-steps are computed on chunks of clients in parallel worker processes
+      trainer = trainers.ISV(self.m_ubm, self.m_subspace_dimension_of_u, self.m_isv_training_iterations, self.m_relevance_factor, seed = self.m_init_seed)
+      self.m_isvbase = trainer.bob_machine(trainer.train(self.__split_list__(data), parallel = self.m_training_threads, checkpoint_file = self.__checkpoint_file__('isv'), checkpoint_interval = self.m_checkpoint_interval))
+      return
     self.m_isvbase = bob.machine.ISVBase(self.m_ubm, self.m_subspace_dimension_of_u)
     # train ISV model
     t = bob.trainer.ISVTrainer(self.m_isv_training_iterations, self.m_relevance_factor)
     t.rng = bob.core.random.mt19937(self.m_init_seed)
-    t.train(self.m_isvbase, data)
+    if self.m_checkpoint_interval:
+      # the EM steps of the bob trainer are executed one by one, so that they can be checkpointed
+      t.initialize(self.m_isvbase, data)
+      self.__train_em_with_checkpoints__('isv', t, self.m_isvbase, data, self.m_isv_training_iterations, ('u', 'd'), ('__X__', '__Z__'), (self.m_relevance_factor, self.m_init_seed))
+      t.finalize(self.m_isvbase, data)
+    else:
+      t.train(self.m_isvbase, data)
+
 
+  def __statistics_arrays__(self, feature):
+    """Computes the GMM statistics of the given training feature as numpy arrays, which can be sent back from a worker process."""
+    projected = self._project_gmm(feature)
+    return (numpy.array(projected.n), numpy.array(projected.sum_px), numpy.array(projected.sum_pxx), projected.t, projected.log_likelihood)
 
   def _load_train_isv(self, train_features):
     utils.info("  -> Projecting training data")
-    data = []
-    for client_features in train_features:
-      list = []
-      for feature in client_features:
-        # Initializes GMMStats object
-        self.m_gmm_stats = bob.machine.GMMStats(self.m_ubm.dim_c, self.m_ubm.dim_d)
-        list.append(UBMGMM.project(self, feature))
-      data.append(list)
+    if self.m_training_threads > 1 and len(train_features) > 1:
+      # accumulate the statistics of the clients in parallel in worker processes, which inherit the tool and the training features
+      client_statistics = trainers.Projection(self.__statistics_arrays__).map_chunks(None, train_features, parallel = self.m_training_threads)
+      data = [[self._set_statistics(bob.machine.GMMStats(self.m_ubm.dim_c, self.m_ubm.dim_d), *statistics) for statistics in client] for client in client_statistics]
+    else:
+      data = []
+      for client_features in train_features:
+        list = []
+        for feature in client_features:
+          # Initializes GMMStats object
+          self.m_gmm_stats = bob.machine.GMMStats(self.m_ubm.dim_c, self.m_ubm.dim_d)
+          list.append(UBMGMM.project(self, feature))
+        data.append(list)
 
     self._train_isv(data)
 
   def train_projector(self, train_features, projector_file):
     """Train Projector and Enroller at the same time"""
 
-    data1 = numpy.vstack([feature for client in train_features for feature in client])
+    self.__start_checkpoints__(projector_file)
+    if self.m_ubm_file is not None:
+      utils.info("  -> Reading UBM from file '%s'" % self.m_ubm_file)
+      self._load_projector_gmm_resolved(self.m_ubm_file)
+    elif self.stream_training_features:
+      # the features of each client (or of each mini-batch of a client) are read from file once per K-Means and GMM iteration
+      if self.m_mini_batch_size:
+        UBMGMM._train_projector_using_chunks(self, [batch for client in train_features for batch in self.__split_features__(client)])
+      else:
+        UBMGMM._train_projector_using_chunks(self, train_features)
+    else:
+      UBMGMM._train_projector_using_features(self, [feature for client in train_features for feature in client])
 
-    UBMGMM._train_projector_using_array(self, data1)
-    # to save some memory, we might want to delete these data
-    del data1
+    # the GMM statistics of the training features are computed with the UBM
+    self.m_gmm_stats = bob.machine.GMMStats(self.m_ubm.dim_c, self.m_ubm.dim_d)
 
     # train ISV
     self._load_train_isv(train_features)
 
     # Save the ISV base AND the UBM into the same file
     self._save_projector(projector_file)
+    self.__remove_checkpoints__()
 
 
   def _save_projector_together(self, projector_file):
@@ -176,6 +213,8 @@ class ISV (UBMGMM):
     self.m_isvbase = bob.machine.ISVBase(bob.io.HDF5File(isv_filename))
     # add UBM model from base class
     self.m_isvbase.ubm = self.m_ubm
+    # precompute the U subspace terms for the Ux estimation
+    self.m_ux_estimator = utils.gmm.UxEstimator(self.m_ubm, self.m_isvbase.u)
 
   def _load_projector_isv(self, projector_file):
     isv_filename = self._resolve_isv_filename(projector_file)
@@ -198,6 +237,8 @@ class ISV (UBMGMM):
     self.m_isvbase = bob.machine.ISVBase(hdf5file)
     # add UBM model from base class
     self.m_isvbase.ubm = self.m_ubm
+    # precompute the U subspace terms for the Ux estimation
+    self.m_ux_estimator = utils.gmm.UxEstimator(self.m_ubm, self.m_isvbase.u)
 
   def load_projector(self, projector_file):
     """Reads the UBM model from file"""
@@ -208,10 +249,30 @@ class ISV (UBMGMM):
       self._load_projector_gmm(projector_file)
       self._load_projector_isv(projector_file)
 
+    self.m_isv_d = self.m_isvbase.d
     self.m_machine = bob.machine.ISVMachine(self.m_isvbase)
     self.m_trainer = bob.trainer.ISVTrainer(self.m_isv_training_iterations, self.m_relevance_factor)
     self.m_trainer.rng = bob.core.random.mt19937(self.m_init_seed)
 
+  def __supports_sharing__(self):
+    """The UBM and the ISV base can be shared only when they are stored in the same file"""
+    return not self.m_gmm_isv_split
+
+  def __shared_projector_arrays__(self):
+    """Returns the arrays of the UBM, the precomputed U subspace terms and the diagonal D of the ISV base"""
+    arrays = UBMGMM.__shared_projector_arrays__(self)
+    arrays.update(utils.shared.with_prefix('ux_', self.m_ux_estimator.precomputed_arrays()))
+    arrays['isv_d'] = self.m_isv_d
+    return arrays
+
+  def __attach_shared_projector__(self, arrays):
+    """Replaces the UBM and the ISV base by the given shared arrays"""
+    UBMGMM.__attach_shared_projector__(self, arrays)
+    self.m_ux_estimator = utils.gmm.UxEstimator(precomputed = utils.shared.without_prefix('ux_', arrays))
+    self.m_isv_d = arrays['isv_d']
+    self.m_isvbase = None
+    self.m_machine = None
+
 
   #######################################################
   ################ ISV training #########################
@@ -219,10 +280,11 @@ class ISV (UBMGMM):
     return UBMGMM.project(self,feature_array)
 
   def _project_isv(self, projected_ubm):
-    projected_isv = numpy.ndarray(shape=(self.m_ubm.dim_c*self.m_ubm.dim_d,), dtype=numpy.float64)
-    model = bob.machine.ISVMachine(self.m_isvbase)
-    model.estimate_ux(projected_ubm, projected_isv)
-    return projected_isv
+    return self.m_ux_estimator.estimate_ux([projected_ubm])[0]
+
+  def _project_isv_batch(self, projected_ubms):
+    """Computes the Ux vectors of several GMM statistics at once"""
+    return self.m_ux_estimator.estimate_ux(projected_ubms)
 
   def project(self, feature_array):
     """Computes GMM statistics against a UBM, then corresponding Ux vector"""
@@ -230,6 +292,12 @@ class ISV (UBMGMM):
     projected_isv = self._project_isv(projected_ubm)
     return [projected_ubm, projected_isv]
 
+  def project_batch(self, features):
+    """Computes the GMM statistics of all given features, and their Ux vectors at once"""
+    # copy the statistics, since the GMM projection always returns the same object
+    projected_ubms = [bob.machine.GMMStats(self._project_gmm(feature)) for feature in features]
+    return [[projected_ubm, projected_isv] for projected_ubm, projected_isv in zip(projected_ubms, self._project_isv_batch(projected_ubms))]
+
   #######################################################
   ################## ISV model enroll ####################
 
@@ -237,13 +305,13 @@ class ISV (UBMGMM):
     hdf5file = bob.io.HDF5File(feature_file, "w")
     hdf5file.create_group('gmmstats')
     hdf5file.cd('gmmstats')
-    gmmstats.save(hdf5file)
+    self._save_statistics(gmmstats, hdf5file)
     hdf5file.cd('/')
     hdf5file.set('Ux', Ux)
 
   def _save_feature_gmm(self, data, feature_file):
     feature_file_gmm = self._resolve_projected_gmm(feature_file)
-    data.save(bob.io.HDF5File(str(feature_file_gmm), 'w'))
+    self._save_statistics(data, bob.io.HDF5File(str(feature_file_gmm), 'w'))
 
   def _save_feature_isv(self, data, feature_file):
     feature_file_isv = self._resolve_projected_isv(feature_file)
@@ -263,15 +331,16 @@ class ISV (UBMGMM):
     if not self.m_gmm_isv_split:
       hdf5file = bob.io.HDF5File(feature_file)
       hdf5file.cd('gmmstats')
-      gmmstats = bob.machine.GMMStats(hdf5file)
+      gmmstats = self._read_statistics(hdf5file)
     else:
       feature_file_gmm = self._resolve_projected_gmm(feature_file)
-      gmmstats = bob.machine.GMMStats(bob.io.HDF5File(str(feature_file_gmm)))
+      gmmstats = self._read_statistics(bob.io.HDF5File(str(feature_file_gmm)))
     return gmmstats
 
 
   def enroll(self, enroll_features):
     """Performs ISV enrollment"""
+    self.__require_bob_machines__()
     self.m_trainer.enrol(self.m_machine, enroll_features, self.m_isv_enroll_iterations)
     # return the resulting gmm
     return self.m_machine
@@ -282,20 +351,21 @@ class ISV (UBMGMM):
   def read_model(self, model_file):
     """Reads the ISV Machine that holds the model"""
     machine = bob.machine.ISVMachine(bob.io.HDF5File(model_file))
-    machine.isv_base = self.m_isvbase
+    if self.m_isvbase is not None:
+      machine.isv_base = self.m_isvbase
     return machine
 
   def read_probe(self, probe_file):
     """Read the type of features that we require, namely GMMStats"""
     if self.m_gmm_isv_split:
       probe_file_gmm = self._resolve_projected_gmm(probe_file)
-      gmmstats = bob.machine.GMMStats(bob.io.HDF5File(str(probe_file_gmm)))
+      gmmstats = self._read_statistics(bob.io.HDF5File(str(probe_file_gmm)))
       probe_file_isv = self._resolve_projected_isv(probe_file)
       Ux = bob.io.load(str(probe_file_isv))
     else:
       hdf5file = bob.io.HDF5File(probe_file)
       hdf5file.cd('gmmstats')
-      gmmstats = bob.machine.GMMStats(hdf5file)
+      gmmstats = self._read_statistics(hdf5file)
       hdf5file.cd('/')
       Ux = hdf5file.read('Ux')
     return [gmmstats, Ux]
@@ -304,6 +374,9 @@ class ISV (UBMGMM):
     """Computes the score for the given model and the given probe."""
     gmmstats = probe[0]
     Ux = probe[1]
+    if self.m_isvbase is None:
+      # the ISV base is shared, so the model means m + Dz are computed from the shared arrays
+      return float(utils.gmm.linear_scoring((self.m_ubm.mean_supervector + self.m_isv_d * model.z)[None,:], self.m_ubm, [gmmstats], Ux[None,:])[0,0])
     return model.forward_ux(gmmstats, Ux)
 
   def score_for_multiple_probes(self, model, probes):
@@ -313,10 +386,9 @@ class ISV (UBMGMM):
     # add all other probe statistics
     for i in range(1,len(probes)):
       gmmstats_acc += probes[i][0]
-    # compute ISV score with the accumulated statistics
-    projected_isv_acc = numpy.ndarray(shape=(self.m_ubm.dim_c*self.m_ubm.dim_d,), dtype=numpy.float64)
-    model.estimate_ux(gmmstats_acc, projected_isv_acc)
-    return model.forward_ux(gmmstats_acc, projected_isv_acc)
+    # compute ISV score with the accumulated statistics; as in bob.machine.ISVMachine.estimate_ux, Ux is estimated around the UBM means
+    projected_isv_acc = self.m_ux_estimator.estimate_ux([gmmstats_acc])[0]
+    return self.score(model, [gmmstats_acc, projected_isv_acc])
 
 
 
@@ -366,6 +438,10 @@ class ISVVideo (ISV, UBMGMMVideo):
 
     utils.warn("In its current version, this class has not been tested. Use it with care!")
 
+  def __supports_sharing__(self):
+    """The enrollment from video.FrameContainers requires the bob machines"""
+    return False
+
 
   # Overrides ISV.train_enroller
   def train_enroller(self, train_features, enroller_file):
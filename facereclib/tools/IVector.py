@@ -8,7 +8,7 @@ import types
 
 from .Tool import Tool
 from .UBMGMM import UBMGMM
-from .. import utils
+from .. import utils, trainers
 
 
 class IVector (UBMGMM):
@@ -21,6 +21,12 @@ class IVector (UBMGMM):
       update_sigma = True,
       tv_training_iterations = 25,  # Number of EM iterations for the JFA training
       variance_threshold = 1e-5,
+      # IVector backend
+      use_whitening = True, # whiten the i-vectors with the mean and covariance of the training i-vectors
+      use_lda = False, # project the length-normalized i-vectors into an LDA subspace
+      lda_subspace_dimension = None, # the dimension of the LDA subspace; if None, the number of training clients - 1 is used
+      use_wccn = False, # apply the within-class covariance normalization after the LDA
+      wccn_regularization = 1e-5, # the ridge term added to the within-class covariance, relative to its average variance
       # Parameters when splitting GMM and IVector files
       gmm_ivec_split = False,
       projected_toreplace = 'projected', # 'Magic' string in path that will be replaced by the GMM or IVector one
@@ -41,13 +47,20 @@ class IVector (UBMGMM):
         self,
         performs_projection = True,
         use_projected_features_for_enrollment = True,
-        requires_enroller_training = False, # not needed anymore because it's done while training the projector
+        requires_enroller_training = True, # the backend is trained from the projected i-vectors of the training clients
         split_training_features_by_client = False,
+        stream_training_features = self.m_mini_batch_size is not None,
+        block_scoring = True,
 
         subspace_dimension_of_t = subspace_dimension_of_t,
         update_sigma = update_sigma,
         tv_training_iterations = tv_training_iterations,
         variance_threshold = variance_threshold,
+        use_whitening = use_whitening,
+        use_lda = use_lda,
+        lda_subspace_dimension = lda_subspace_dimension,
+        use_wccn = use_wccn,
+        wccn_regularization = wccn_regularization,
         gmm_ivec_split = gmm_ivec_split,
         projected_toreplace = projected_toreplace,
         projected_gmm = projected_gmm,
@@ -65,6 +78,13 @@ class IVector (UBMGMM):
     self.m_subspace_dimension_of_t = subspace_dimension_of_t
     self.m_tv_training_iterations = tv_training_iterations
     self.m_variance_threshold = variance_threshold
+    self.m_use_whitening = use_whitening
+    self.m_use_lda = use_lda
+    self.m_lda_subspace_dimension = lda_subspace_dimension
+    self.m_use_wccn = use_wccn
+    self.m_wccn_regularization = wccn_regularization
+    # the backend is trained by train_enroller, or read by load_enroller
+    self.m_backend = []
 
     self.m_gmm_ivec_split = gmm_ivec_split
     self.m_projected_toreplace = projected_toreplace
@@ -77,13 +97,24 @@ class IVector (UBMGMM):
   def _train_ivector(self, data):
     """Train the IVector model given a dataset"""
     utils.info("  -> Training IVector enroller")
+    if self.m_training_threads > 1:
+      # the E-steps are computed on chunks of the statistics in parallel worker processes
+      trainer = trainers.IVector(self.m_ubm, self.m_subspace_dimension_of_t, self.m_tv_training_iterations, self.m_update_sigma, self.m_variance_threshold, seed = self.m_init_seed)
+      self.m_tv = trainer.bob_machine(trainer.train(self.__split_list__(data), parallel = self.m_training_threads, checkpoint_file = self.__checkpoint_file__('tv'), checkpoint_interval = self.m_checkpoint_interval))
+      return
     self.m_tv = bob.machine.IVectorMachine(self.m_ubm, self.m_subspace_dimension_of_t)
     self.m_tv.variance_threshold = self.m_variance_threshold
 
     # train IVector model
     t = bob.trainer.IVectorTrainer(update_sigma=self.m_update_sigma, max_iterations=self.m_tv_training_iterations)
     t.rng = bob.core.random.mt19937(self.m_init_seed)
-    t.train(self.m_tv, data)
+    if self.m_checkpoint_interval:
+      # the EM steps of the bob trainer are executed one by one, so that they can be checkpointed
+      t.initialize(self.m_tv, data)
+      self.__train_em_with_checkpoints__('tv', t, self.m_tv, data, self.m_tv_training_iterations, ('t', 'sigma'), (), (self.m_update_sigma, self.m_variance_threshold, self.m_init_seed))
+      t.finalize(self.m_tv, data)
+    else:
+      t.train(self.m_tv, data)
 
   def _load_train_ivector(self, train_features):
     utils.info("  -> Projecting training data")
@@ -94,21 +125,20 @@ class IVector (UBMGMM):
       data.append(UBMGMM.project(self, feature))
 
     self._train_ivector(data)
+    self.m_ivector_extractor = utils.gmm.UxEstimator(self.m_ubm, self.m_tv.t, self.m_tv.sigma)
 
   def train_projector(self, train_features, projector_file):
     """Train Projector and Enroller at the same time"""
 
-    data = numpy.vstack(train_features)
-
-    UBMGMM._train_projector_using_array(self, data)
-    # to save some memory, we might want to delete these data
-    del data
+    self.__start_checkpoints__(projector_file)
+    UBMGMM._train_projector_using_features(self, train_features)
 
     # train IVector
     self._load_train_ivector(train_features)
 
     # Save the IVector base AND the UBM into the same file
     self._save_projector(projector_file)
+    self.__remove_checkpoints__()
 
 
   def _save_projector_together(self, projector_file):
@@ -175,6 +205,7 @@ class IVector (UBMGMM):
     self.m_tv = bob.machine.IVectorMachine(bob.io.HDF5File(ivec_filename))
     # add UBM model from base class
     self.m_tv.ubm = self.m_ubm
+    self.m_ivector_extractor = utils.gmm.UxEstimator(self.m_ubm, self.m_tv.t, self.m_tv.sigma)
 
   def _load_projector_ivector(self, projector_file):
     ivec_filename = self._resolve_ivector_filename(projector_file)
@@ -197,6 +228,7 @@ class IVector (UBMGMM):
     self.m_tv = bob.machine.IVectorMachine(hdf5file)
     # add UBM model from base class
     self.m_tv.ubm = self.m_ubm
+    self.m_ivector_extractor = utils.gmm.UxEstimator(self.m_ubm, self.m_tv.t, self.m_tv.sigma)
 
   def load_projector(self, projector_file):
     """Reads the UBM model from file"""
@@ -207,6 +239,22 @@ class IVector (UBMGMM):
       self._load_projector_gmm(projector_file)
       self._load_projector_ivector(projector_file)
 
+  def __supports_sharing__(self):
+    """The UBM and the total variability matrix can be shared only when they are stored in the same file"""
+    return not self.m_gmm_ivec_split
+
+  def __shared_projector_arrays__(self):
+    """Returns the arrays of the UBM and the precomputed terms of the i-vector extraction"""
+    arrays = UBMGMM.__shared_projector_arrays__(self)
+    arrays.update(utils.shared.with_prefix('ivector_', self.m_ivector_extractor.precomputed_arrays()))
+    return arrays
+
+  def __attach_shared_projector__(self, arrays):
+    """Replaces the UBM and the total variability machine by the given shared arrays"""
+    UBMGMM.__attach_shared_projector__(self, arrays)
+    self.m_ivector_extractor = utils.gmm.UxEstimator(precomputed = utils.shared.without_prefix('ivector_', arrays))
+    self.m_tv = None
+
 
   #######################################################
   ################ ISV training #########################
@@ -214,7 +262,11 @@ class IVector (UBMGMM):
     return UBMGMM.project(self,feature_array)
 
   def _project_ivector(self, projected_ubm):
-    return self.m_tv.forward(projected_ubm)
+    return self.m_ivector_extractor.estimate_x([projected_ubm])[0]
+
+  def _project_ivector_batch(self, projected_ubms):
+    """Extracts the i-vectors of several GMM statistics at once"""
+    return self.m_ivector_extractor.estimate_x(projected_ubms)
 
   def project(self, feature_array):
     """Computes GMM statistics against a UBM, then corresponding Ux vector"""
@@ -222,6 +274,12 @@ class IVector (UBMGMM):
     projected_ivec = self._project_ivector(projected_ubm)
     return [projected_ubm, projected_ivec]
 
+  def project_batch(self, features):
+    """Computes the GMM statistics of all given features, and their i-vectors at once"""
+    # copy the statistics, since the GMM projection always returns the same object
+    projected_ubms = [bob.machine.GMMStats(self._project_gmm(feature)) for feature in features]
+    return [[projected_ubm, projected_ivec] for projected_ubm, projected_ivec in zip(projected_ubms, self._project_ivector_batch(projected_ubms))]
+
   #######################################################
   ################## ISV model enroll ####################
 
@@ -229,13 +287,13 @@ class IVector (UBMGMM):
     hdf5file = bob.io.HDF5File(feature_file, "w")
     hdf5file.create_group('gmmstats')
     hdf5file.cd('gmmstats')
-    gmmstats.save(hdf5file)
+    self._save_statistics(gmmstats, hdf5file)
     hdf5file.cd('/')
     hdf5file.set('ivector', ivector)
 
   def _save_feature_gmm(self, data, feature_file):
     feature_file_gmm = self._resolve_projected_gmm(feature_file)
-    data.save(bob.io.HDF5File(str(feature_file_gmm), 'w'))
+    self._save_statistics(data, bob.io.HDF5File(str(feature_file_gmm), 'w'))
 
   def _save_feature_ivector(self, data, feature_file):
     feature_file_ivec = self._resolve_projected_ivector(feature_file)
@@ -250,49 +308,176 @@ class IVector (UBMGMM):
       self._save_feature_gmm(gmmstats, feature_file)
       self._save_feature_ivector(ivector, feature_file)
 
-  def read_feature(self, feature_file):
-    """Read the type of features that we require, namely GMMStats"""
+  def _read_gmm_stats(self, feature_file):
+    """Reads the GMMStats of the given projected file, which are required to extract the i-vector"""
     if not self.m_gmm_ivec_split:
       hdf5file = bob.io.HDF5File(feature_file)
       hdf5file.cd('gmmstats')
-      gmmstats = bob.machine.GMMStats(hdf5file)
+      gmmstats = self._read_statistics(hdf5file)
     else:
       feature_file_gmm = self._resolve_projected_gmm(feature_file)
-      gmmstats = bob.machine.GMMStats(bob.io.HDF5File(str(feature_file_gmm)))
+      gmmstats = self._read_statistics(bob.io.HDF5File(str(feature_file_gmm)))
     return gmmstats
 
+  def read_feature(self, feature_file):
+    """Read the type of features that we require for the backend training and the enrollment, namely the i-vector"""
+    if not self.m_gmm_ivec_split:
+      return bob.io.HDF5File(feature_file).read('ivector')
+    return bob.io.load(str(self._resolve_projected_ivector(feature_file)))
+
+
+  #######################################################
+  ############## IVector backend training ###############
+  def _length_normalize(self, ivectors):
+    """Normalizes the rows of the given 2D array to unit Euclidean length"""
+    norms = numpy.sqrt(numpy.sum(ivectors ** 2, axis = 1))
+    return ivectors / numpy.maximum(norms, 1e-12)[:, None]
+
+  def _train_whitening(self, ivectors):
+    """Trains a LinearMachine that subtracts the mean and whitens the covariance of the given 2D array of i-vectors"""
+    statistics = utils.streaming.ScatterStatistics(ivectors.shape[1])
+    statistics.accumulate(ivectors)
+    eigen_values, eigen_vectors = numpy.linalg.eigh(statistics.covariance())
+    # skip the directions without variance
+    valid = eigen_values > 1e-10 * numpy.max(eigen_values)
+    machine = bob.machine.LinearMachine(numpy.ascontiguousarray(eigen_vectors[:, valid] / numpy.sqrt(eigen_values[valid])))
+    machine.input_subtract = statistics.mean
+    return machine
+
+  def _train_lda(self, clients):
+    """Trains the LDA LinearMachine on the given list of 2D arrays of (whitened and length-normalized) i-vectors, one for each client"""
+    statistics = utils.streaming.ClassScatterStatistics(clients[0].shape[1])
+    for client in clients:
+      client_statistics = utils.streaming.ScatterStatistics(client.shape[1])
+      client_statistics.accumulate(client)
+      statistics.add_class(client_statistics)
+    machine, eigen_values = utils.streaming.lda(statistics, strip_to_rank = self.m_lda_subspace_dimension is None)
+    if self.m_lda_subspace_dimension is not None:
+      machine.resize(machine.shape[0], self.m_lda_subspace_dimension)
+    return machine
+
+  def _train_wccn(self, clients):
+    """Trains the WCCN LinearMachine on the given list of 2D arrays of i-vectors, one for each client.
+    The projection matrix is the Cholesky factor of the inverse of the average within-class covariance matrix.
+    Clients with a single i-vector do not contribute to the within-class covariance, which is regularized by a ridge term to keep it invertible."""
+    clients = [client for client in clients if client.shape[0] > 1]
+    if not clients:
+      raise ValueError("The WCCN training requires at least one client with several i-vectors")
+    dimension = clients[0].shape[1]
+    within_covariance = numpy.zeros((dimension, dimension), numpy.float64)
+    for client in clients:
+      centered = client - numpy.mean(client, axis = 0)
+      within_covariance += numpy.dot(centered.T, centered) / client.shape[0]
+    within_covariance /= len(clients)
+    # the ridge term is relative to the average variance (and absolute, if there is no variance at all)
+    average_variance = numpy.trace(within_covariance) / dimension
+    ridge = self.m_wccn_regularization * (average_variance if average_variance > 0. else 1.)
+    return bob.machine.LinearMachine(numpy.linalg.cholesky(numpy.linalg.pinv(within_covariance + ridge * numpy.eye(dimension))))
+
+  def train_enroller(self, train_features, enroller_file):
+    """Trains the i-vector backend (whitening, LDA and WCCN) using the projected i-vectors of the training clients"""
+    clients = [numpy.vstack(client) for client in train_features]
+    self.m_backend = []
+    if self.m_use_whitening:
+      utils.info("  -> Training IVector whitening")
+      self.m_backend.append(('Whitening', self._train_whitening(numpy.vstack(clients))))
+    clients = [self._backend_project(client) for client in clients]
+    if self.m_use_lda:
+      utils.info("  -> Training IVector LDA")
+      self.m_backend.append(('LDA', self._train_lda(clients)))
+      clients = [utils.project_batch(self.m_backend[-1][1], client) for client in clients]
+    if self.m_use_wccn:
+      utils.info("  -> Training IVector WCCN")
+      self.m_backend.append(('WCCN', self._train_wccn(clients)))
+
+    hdf5file = bob.io.HDF5File(enroller_file, "w")
+    for name, machine in self.m_backend:
+      hdf5file.create_group(name)
+      hdf5file.cd(name)
+      machine.save(hdf5file)
+      hdf5file.cd('/')
 
+  def load_enroller(self, enroller_file):
+    """Reads the i-vector backend from file"""
+    hdf5file = bob.io.HDF5File(enroller_file)
+    self.m_backend = []
+    for name in ('Whitening', 'LDA', 'WCCN'):
+      if hdf5file.has_group(name):
+        hdf5file.cd(name)
+        self.m_backend.append((name, bob.machine.LinearMachine(hdf5file)))
+        hdf5file.cd('/')
+
+  def __read_shared_enroller_arrays__(self, enroller_file):
+    """Reads the i-vector backend from file and returns the arrays of its linear machines"""
+    self.load_enroller(enroller_file)
+    arrays = {}
+    for name, machine in self.m_backend:
+      arrays.update(utils.shared.with_prefix(name + '_', utils.shared.SharedLinearMachine.arrays(machine)))
+    return arrays
+
+  def load_shared_enroller(self, enroller_file):
+    """Attaches the linear machines of the i-vector backend to memory-mapped arrays, which are shared between all processes"""
+    arrays = utils.shared.load(enroller_file, self.__read_shared_enroller_arrays__)
+    self.m_backend = []
+    for name in ('Whitening', 'LDA', 'WCCN'):
+      if name + '_weights' in arrays:
+        self.m_backend.append((name, utils.shared.SharedLinearMachine(**utils.shared.without_prefix(name + '_', arrays))))
+
+  def _backend_project(self, ivectors):
+    """Projects the given 2D array of i-vectors (one per row) with the trained backend, i.e., whitening, length normalization, LDA and WCCN.
+    The resulting vectors are normalized to unit length, so that their inner products are the cosine similarities."""
+    for name, machine in self.m_backend:
+      ivectors = utils.project_batch(machine, ivectors)
+      if name == 'Whitening':
+        ivectors = self._length_normalize(ivectors)
+    return self._length_normalize(ivectors)
+
+
+  #######################################################
+  ################## IVector enrollment #################
   def enroll(self, enroll_features):
-    """Performs IVector enrollment"""
-    raise NotImplementedError('Enrollment is not yet supported')
+    """Performs IVector enrollment by averaging the projected i-vectors of the enrollment files"""
+    projected = self._backend_project(numpy.vstack(enroll_features))
+    return self._length_normalize(numpy.mean(projected, axis = 0)[None, :])[0]
 
 
   ######################################################
   ################ Feature comparison ##################
   def read_model(self, model_file):
-    """Reads the IVector Machine that holds the model"""
-    raise NotImplementedError('Enrollment model is not yet supported')
+    """Reads the enrolled model, which is the averaged projected i-vector"""
+    return bob.io.load(model_file)
 
   def read_probe(self, probe_file):
     """Read the type of features that we require, namely GMMStats"""
     if self.m_gmm_ivec_split:
       probe_file_gmm = self._resolve_projected_gmm(probe_file)
-      gmmstats = bob.machine.GMMStats(bob.io.HDF5File(str(probe_file_gmm)))
-      probe_file_ivec = self._resolve_projected_ivec(probe_file)
+      gmmstats = self._read_statistics(bob.io.HDF5File(str(probe_file_gmm)))
+      probe_file_ivec = self._resolve_projected_ivector(probe_file)
       ivector = bob.io.load(str(probe_file_ivec))
     else:
       hdf5file = bob.io.HDF5File(probe_file)
       hdf5file.cd('gmmstats')
-      gmmstats = bob.machine.GMMStats(hdf5file)
+      gmmstats = self._read_statistics(hdf5file)
       hdf5file.cd('/')
       ivector = hdf5file.read('ivector')
     return [gmmstats, ivector]
 
   def score(self, model, probe):
-    """Computes the score for the given model and the given probe."""
-    raise NotImplementedError('Scoring is not yet supported')
+    """Computes the cosine similarity of the given model and the projected i-vector of the given probe."""
+    return float(numpy.dot(model, self._backend_project(probe[1][None, :])[0]))
 
   def score_for_multiple_probes(self, model, probes):
-    """This function computes the score between the given model and several given probe files."""
-    raise NotImplementedError('Multiple probes is not yet supported')
-
+    """This function computes the cosine similarity between the given model and the average of the projected i-vectors of the given probes."""
+    projected = self._backend_project(numpy.vstack([probe[1] for probe in probes]))
+    return float(numpy.dot(model, self._length_normalize(numpy.mean(projected, axis = 0)[None, :])[0]))
+
+  def score_block(self, models, probes):
+    """Computes the cosine similarities of all given models and all given probes with a single matrix multiplication."""
+    return numpy.dot(numpy.vstack(models), self._backend_project(numpy.vstack([probe[1] for probe in probes])).T)
+
+  def score_block_for_multiple_probes(self, models, probe_sets):
+    """Computes the cosine similarities of all given models and the averages of the projected i-vectors of all given probe sets, where the i-vectors of all probes are projected at once."""
+    projected = self._backend_project(numpy.vstack([probe[1] for probes in probe_sets for probe in probes]))
+    bounds = numpy.cumsum([0] + [len(probes) for probes in probe_sets])
+    averages = numpy.vstack([numpy.mean(projected[bounds[j] : bounds[j+1]], axis = 0) for j in range(len(probe_sets))])
+    return numpy.dot(numpy.vstack(models), self._length_normalize(averages).T)
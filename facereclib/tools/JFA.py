@@ -7,7 +7,7 @@ import numpy
 
 from .Tool import Tool
 from . import UBMGMM
-from .. import utils
+from .. import utils, trainers
 
 
 class JFA (UBMGMM):
@@ -42,6 +42,7 @@ class JFA (UBMGMM):
 
         multiple_model_scoring = None,
         multiple_probe_scoring = None,
+        block_scoring = True,
         **kwargs
     )
 
@@ -63,17 +64,43 @@ class JFA (UBMGMM):
 
   #######################################################
   ################ JFA training #########################
-  def train_enroller(self, train_features, enroller_file):
-    # create a JFABasemachine with the UBM from the base class
-    self.m_jfabase = bob.machine.JFABase(self.m_ubm, self.m_subspace_dimension_of_u, self.m_subspace_dimension_of_v)
+  def _train_jfa_parallel(self, train_features):
+    """Trains the JFA with the map-reduce trainer, computing the E-steps on chunks of clients in parallel worker processes.
+    As in bob.trainer.JFATrainer, V, U and D are trained one after another; each stage has its own checkpoint, so that finished stages are not repeated when the training is resumed."""
+    chunks = self.__split_list__(train_features)
+    machine = None
+    for stage in ('v', 'u', 'd'):
+      trainer = trainers.JFA(self.m_ubm, self.m_subspace_dimension_of_u, self.m_subspace_dimension_of_v, stage, self.m_jfa_training_iterations, seed = self.m_init_seed)
+      machine = trainer.train(chunks, parallel = self.m_training_threads, machine = machine, checkpoint_file = self.__checkpoint_file__('jfa_' + stage), checkpoint_interval = self.m_checkpoint_interval)
+    return trainer.bob_machine(machine)
+
+  def _train_jfa_with_checkpoints(self, trainer, train_features):
+    """Executes the steps of the given bob.trainer.JFATrainer one by one, so that the exact bob training can be checkpointed.
+    As in bob.trainer.JFATrainer.train, V, U and D are trained one after another, and each stage has its own checkpoint."""
+    trainer.initialize(self.m_jfabase, train_features)
+    for step, stage in (('1', 'v'), ('2', 'u'), ('3', 'd')):
+      self.__train_em_with_checkpoints__('jfa_' + stage, trainer, self.m_jfabase, train_features, self.m_jfa_training_iterations, ('u', 'v', 'd'), ('__X__', '__Y__', '__Z__'), (self.m_init_seed,), step)
+      getattr(trainer, 'finalize' + step)(self.m_jfabase, train_features)
 
-    # train the JFA
-    t = bob.trainer.JFATrainer(self.m_jfa_training_iterations)
-    t.rng = bob.core.random.mt19937(self.m_init_seed)
-    t.train(self.m_jfabase, train_features)
+  def train_enroller(self, train_features, enroller_file):
+    self.__start_checkpoints__(enroller_file)
+    if self.m_training_threads > 1:
+      self.m_jfabase = self._train_jfa_parallel(train_features)
+    else:
+      # create a JFABasemachine with the UBM from the base class
+      self.m_jfabase = bob.machine.JFABase(self.m_ubm, self.m_subspace_dimension_of_u, self.m_subspace_dimension_of_v)
+
+      # train the JFA
+      t = bob.trainer.JFATrainer(self.m_jfa_training_iterations)
+      t.rng = bob.core.random.mt19937(self.m_init_seed)
+      if self.m_checkpoint_interval:
+        self._train_jfa_with_checkpoints(t, train_features)
+      else:
+        t.train(self.m_jfabase, train_features)
 
     # Save the JFA base AND the UBM into the same file
     self.m_jfabase.save(bob.io.HDF5File(enroller_file, "w"))
+    self.__remove_checkpoints__()
 
 
 
@@ -90,14 +117,37 @@ class JFA (UBMGMM):
     self.m_trainer = bob.trainer.JFATrainer()
     self.m_trainer.rng = bob.core.random.mt19937(self.m_init_seed)
 
+  def __supports_sharing__(self):
+    """The JFA scoring is always linear"""
+    return True
+
+  def __read_shared_enroller_arrays__(self, enroller_file):
+    """Reads the JFA base from file and returns the precomputed U subspace terms and the V and D matrices, which are shared between processes"""
+    jfabase = bob.machine.JFABase(bob.io.HDF5File(enroller_file))
+    arrays = utils.shared.with_prefix('ux_', utils.gmm.UxEstimator(self.m_ubm, jfabase.u).precomputed_arrays())
+    arrays.update({'v' : jfabase.v, 'd' : jfabase.d})
+    return arrays
+
+  def load_shared_enroller(self, enroller_file):
+    """Attaches the JFA base to memory-mapped arrays, which are shared between all processes"""
+    arrays = utils.shared.load(enroller_file, self.__read_shared_enroller_arrays__)
+    self.m_ux_estimator = utils.gmm.UxEstimator(precomputed = utils.shared.without_prefix('ux_', arrays))
+    self.m_jfa_v = arrays['v']
+    self.m_jfa_d = arrays['d']
+    self.m_jfabase = None
+    self.m_machine = None
+    self.m_trainer = None
+    self.m_shared_enroller_file = enroller_file
+
 
   def read_feature(self, feature_file):
     """Reads the projected feature to be enrolled as a model"""
-    return bob.machine.GMMStats(bob.io.HDF5File(str(feature_file)))
+    return self._read_statistics(bob.io.HDF5File(str(feature_file)))
 
 
   def enroll(self, enroll_features):
     """Enrolls a GMM using MAP adaptation"""
+    self.__require_bob_machines__()
 
     self.m_trainer.enrol(self.m_machine, enroll_features, self.m_jfa_enroll_iterations)
     # return the resulting gmm
@@ -109,15 +159,34 @@ class JFA (UBMGMM):
   def read_model(self, model_file):
     """Reads the JFA Machine that holds the model"""
     machine = bob.machine.JFAMachine(bob.io.HDF5File(model_file))
-    machine.jfa_base = self.m_jfabase
+    if self.m_jfabase is not None:
+      machine.jfa_base = self.m_jfabase
     return machine
 
   read_probe = read_feature
 
   def score(self, model, probe):
     """Computes the score for the given model and the given probe"""
+    if self.m_jfabase is None:
+      return float(self.score_block([model], [probe])[0,0])
     return model.forward(probe)
 
+  def score_block(self, models, probes):
+    """Computes the scores of all given models and probes at once.
+    The channel offset U x of each probe is estimated only once, and the linear scores of the model supervectors m + V y + D z are computed with a single matrix multiplication."""
+    ubm = self.m_ubm
+    if self.m_jfabase is None:
+      # the JFA base is shared; the U x of all probes are estimated at once
+      v, d = self.m_jfa_v, self.m_jfa_d
+      offsets = self.m_ux_estimator.estimate_ux(probes)
+    else:
+      v, d = self.m_jfabase.v, self.m_jfabase.d
+      offsets = numpy.ndarray((len(probes), ubm.dim_c * ubm.dim_d), numpy.float64)
+      for i, probe in enumerate(probes):
+        self.m_machine.estimate_ux(probe, offsets[i])
+    supervectors = numpy.vstack([ubm.mean_supervector + numpy.dot(v, model.y) + d * model.z for model in models])
+    return utils.gmm.linear_scoring(supervectors, ubm, probes, offsets)
+
   def score_for_multiple_probes(self, model, probes):
     """This function computes the score between the given model and several given probe files."""
     # TODO: Check if this is correct
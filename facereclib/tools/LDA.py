@@ -7,7 +7,7 @@ import numpy
 import scipy.spatial
 
 from .Tool import Tool
-from .. import utils
+from .. import utils, trainers
 
 class LDA (Tool):
   """Tool for computing linear discriminant analysis (so-called Fisher faces)"""
@@ -19,6 +19,8 @@ class LDA (Tool):
       distance_function = scipy.spatial.distance.euclidean,
       is_distance_function = True,
       uses_variances = False,
+      stream_training_features = False, # if enabled, PCA and LDA are trained incrementally, without keeping all training features in memory
+      training_threads = 1, # if greater than 1, the scatter matrices of the incremental PCA and LDA are accumulated by this number of processes
       **kwargs  # parameters directly sent to the base class
   ):
     """Initializes the LDA tool with the given configuration"""
@@ -28,12 +30,14 @@ class LDA (Tool):
         self,
         performs_projection = True,
         split_training_features_by_client = True,
+        stream_training_features = stream_training_features,
 
         lda_subspace_dimension = lda_subspace_dimension,
         pca_subspace_dimension = pca_subspace_dimension,
         distance_function = str(distance_function),
         is_distance_function = is_distance_function,
         uses_variances = uses_variances,
+        training_threads = training_threads,
 
         **kwargs
     )
@@ -48,28 +52,39 @@ class LDA (Tool):
     self.m_distance_function = distance_function
     self.m_factor = -1 if is_distance_function else 1.
     self.m_uses_variances = uses_variances
+    self.m_training_threads = training_threads
 
 
-  def __read_data__(self, training_files):
-    data = []
+  def __select_clients__(self, training_files):
+    """Returns the list of clients that have enough training files."""
+    clients = []
     for client_files in training_files:
       # at least two files per client are required!
       if len(client_files) < 2:
         utils.warn("Skipping one client since the number of client files is only %d" %len(client_files))
         continue
-      data.append(numpy.vstack([feature.flatten() for feature in client_files]))
+      clients.append(client_files)
+    return clients
+
+  def __read_data__(self, training_files):
+    data = [numpy.vstack([feature.flatten() for feature in client_files]) for client_files in self.__select_clients__(training_files)]
 
     # Returns the list of lists of arrays
     return data
 
   def __train_pca__(self, training_set):
     """Trains and returns a LinearMachine that is trained using PCA"""
-    data_list = [feature for client in training_set for feature in client]
-    data = numpy.vstack(data_list)
+    if self.stream_training_features:
+      utils.info("  -> Training LinearMachine using incremental PCA")
+      # each client is one chunk of the map-reduce training
+      machine, eigen_values = trainers.PCA().train(training_set, parallel = self.m_training_threads)
+    else:
+      data_list = [feature for client in training_set for feature in client]
+      data = numpy.vstack(data_list)
 
-    utils.info("  -> Training LinearMachine using PCA")
-    t = bob.trainer.PCATrainer()
-    machine, eigen_values = t.train(data)
+      utils.info("  -> Training LinearMachine using PCA")
+      t = bob.trainer.PCATrainer()
+      machine, eigen_values = t.train(data)
 
     if isinstance(self.m_pca_subspace, float):
       cummulated = numpy.cumsum(eigen_values) / numpy.sum(eigen_values)
@@ -92,29 +107,48 @@ class LDA (Tool):
 
   def __perform_pca__(self, machine, training_set):
     """Perform PCA on data"""
-    data = []
-    for client_features in training_set:
-      data.append(numpy.vstack([machine(feature) for feature in client_features]))
-    return data
+    return [utils.project_batch(machine, client_features) for client_features in training_set]
 
 
-  def train_projector(self, training_features, projector_file):
-    """Generates the LDA projection matrix from the given features (that are sorted by identity)"""
+  def __train_lda__(self, training_features):
+    """Trains the (PCA+)LDA machine and the eigenvalues with the bob.trainer.FisherLDATrainer, keeping all training features in memory"""
     # Initializes an array for the data
     data = self.__read_data__(training_features)
 
+    pca_machine = None
     if self.m_pca_subspace:
       pca_machine = self.__train_pca__(data)
       data = self.__perform_pca__(pca_machine, data)
 
     utils.info("  -> Training LinearMachine using LDA")
     t = bob.trainer.FisherLDATrainer(strip_to_rank = (self.m_lda_subspace == 0))
-    self.m_machine, self.m_variances = t.train(data)
+    machine, variances = t.train(data)
+    return pca_machine, machine, variances
+
+  def __train_lda_incrementally__(self, training_features):
+    """Trains the (PCA+)LDA machine and the eigenvalues by accumulating the scatter matrices client by client, reading the training features chunk by chunk"""
+    clients = self.__select_clients__(training_features)
+
+    pca_machine = None
+    if self.m_pca_subspace:
+      pca_machine = self.__train_pca__(clients)
+
+    utils.info("  -> Training LinearMachine using incremental LDA")
+    machine, variances = trainers.LDA(self.m_lda_subspace or None, pca_machine).train(clients, parallel = self.m_training_threads)
+    return pca_machine, machine, variances
+
+  def train_projector(self, training_features, projector_file):
+    """Generates the LDA projection matrix from the given features (that are sorted by identity)"""
+    if self.stream_training_features:
+      pca_machine, self.m_machine, self.m_variances = self.__train_lda_incrementally__(training_features)
+    else:
+      pca_machine, self.m_machine, self.m_variances = self.__train_lda__(training_features)
+
     if self.m_lda_subspace:
       self.m_machine.resize(self.m_machine.shape[0], self.m_lda_subspace)
       self.m_variances.resize(self.m_lda_subspace)
 
-    if self.m_pca_subspace:
+    if pca_machine is not None:
       # compute combined PCA/LDA projection matrix
       combined_matrix = numpy.dot(pca_machine.weights, self.m_machine.weights)
       # set new weight matrix (and new mean vector) of novel machine
@@ -138,6 +172,12 @@ class LDA (Tool):
     # Allocates an array for the projected data
     self.m_projected_feature = numpy.ndarray(self.m_machine.shape[1], numpy.float64)
 
+  def load_shared_projector(self, projector_file):
+    """Attaches to the memory-mapped LDA projection matrix, which is shared between all processes"""
+    self.m_variances, self.m_machine = utils.shared.load_linear_projector(projector_file)
+    # Allocates an array for the projected data
+    self.m_projected_feature = numpy.ndarray(self.m_machine.shape[1], numpy.float64)
+
   def project(self, feature):
     """Projects the data using the stored covariance matrix"""
     # Projects the data
@@ -145,6 +185,10 @@ class LDA (Tool):
     # return the projected data
     return self.m_projected_feature
 
+  def project_batch(self, features):
+    """Projects all given features at once, returning a 2D array with one projected feature per row"""
+    return utils.project_batch(self.m_machine, numpy.vstack([feature.flatten() for feature in features]))
+
   def enroll(self, enroll_features):
     """Enrolls the model by computing an average of the given input vectors"""
     assert len(enroll_features)
@@ -7,7 +7,7 @@ import numpy
 import scipy.spatial
 
 from .Tool import Tool
-from .. import utils
+from .. import utils, trainers
 
 class PCA (Tool):
   """Tool for computing eigenfaces"""
@@ -18,6 +18,8 @@ class PCA (Tool):
       distance_function = scipy.spatial.distance.euclidean,
       is_distance_function = True,
       uses_variances = False,
+      stream_training_features = False, # if enabled, the PCA is trained incrementally, without keeping all training features in memory
+      training_threads = 1, # if greater than 1, the scatter matrices of the incremental PCA are accumulated by this number of processes
       **kwargs  # parameters directly sent to the base class
   ):
 
@@ -26,11 +28,13 @@ class PCA (Tool):
     Tool.__init__(
         self,
         performs_projection = True,
+        stream_training_features = stream_training_features,
 
         subspace_dimension = subspace_dimension,
         distance_function = str(distance_function),
         is_distance_function = is_distance_function,
         uses_variances = uses_variances,
+        training_threads = training_threads,
 
         **kwargs
     )
@@ -40,16 +44,21 @@ class PCA (Tool):
     self.m_distance_function = distance_function
     self.m_factor = -1 if is_distance_function else 1.
     self.m_uses_variances = uses_variances
+    self.m_training_threads = training_threads
 
 
   def train_projector(self, training_features, projector_file):
     """Generates the PCA covariance matrix"""
-    # Initializes the data
-    data = numpy.vstack([feature.flatten() for feature in training_features])
+    if self.stream_training_features:
+      utils.info("  -> Training LinearMachine using incremental PCA")
+      self.m_machine, self.m_variances = trainers.PCA().train(utils.streaming.split(training_features), parallel = self.m_training_threads)
+    else:
+      # Initializes the data
+      data = numpy.vstack([feature.flatten() for feature in training_features])
 
-    utils.info("  -> Training LinearMachine using PCA")
-    t = bob.trainer.PCATrainer()
-    self.m_machine, self.m_variances = t.train(data)
+      utils.info("  -> Training LinearMachine using PCA")
+      t = bob.trainer.PCATrainer()
+      self.m_machine, self.m_variances = t.train(data)
 
     # compute variance percentage, if desired
     if isinstance(self.m_subspace_dim, float):
@@ -83,6 +92,12 @@ class PCA (Tool):
     # Allocates an array for the projected data
     self.m_projected_feature = numpy.ndarray(self.m_machine.shape[1], numpy.float64)
 
+  def load_shared_projector(self, projector_file):
+    """Attaches to the memory-mapped PCA projection matrix, which is shared between all processes"""
+    self.m_variances, self.m_machine = utils.shared.load_linear_projector(projector_file)
+    # Allocates an array for the projected data
+    self.m_projected_feature = numpy.ndarray(self.m_machine.shape[1], numpy.float64)
+
   def project(self, feature):
     """Projects the data using the stored covariance matrix"""
     # Projects the data
@@ -90,6 +105,10 @@ class PCA (Tool):
     # return the projected data
     return self.m_projected_feature
 
+  def project_batch(self, features):
+    """Projects all given features at once, returning a 2D array with one projected feature per row"""
+    return utils.project_batch(self.m_machine, numpy.vstack([feature.flatten() for feature in features]))
+
   def enroll(self, enroll_features):
     """Enrolls the model by computing an average of the given input vectors"""
     assert len(enroll_features)
@@ -4,9 +4,10 @@
 
 import bob
 import numpy
+import os
 
 from .Tool import Tool
-from .. import utils
+from .. import utils, trainers
 
 
 class PLDA (Tool):
@@ -18,6 +19,8 @@ class PLDA (Tool):
       subspace_dimension_of_g, # Size of subspace G
       subspace_dimension_pca = None,  # if given, perform PCA on data and reduce the PCA subspace to the given dimension
       plda_training_iterations = 200, # Maximum number of iterations for the EM loop
+      stream_training_features = False, # if enabled, the PCA is trained incrementally, without keeping all training features in memory
+      checkpoint_interval = None, # if given, the PLDA base is written every this number of EM iterations next to the enroller file, and a restarted training resumes from there
       # TODO: refactor the remaining parameters!
       INIT_SEED = 5489, # seed for initializing
       INIT_F_METHOD = bob.trainer.PLDATrainer.BETWEEN_SCATTER,
@@ -34,11 +37,14 @@ class PLDA (Tool):
     Tool.__init__(
         self,
         requires_enroller_training = True,
+        stream_training_features = stream_training_features,
+        block_scoring = True,
 
         subspace_dimension_of_f = subspace_dimension_of_f, # Size of subspace F
         subspace_dimension_of_g = subspace_dimension_of_g, # Size of subspace G
         subspace_dimension_pca = subspace_dimension_pca,  # if given, perform PCA on data and reduce the PCA subspace to the given dimension
         plda_training_iterations = plda_training_iterations, # Maximum number of iterations for the EM loop
+        checkpoint_interval = checkpoint_interval,
         # TODO: refactor the remaining parameters!
         INIT_SEED = INIT_SEED, # seed for initializing
         INIT_F_METHOD = str(INIT_F_METHOD),
@@ -55,6 +61,7 @@ class PLDA (Tool):
     self.m_subspace_dimension_of_g = subspace_dimension_of_g
     self.m_subspace_dimension_pca = subspace_dimension_pca
     self.m_plda_training_iterations = plda_training_iterations
+    self.m_checkpoint_interval = checkpoint_interval
     self.m_score_set = {'joint_likelihood': 'joint_likelihood', 'average':numpy.average, 'min':min, 'max':max}[multiple_probe_scoring]
 
     # TODO: refactor
@@ -63,31 +70,29 @@ class PLDA (Tool):
 
   def __train_pca__(self, training_set):
     """Trains and returns a LinearMachine that is trained using PCA"""
-    data_list = []
-    for client in training_set:
-      for feature in client:
-        # Appends in the array
-        data_list.append(feature)
-    data = numpy.vstack(data_list)
-
-    utils.info("  -> Training LinearMachine using PCA ")
-    t = bob.trainer.PCATrainer()
-    machine, __eig_vals = t.train(data)
+    if self.stream_training_features:
+      utils.info("  -> Training LinearMachine using incremental PCA")
+      # each client is one chunk of the map-reduce training
+      machine, __eig_vals = trainers.PCA().train(training_set)
+    else:
+      data_list = []
+      for client in training_set:
+        for feature in client:
+          # Appends in the array
+          data_list.append(feature)
+      data = numpy.vstack(data_list)
+
+      utils.info("  -> Training LinearMachine using PCA ")
+      t = bob.trainer.PCATrainer()
+      machine, __eig_vals = t.train(data)
     # limit number of pcs
     machine.resize(machine.shape[0], self.m_subspace_dimension_pca)
     return machine
 
   def __perform_pca_client__(self, machine, client):
     """Perform PCA on an array"""
-    client_data_list = []
-    for feature in client:
-      # project data
-      projected_feature = numpy.ndarray(machine.shape[1], numpy.float64)
-      machine(feature, projected_feature)
-      # add data in new array
-      client_data_list.append(projected_feature)
-    client_data = numpy.vstack(client_data_list)
-    return client_data
+    # project all features of the client at once
+    return utils.project_batch(machine, numpy.vstack(client))
 
   def __perform_pca__(self, machine, training_set):
     """Perform PCA on data"""
@@ -98,6 +103,41 @@ class PLDA (Tool):
     return data
 
 
+  def __train_plda_with_checkpoints__(self, trainer, training_features, checkpoint_file):
+    """Executes the EM iterations of the given bob.trainer.PLDATrainer one by one, and writes the PLDA base and the number of finished iterations to the checkpoint file every m_checkpoint_interval iterations.
+    If the checkpoint file exists and was written by a training with the same parameters and number of clients, the training is resumed from the stored PLDA base."""
+    # the initialization computes the statistics of the training data that are required by the E-step, so it is executed in any case
+    trainer.initialize(self.m_plda_base, training_features)
+    first_iteration = 0
+    fingerprint = "PLDA(f=%d, g=%d, init=%s) on %d clients of dimension %d" % (self.m_subspace_dimension_of_f, self.m_subspace_dimension_of_g, self.m_init, len(training_features), training_features[0].shape[1])
+    if os.path.exists(checkpoint_file):
+      hdf5file = bob.io.HDF5File(checkpoint_file)
+      if not hdf5file.has_key('fingerprint') or hdf5file.read('fingerprint') != fingerprint:
+        utils.warn("Ignoring checkpoint '%s', which was written by a training with different parameters" % checkpoint_file)
+      else:
+        first_iteration = int(hdf5file.read('iteration'))
+        hdf5file.cd('/plda')
+        self.m_plda_base = bob.machine.PLDABase(hdf5file)
+        utils.info("  -> Resuming PLDA training after %d iterations from checkpoint '%s'" % (first_iteration, checkpoint_file))
+
+    for iteration in range(first_iteration, self.m_plda_training_iterations):
+      trainer.e_step(self.m_plda_base, training_features)
+      trainer.m_step(self.m_plda_base, training_features)
+      utils.debug("  -> Iteration %d of PLDA training" % (iteration + 1))
+      if (iteration + 1) % self.m_checkpoint_interval == 0 and iteration + 1 < self.m_plda_training_iterations:
+        # write to a temporary file first, so that a job that is killed while writing does not destroy the previous checkpoint
+        hdf5file = bob.io.HDF5File(checkpoint_file + '.tmp', 'w')
+        hdf5file.set('iteration', iteration + 1)
+        hdf5file.set('fingerprint', fingerprint)
+        hdf5file.create_group('/plda')
+        hdf5file.cd('/plda')
+        self.m_plda_base.save(hdf5file)
+        del hdf5file
+        os.rename(checkpoint_file + '.tmp', checkpoint_file)
+
+    trainer.finalize(self.m_plda_base, training_features)
+
+
   def train_enroller(self, training_features, projector_file):
     """Generates the PLDA base model from a list of arrays (one per identity),
        and a set of training parameters. If PCA is requested, it is trained on the same data.
@@ -108,6 +148,9 @@ class PLDA (Tool):
     if self.m_subspace_dimension_pca is not None:
       self.m_pca_machine = self.__train_pca__(training_features)
       training_features = self.__perform_pca__(self.m_pca_machine, training_features)
+    else:
+      # the PLDA trainer requires one 2D array per client
+      training_features = [numpy.vstack(client) for client in training_features]
 
     input_dimension = training_features[0].shape[1]
 
@@ -127,7 +170,11 @@ class PLDA (Tool):
 
     # train machine
     self.m_plda_base = bob.machine.PLDABase(input_dimension, self.m_subspace_dimension_of_f, self.m_subspace_dimension_of_g)
-    t.train(self.m_plda_base, training_features)
+    checkpoint_file = os.path.splitext(projector_file)[0] + '_plda_checkpoint.hdf5'
+    if self.m_checkpoint_interval:
+      self.__train_plda_with_checkpoints__(t, training_features, checkpoint_file)
+    else:
+      t.train(self.m_plda_base, training_features)
 
     # write machines to file
     proj_hdf5file = bob.io.HDF5File(str(projector_file), "w")
@@ -138,6 +185,11 @@ class PLDA (Tool):
     proj_hdf5file.create_group('/plda')
     proj_hdf5file.cd('/plda')
     self.m_plda_base.save(proj_hdf5file)
+    del proj_hdf5file
+
+    # the training has finished, so the checkpoint is not required any more
+    if os.path.exists(checkpoint_file):
+      os.remove(checkpoint_file)
 
 
   def load_enroller(self, projector_file):
@@ -152,9 +204,34 @@ class PLDA (Tool):
     #self.m_plda_base = bob.machine.PLDABase(bob.io.HDF5File(projector_file))
     self.m_plda_machine = bob.machine.PLDAMachine(self.m_plda_base)
     self.m_plda_trainer = bob.trainer.PLDATrainer()
+    # precompute the terms of the PLDA base that are required for the scoring
+    self.m_log_likelihood_ratios = utils.plda.PLDALogLikelihoodRatios(self.m_plda_base)
+    self.m_shared_enroller_file = None
+
+  def __read_shared_enroller_arrays__(self, enroller_file):
+    """Reads the PCA and PLDA machines from file and returns the arrays that are required for the scoring"""
+    self.load_enroller(enroller_file)
+    arrays = utils.shared.with_prefix('plda_', self.m_log_likelihood_ratios.precomputed_arrays())
+    if self.m_subspace_dimension_pca is not None:
+      arrays.update(utils.shared.with_prefix('pca_', utils.shared.SharedLinearMachine.arrays(self.m_pca_machine)))
+    return arrays
+
+  def load_shared_enroller(self, enroller_file):
+    """Attaches the PCA projection and the precomputed PLDA terms to memory-mapped arrays, which are shared between all processes.
+    The PLDA base, which is required for the enrollment only, is loaded when the first model is enrolled."""
+    arrays = utils.shared.load(enroller_file, self.__read_shared_enroller_arrays__)
+    if self.m_subspace_dimension_pca is not None:
+      self.m_pca_machine = utils.shared.SharedLinearMachine(**utils.shared.without_prefix('pca_', arrays))
+    self.m_log_likelihood_ratios = utils.plda.PLDALogLikelihoodRatios(precomputed = utils.shared.without_prefix('plda_', arrays))
+    self.m_plda_base = None
+    self.m_plda_machine = None
+    self.m_plda_trainer = None
+    self.m_shared_enroller_file = enroller_file
 
   def enroll(self, enroll_features):
     """Enrolls the model by computing an average of the given input vectors"""
+    if self.m_shared_enroller_file is not None:
+      self.load_enroller(self.m_shared_enroller_file)
     if self.m_subspace_dimension_pca is not None:
       enroll_features_projected = self.__perform_pca_client__(self.m_pca_machine, enroll_features)
       self.m_plda_trainer.enrol(self.m_plda_machine,enroll_features_projected)
@@ -164,40 +241,44 @@ class PLDA (Tool):
 
   def read_model(self, model_file):
     """Reads the model, which in this case is a PLDA-Machine"""
+    if self.m_plda_base is None:
+      # the PLDA base is shared, and the scoring requires the enrolled parameters only
+      return utils.plda.PLDAModel(bob.io.HDF5File(model_file))
     # read machine and attach base machine
     plda_machine = bob.machine.PLDAMachine(bob.io.HDF5File(model_file), self.m_plda_base)
     return plda_machine
 
+  def __project_probes__(self, probes):
+    """Returns the given probes as a 2D array, projected into the PCA subspace if requested"""
+    if self.m_subspace_dimension_pca is not None:
+      return self.__perform_pca_client__(self.m_pca_machine, probes)
+    return numpy.vstack([probe.flatten() for probe in probes])
+
   def score(self, model, probe):
     """Computes the PLDA score for the given model and probe"""
-    return self.score_for_multiple_probes(model, [probe])
+    return self.score_block([model], [probe])[0,0]
 
   def score_for_multiple_probes(self, model, probes):
     """This function computes the score between the given model and several given probe files.
-    In this base class implementation, it computes the scores for each probe file using the 'score' method,
-    and fuses the scores using the fusion method specified in the constructor of this class."""
-    n_probes = len(probes)
-    if self.m_subspace_dimension_pca is not None:
-      # project probe
-      probe_ = numpy.ndarray((n_probes, self.m_pca_machine.shape[1]), numpy.float64)
-      projected_probe = numpy.ndarray(self.m_pca_machine.shape[1], numpy.float64)
-      for i in range(n_probes):
-        self.m_pca_machine(probes[i], projected_probe)
-        probe_[i,:] = projected_probe
-      # forward
-      if self.m_score_set == 'joint_likelihood':
-        return model.forward(probe_)
-      else:
-        scores = [model.forward(probe_[i,:]) for i in range(n_probes)]
-        return self.m_score_set(scores)
-    else:
-      # just forward
-      if self.m_score_set == 'joint_likelihood':
-        probe_ = numpy.ndarray((n_probes, self.m_pca_machine.shape[1]), numpy.float64)
-        for i in range(n_probes):
-          probe_[i,:] = probes[i]
-        return model.forward(probe_)
-      # forward
-      else:
-        scores = [model.forward(probes[i]) for i in range(n_probes)]
-        return self.m_score_set(scores)
+    Using the 'joint_likelihood' strategy, the log-likelihood ratio of all probes being from the model identity is computed,
+    otherwise the scores of the single probes are fused using the fusion method specified in the constructor of this class."""
+    if self.m_score_set == 'joint_likelihood':
+      return self.m_log_likelihood_ratios.joint_score(model.n_samples, numpy.array(model.weighted_sum, numpy.float64), self.__project_probes__(probes))
+    return self.m_score_set(self.score_block([model], probes)[0])
+
+  def score_block_for_multiple_probes(self, models, probe_sets):
+    """Computes the scores of all given models and probe sets.
+    Unless the 'joint_likelihood' strategy is used, the log-likelihood ratios of all probes of all sets are computed with a single call to 'score_block' and fused per probe set."""
+    if self.m_score_set == 'joint_likelihood':
+      return Tool.score_block_for_multiple_probes(self, models, probe_sets)
+    scores = self.score_block(models, [probe for probes in probe_sets for probe in probes])
+    bounds = numpy.cumsum([0] + [len(probes) for probes in probe_sets])
+    return numpy.array([[self.m_score_set(scores[i, bounds[j] : bounds[j+1]]) for j in range(len(probe_sets))] for i in range(len(models))], numpy.float64).reshape((len(models), len(probe_sets)))
+
+  def score_block(self, models, probes):
+    """Computes the log-likelihood ratios of all given models and all given probes at once, projecting all probes through the PCA in a single matrix multiplication."""
+    return self.m_log_likelihood_ratios.scores(
+        [model.n_samples for model in models],
+        numpy.array([model.weighted_sum for model in models], numpy.float64),
+        self.__project_probes__(probes)
+    )
@@ -23,43 +23,101 @@ import argparse
 import bob
 import numpy
 from . import UBMGMM
-from .. import utils
+from .. import utils, trainers
 
 class ParallelUBMGMM():
-  
+  """Trains the UBM with full-batch K-Means and GMM EM, where the E-steps of each iteration are computed by a job array in the grid.
+  The mini-batch training of the UBMGMM tool (mini_batch_size) is not supported here:
+  each mini-batch update depends on the machine updated with the previous mini-batch, so the E-steps of the mini-batches cannot be computed by parallel jobs,
+  and one grid job per mini-batch would only add the scheduling overhead to a sequential training."""
+
   def __init__(self):
     pass
     
   def training_list(self):
     """Returns the list of feature files that is required for training"""
-    features = self.m_file_selector.training_list('features', 'train_projector')
-    if self.m_args.normalize_features:
-      return [f.replace(self.m_configuration.features_directory, self.m_configuration.normalized_directory) for f in features]
-    else:
-      return features
+    return self.m_file_selector.training_list('features', 'train_projector')
 
-    
-  def feature_normalization(self, indices, force=False):
-    """Normalizes the list of features to have zero mean and unit variance (parallel)"""
-    training_list = self.m_file_selector.training_list('features', 'train_projector')
-    normalized_list = self.training_list()
 
-    utils.info("UBM training: normalizing features from range(%d, %d)" % indices)
+  def __job_indices__(self, counts):
+    """Returns the index ranges of the training files that are processed by the jobs of a job array with the given number of files per job."""
+    training_list = self.training_list()
+    job_ids = range(self._generate_job_array(training_list, counts)[1])
+    return [(counts * job_id, min(counts * (job_id+1), len(training_list))) for job_id in job_ids]
 
-    # iterate through the files and normalize the features
-    for index in range(indices[0], indices[1]):
-      feature = self.m_extractor.read_feature(str(training_list[index]))
+  def __job_files__(self, file_pattern, counts, *prefix):
+    """Returns the list of files written by the jobs of a job array, which are specified by the given pattern (which might start with additional prefix parameters, e.g., the iteration)."""
+    training_list = self.training_list()
+    # try if there is one file containing all data
+    if os.path.exists(file_pattern % (prefix + (0, len(training_list)))):
+      return [file_pattern % (prefix + (0, len(training_list)))]
+    # otherwise, use the files of the job array
+    return [file_pattern % (prefix + indices) for indices in self.__job_indices__(counts)]
 
-      mean, std = self.m_tool.__normalize_std_array__(feature)
 
-      if self.m_tool_chain.__check_file__(normalized_list[index], force):
-        utils.debug("Skipping file '%s'" % normalized_list[index])
-      else:
-        utils.ensure_dir(os.path.dirname(normalized_list[index]))
-        f = bob.io.HDF5File(str(normalized_list[index]), 'w')
-        f.set('mean', mean)
-        f.set('std', std)
-        utils.debug("Saved normalized feature %s" %str(normalized_list[index]))
+  def feature_normalization(self, indices, force=False):
+    """Computes the statistics that are required to normalize the features to unit variance (parallel).
+    The statistics of all jobs are combined into one standard deviation in the (non-parallel) initialization steps."""
+    stats_file = self.m_configuration.normalization_stats_file % indices
+
+    if self.m_tool_chain.__check_file__(stats_file, force):
+      utils.info("UBM training: Skipping feature normalization since the file '%s' already exists" % stats_file)
+    else:
+      utils.info("UBM training: computing normalization statistics of features from range(%d, %d)" % indices)
+      training_list = self.training_list()
+
+      # iterate through the files and accumulate the number of feature vectors, their sum and their sum of squares
+      features = utils.streaming.LazyList(training_list[indices[0]:indices[1]], self.m_extractor.read_feature)
+      n, sum_x, sum_xx = utils.normalization.moments(features)
+
+      utils.ensure_dir(os.path.dirname(stats_file))
+      f = bob.io.HDF5File(stats_file, 'w')
+      f.set('n', float(n))
+      f.set('sum_x', sum_x)
+      f.set('sum_xx', sum_xx)
+      utils.info("UBM training: Wrote normalization statistics '%s'" % stats_file)
+
+
+  def __normalization__(self):
+    """Returns the standard deviation of the training features that is used to normalize them, or None if the features are not normalized.
+    The standard deviation is computed from the statistics of the 'feature_normalization' jobs and stored, so that it is computed only once."""
+    if not self.m_args.normalize_features:
+      return None
+    if os.path.exists(self.m_configuration.normalization_file):
+      return bob.io.HDF5File(self.m_configuration.normalization_file).read('std')
+
+    n = 0.
+    sum_x = sum_xx = 0.
+    for stats_file in self.__job_files__(self.m_configuration.normalization_stats_file, self.m_grid.number_of_projected_features_per_job):
+      f = bob.io.HDF5File(stats_file)
+      n += f.read('n')
+      sum_x += f.read('sum_x')
+      sum_xx += f.read('sum_xx')
+    return utils.normalization.standard_deviation(n, sum_x, sum_xx)
+
+  def __save_normalization__(self):
+    """Computes and writes the standard deviation used for normalization, if required; this is done in the (non-parallel) initialization steps."""
+    std = self.__normalization__()
+    if std is not None and not os.path.exists(self.m_configuration.normalization_file):
+      utils.ensure_dir(os.path.dirname(self.m_configuration.normalization_file))
+      bob.io.HDF5File(self.m_configuration.normalization_file, 'w').set('std', std)
+      utils.info("UBM training: Wrote feature normalization '%s'" % self.m_configuration.normalization_file)
+    return std
+
+
+  def __read_training_data__(self, indices, dtype = numpy.float64):
+    """Reads the training features with the given indices and normalizes them in place, if desired."""
+    training_list = self.training_list()
+    data = numpy.vstack([self.m_extractor.read_feature(str(training_list[index])) for index in indices])
+    std = self.__normalization__()
+    if std is not None:
+      return utils.normalization.normalize_std_array(data, std, in_place = True, dtype = dtype)[0]
+    return numpy.asarray(data, dtype)
+
+
+  def __read_training_feature__(self, index):
+    """Reads the (normalized) training feature with the given index."""
+    return self.__read_training_data__([int(index)])
 
 
   def kmeans_initialize(self, force=False):
@@ -69,22 +127,83 @@ class ParallelUBMGMM():
     if self.m_tool_chain.__check_file__(output_file, force, 1000):
       utils.info("UBM training: Skipping KMeans initialization since the file '%s' already exists" % output_file)
     else:
-      # read data
+      # a new training is started, so the normalization and the training data cache of a previous training are outdated
+      if force:
+        if os.path.exists(self.m_configuration.normalization_file):
+          os.remove(self.m_configuration.normalization_file)
+        self.__clean_training_cache__()
+      self.__save_normalization__()
+
+      if self.m_tool.m_mini_batch_size:
+        utils.warn("UBM training: the mini-batch training is not supported in the grid; the UBM is trained with full-batch EM")
       utils.info("UBM training: initializing kmeans")
       training_list = self.training_list()
-      data = numpy.vstack([self.m_extractor.read_feature(str(training_list[index])) for index in utils.quasi_random_indices(len(training_list), self.m_args.limit_training_examples)])
-
-      # Perform KMeans initialization
-      kmeans_machine = bob.machine.KMeansMachine(self.m_tool.m_gaussians, data.shape[1])
-      # Creates the KMeansTrainer and call the initialization procedure
-      kmeans_trainer = bob.trainer.KMeansTrainer()
-      kmeans_trainer.initialize(kmeans_machine, data)
+      indices = utils.quasi_random_indices(len(training_list), self.m_args.limit_training_examples)
       utils.ensure_dir(os.path.dirname(output_file))
-      kmeans_machine.save(bob.io.HDF5File(output_file, 'w'))
+
+      if self.m_tool.m_k_means_initialization == 'k-means++':
+        # k-means++ seeding on a random subset of the training data, which is sampled while reading the files one after the other
+        kmeans_trainer = trainers.KMeans(self.m_tool.m_gaussians, seed = self.m_tool.m_init_seed, initialization = 'k-means++')
+        kmeans_trainer.save_machine(kmeans_trainer.initialize(utils.streaming.LazyList(indices, self.__read_training_feature__)), output_file)
+      else:
+        # read data
+        data = self.__read_training_data__(indices)
+
+        # Perform KMeans initialization
+        kmeans_machine = bob.machine.KMeansMachine(self.m_tool.m_gaussians, data.shape[1])
+        # Creates the KMeansTrainer and call the initialization procedure
+        kmeans_trainer = bob.trainer.KMeansTrainer()
+        kmeans_trainer.initialize(kmeans_machine, data)
+        kmeans_machine.save(bob.io.HDF5File(output_file, 'w'))
       utils.info("UBM training: saved initial KMeans machine to '%s'" % output_file)
 
 
 
+  def __kmeans_trainer__(self):
+    """Returns the map-reduce trainer for the K-Means E- and M-steps."""
+    return trainers.KMeans(self.m_tool.m_gaussians)
+
+  def __gmm_trainer__(self):
+    """Returns the map-reduce trainer for the GMM E- and M-steps."""
+    return trainers.GMM(
+        self.m_tool.m_gaussians,
+        variance_threshold = self.m_tool.m_variance_threshold,
+        update_weights = self.m_tool.m_update_weights,
+        update_means = self.m_tool.m_update_means,
+        update_variances = self.m_tool.m_update_variances,
+        responsibility_threshold = self.m_tool.m_responsibility_threshold)
+
+  def __training_chunk__(self, indices):
+    """Returns the (normalized) training data of the features in the given index range.
+    In the first iteration, the data is read from the feature files and written into a cache file.
+    Later iterations attach to the memory-mapped cache file, so that the feature files do not need to be read and stacked again."""
+    cache_file = self.m_configuration.training_cache_file % indices
+    if os.path.exists(cache_file):
+      utils.debug("UBM training: Using cached training data '%s'" % cache_file)
+      return numpy.load(cache_file, mmap_mode = 'r')
+
+    data = self.__read_training_data__(range(indices[0], indices[1]), self.m_args.training_cache_dtype)
+    # write to a temporary file first, so that parallel or aborted jobs never see incomplete cache files
+    utils.ensure_dir(os.path.dirname(cache_file))
+    temp_file = cache_file + '.%d.tmp' % os.getpid()
+    with open(temp_file, 'wb') as f:
+      numpy.save(f, data)
+    os.rename(temp_file, cache_file)
+    utils.info("UBM training: Wrote training data cache '%s'" % cache_file)
+    return data
+
+  def __stats_files__(self, stats_file_pattern, counts):
+    """Returns the list of statistics files written by the E-step jobs of the current iteration."""
+    return self.__job_files__(stats_file_pattern, counts, self.m_args.iteration)
+
+  def __clean_training_cache__(self):
+    """Removes the cached training data."""
+    cache_directory = os.path.dirname(self.m_configuration.training_cache_file)
+    if os.path.exists(cache_directory):
+      utils.info("Removing training data cache directory '%s'" % cache_directory)
+      shutil.rmtree(cache_directory)
+
+
   def kmeans_estep(self, indices, force=False):
     """Performs a single E-step of the K-Means algorithm (parallel)"""
     stats_file = self.m_configuration.kmeans_stats_file % (self.m_args.iteration, indices[0], indices[1])
@@ -92,48 +211,15 @@ class ParallelUBMGMM():
     if  self.m_tool_chain.__check_file__(stats_file, force, 1000):
       utils.info("UBM training: Skipping KMeans E-Step since the file '%s' already exists" % stats_file)
     else:
-      training_list = self.training_list()
       machine_file = self.m_configuration.kmeans_intermediate_file % self.m_args.iteration
-      kmeans_machine = bob.machine.KMeansMachine(bob.io.HDF5File(machine_file))
-
       utils.info("UBM training: KMeans E-Step from range(%d, %d)" % indices)
 
-      # read data
-      data = numpy.vstack([self.m_extractor.read_feature(str(training_list[index])) for index in range(indices[0], indices[1])])
-
-      kmeans_trainer = bob.trainer.KMeansTrainer()
-      t = bob.machine.KMeansMachine(self.m_tool.m_gaussians, data.shape[1]) # Temporary Kmeans machine required for trainer initialization
-      kmeans_trainer.initialize(t, data)
-
-      # Performs the E-step
-      kmeans_trainer.e_step(kmeans_machine, data)
-
-      # write results to file
-      dist = numpy.array([kmeans_trainer.average_min_distance])
-      nsamples = numpy.array([indices[1] - indices[0]], dtype=numpy.float64)
-
-      utils.ensure_dir(os.path.dirname(stats_file))
-      f = bob.io.HDF5File(stats_file, 'w')
-      f.set('zeros', kmeans_trainer.zeroeth_order_statistics)
-      f.set('first', kmeans_trainer.first_order_statistics)
-      f.set('dist', dist * nsamples)
-      f.set('nsamples', nsamples)
+      # Performs the E-step and writes the statistics
+      self.__kmeans_trainer__().map_to_file(machine_file, self.__training_chunk__(indices), stats_file)
       utils.info("UBM training: Wrote Stats file '%s'" % stats_file)
 
 
 
-  def read_stats(self, filename):
-    """Reads accumulated K-Means statistics from file"""
-    utils.debug("UBM training: Reading stats file '%s'" % filename)
-    f = bob.io.HDF5File(filename)
-    zeroeth  = f.read('zeros')
-    first    = f.read('first')
-    nsamples = f.read('nsamples')
-    dist     = f.read('dist')
-    return (zeroeth, first, nsamples, dist)
-
-
-
   def kmeans_mstep(self, counts, force=False):
     """Performs a single M-step of the K-Means algorithm (non-parallel)"""
     old_machine_file = self.m_configuration.kmeans_intermediate_file % self.m_args.iteration
@@ -142,49 +228,12 @@ class ParallelUBMGMM():
     if  self.m_tool_chain.__check_file__(new_machine_file, force, 1000):
       utils.info("UBM training: Skipping KMeans M-Step since the file '%s' already exists" % new_machine_file)
     else:
-      # get the files from e-step
-      training_list = self.training_list()
-
-      # try if there is one file containing all data
-      if os.path.exists(self.m_configuration.kmeans_stats_file % (self.m_args.iteration, 0, len(training_list))):
-        stats_file = self.m_configuration.kmeans_stats_file % (self.m_args.iteration, 0, len(training_list))
-        # load stats file
-        zeroeth, first, nsamples, dist = self.read_stats(stats_file)
-      else:
-        # load several files
-        job_ids = range(self.__generate_job_array__(training_list, counts)[1])
-        job_indices = [(counts * job_id, min(counts * (job_id+1), len(training_list))) for job_id in job_ids]
-        stats_files = [self.m_configuration.kmeans_stats_file % (self.m_args.iteration, indices[0], indices[1]) for indices in job_indices]
-
-        # read all stats files
-        zeroeth, first, nsamples, dist = self.read_stats(stats_files[0])
-        for stats_file in stats_files[1:]:
-          zeroeth_, first_, nsamples_, dist_ = self.read_stats(stats_file)
-          zeroeth += zeroeth_
-          first += first_
-          nsamples += nsamples_
-          dist += dist_
-
-      # read some features (needed for computation, but not really required)
-      data = numpy.array(self.m_extractor.read_feature(str(training_list[0])))
-
-      # Creates the KMeansTrainer
-      kmeans_trainer = bob.trainer.KMeansTrainer()
-      # Creates the KMeansMachine
-      kmeans_machine = bob.machine.KMeansMachine(bob.io.HDF5File(old_machine_file))
-      kmeans_trainer.initialize(kmeans_machine, data)
-
-      kmeans_trainer.zeroeth_order_statistics = zeroeth
-      kmeans_trainer.first_order_statistics = first
-      kmeans_trainer.average_min_distance = dist
-
-      # Performs the M-step
-      kmeans_trainer.m_step(kmeans_machine, data) # data is not used in M-step
-      utils.info("UBM training: Performed M step %d with result %f" % (self.m_args.iteration, dist/nsamples))
+      # reduce the statistics of the E-step jobs and perform the M-step
+      stats_files = self.__stats_files__(self.m_configuration.kmeans_stats_file, counts)
+      average_distance = self.__kmeans_trainer__().reduce_files(old_machine_file, stats_files, new_machine_file)
+      utils.info("UBM training: Performed M step %d with result %f" % (self.m_args.iteration, average_distance))
 
       # Save the K-Means model
-      utils.ensure_dir(os.path.dirname(new_machine_file))
-      kmeans_machine.save(bob.io.HDF5File(new_machine_file, 'w'))
       shutil.copy(new_machine_file, self.m_configuration.kmeans_file)
       utils.info("UBM training: Wrote new KMeans machine '%s'" % new_machine_file)
 
@@ -210,7 +259,8 @@ class ParallelUBMGMM():
       kmeans_machine = bob.machine.KMeansMachine(bob.io.HDF5File(self.m_configuration.kmeans_file))
 
       # read features
-      data = numpy.vstack([self.m_extractor.read_feature(str(training_list[index])) for index in utils.quasi_random_indices(len(training_list), self.m_args.limit_training_examples)])
+      std = self.__save_normalization__()
+      data = self.__read_training_data__(utils.quasi_random_indices(len(training_list), self.m_args.limit_training_examples))
 
       # Create initial GMM Machine
       gmm_machine = bob.machine.GMMMachine(self.m_tool.m_gaussians, data.shape[1])
@@ -221,7 +271,11 @@ class ParallelUBMGMM():
       gmm_machine.means = kmeans_machine.means
       gmm_machine.variances = variances
       gmm_machine.weights = weights
-      gmm_machine.set_variance_thresholds(self.m_tool.m_variance_threshold)
+      if std is None:
+        gmm_machine.set_variance_thresholds(self.m_tool.m_variance_threshold)
+      else:
+        # the GMM is trained on the normalized data; the variance thresholds are normalized accordingly
+        gmm_machine.set_variance_thresholds(self.m_tool.m_variance_threshold / std ** 2)
 
       utils.ensure_dir(os.path.dirname(output_file))
       gmm_machine.save(bob.io.HDF5File(os.path.join(output_file), 'w'))
@@ -235,26 +289,11 @@ class ParallelUBMGMM():
     if  self.m_tool_chain.__check_file__(stats_file, force, 1000):
       utils.info("UBM training: Skipping GMM E-Step since the file '%s' already exists" % stats_file)
     else:
-      training_list = self.training_list()
       machine_file = self.m_configuration.gmm_intermediate_file % self.m_args.iteration
-      gmm_machine = bob.machine.GMMMachine(bob.io.HDF5File(machine_file))
-
       utils.info("UBM training: GMM E-Step from range(%d, %d)" % indices)
 
-      # read data
-      data = numpy.vstack([self.m_extractor.read_feature(str(training_list[index])) for index in range(indices[0], indices[1])])
-
-      gmm_trainer = bob.trainer.ML_GMMTrainer(self.m_tool.m_update_means, self.m_tool.m_update_variances, self.m_tool.m_update_weights)
-      gmm_trainer.responsibilities_threshold = self.m_tool.m_responsibility_threshold
-      gmm_trainer.initialize(gmm_machine, data)
-
-      # Calls the E-step and extracts the GMM statistics
-      gmm_trainer.e_step(gmm_machine, data)
-      gmm_stats = gmm_trainer.gmm_statistics
-
-      # Saves the GMM statistics to the file
-      utils.ensure_dir(os.path.dirname(stats_file))
-      gmm_stats.save(bob.io.HDF5File(stats_file, 'w'))
+      # Calls the E-step and writes the GMM statistics
+      self.__gmm_trainer__().map_to_file(machine_file, self.__training_chunk__(indices), stats_file)
       utils.info("UBM training: Wrote GMM stats '%s'" % (stats_file))
 
 
@@ -266,49 +305,30 @@ class ParallelUBMGMM():
     if  self.m_tool_chain.__check_file__(new_machine_file, force, 1000):
       utils.info("UBM training: Skipping GMM M-Step since the file '%s' already exists" % new_machine_file)
     else:
-      # get the files from e-step
-      training_list = self.training_list()
-
-      # try if there is one file containing all data
-      if os.path.exists(self.m_configuration.gmm_stats_file % (self.m_args.iteration, 0, len(training_list))):
-        stats_file = self.m_configuration.gmm_stats_file % (self.m_args.iteration, 0, len(training_list))
-        # load stats file
-        gmm_stats = bob.machine.GMMStats(bob.io.HDF5File(stats_file))
+      # reduce the statistics of the E-step jobs and perform the M-step
+      stats_files = self.__stats_files__(self.m_configuration.gmm_stats_file, counts)
+      log_likelihood = self.__gmm_trainer__().reduce_files(old_machine_file, stats_files, new_machine_file)
+      utils.info("UBM training: Performed M step %d with average log-likelihood %f" % (self.m_args.iteration, log_likelihood))
+
+      # Saves the GMM to the file
+      std = self.__normalization__()
+      if std is None:
+        shutil.copy(new_machine_file, self.m_tool.m_gmm_filename)
       else:
-        # load several files
-        job_ids = range(self.__generate_job_array__(training_list, counts)[1])
-        job_indices = [(counts * job_id, min(counts * (job_id+1), len(training_list))) for job_id in job_ids]
-        stats_files = [self.m_configuration.gmm_stats_file % (self.m_args.iteration, indices[0], indices[1]) for indices in job_indices]
-
-        # read all stats files
-        gmm_stats = bob.machine.GMMStats(bob.io.HDF5File(stats_files[0]))
-        for stats_file in stats_files[1:]:
-          gmm_stats += bob.machine.GMMStats(bob.io.HDF5File(stats_file))
-
-      # read some features (needed for computation, but not really required)
-      data = numpy.array(self.m_extractor.read_feature(str(training_list[0])))
-
-      # load the old gmm machine
-      gmm_machine =  bob.machine.GMMMachine(bob.io.HDF5File(old_machine_file))
-      # initialize the trainer
-      gmm_trainer = bob.trainer.ML_GMMTrainer(self.m_tool.m_update_means, self.m_tool.m_update_variances, self.m_tool.m_update_weights)
-      gmm_trainer.responsibilities_threshold = self.m_tool.m_responsibility_threshold
-      gmm_trainer.initialize(gmm_machine, data)
-      gmm_trainer.gmm_statistics = gmm_stats
-
-      # Calls M-step
-      gmm_trainer.m_step(gmm_machine, data)
-
-      # Saves the GMM statistics to the file
-      utils.ensure_dir(os.path.dirname(new_machine_file))
-      gmm_machine.save(bob.io.HDF5File(new_machine_file, 'w'))
-      import shutil
-      shutil.copy(new_machine_file, self.m_tool.m_gmm_filename)
+        # undo the normalization of the GMM parameters
+        gmm_trainer = self.__gmm_trainer__()
+        machine = gmm_trainer.load_machine(new_machine_file)
+        machine['means'] *= std
+        machine['variances'] *= std ** 2
+        machine['variance_thresholds'] *= std ** 2
+        gmm_trainer.save_machine(machine, self.m_tool.m_gmm_filename)
 
     if self.m_args.clean_intermediate and self.m_args.iteration > 0:
       old_file = self.m_configuration.gmm_intermediate_file % (self.m_args.iteration-1)
       utils.info("Removing old intermediate directory '%s'" % os.path.dirname(old_file))
       shutil.rmtree(os.path.dirname(old_file))
+    if self.m_args.clean_intermediate and self.m_args.iteration == self.m_args.gmm_training_iterations - 1:
+      self.__clean_training_cache__()
 
 
   def gmm_project(self, indices, force=False):
@@ -34,6 +34,8 @@ class Tool:
       split_training_features_by_client = False, # enable if your projector training needs the training files sorted by client
       use_projected_features_for_enrollment = True, # by default, the enroller used projected features for enrollment, if projection is enabled.
       requires_enroller_training = False, # enable if your enroller needs training
+      stream_training_features = False, # enable if your projector and enroller training can process the training features one after the other, which are then read from file only when they are accessed
+      block_scoring = False, # enable if your tool overwrites 'score_block' to compute the scores of many models and probes at once
 
       multiple_model_scoring = 'average', # by default, compute the average between several models and the probe
       multiple_probe_scoring = 'average', # by default, compute the average between the model and several probes
@@ -50,6 +52,8 @@ class Tool:
     self.split_training_features_by_client = split_training_features_by_client
     self.use_projected_features_for_enrollment = performs_projection and use_projected_features_for_enrollment
     self.requires_enroller_training = requires_enroller_training
+    self.stream_training_features = stream_training_features
+    self.block_scoring = block_scoring
     self.m_model_fusion_function = utils.score_fusion_strategy(multiple_model_scoring)
     self.m_probe_fusion_function = utils.score_fusion_strategy(multiple_probe_scoring)
     self._kwargs = kwargs
@@ -103,6 +107,40 @@ class Tool:
   ### Special functions that might be overwritten on need
   ############################################################
 
+  def score_block(self, models, probes):
+    """This function computes the scores between all given models and all given probes, and returns them as a 2D numpy.ndarray (models x probes).
+    In this base class implementation, the scores are computed pair by pair using the 'score' function.
+    Derived classes that can compute the scores more efficiently at once (e.g. using a single matrix multiplication)
+    should overwrite this function and enable block_scoring in the constructor, so that the ToolChain uses it to score batches of models.
+    """
+    scores = numpy.ndarray((len(models), len(probes)), numpy.float64)
+    for i, model in enumerate(models):
+      for j, probe in enumerate(probes):
+        scores[i,j] = self.score(model, probe)
+    return scores
+
+  def score_block_for_multiple_probes(self, models, probe_sets):
+    """This function computes the scores between all given models and all given probe file sets, and returns them as a 2D numpy.ndarray (models x probe sets).
+    It is used by the ToolChain instead of 'score_block', when block_scoring is enabled and the database uses probe file sets.
+    In this base class implementation, the scores are computed pair by pair using the 'score_for_multiple_probes' function.
+    """
+    scores = numpy.ndarray((len(models), len(probe_sets)), numpy.float64)
+    for i, model in enumerate(models):
+      for j, probes in enumerate(probe_sets):
+        scores[i,j] = self.score_for_multiple_probes(model, probes)
+    return scores
+
+
+  def project_batch(self, features):
+    """Projects all given features and returns an iterable of projected features.
+    In this base class implementation, the features are projected one by one using the 'project' function, when they are requested.
+    Since 'project' might return the same buffer for each feature, each projected feature must be used (e.g. written) before the next one is requested.
+    Derived classes might overwrite this function to project all features at once.
+    """
+    for feature in features:
+      yield self.project(feature)
+
+
   def save_feature(self, feature, feature_file):
     """Saves the given *projected* feature to a file with the given name.
     In this base class implementation:
@@ -192,6 +230,16 @@ class Tool:
     pass
 
 
+  def load_shared_projector(self, projector_file):
+    """Loads the parameters required for feature projection from file,
+    such that large parameter arrays are shared (read-only) between all processes that load the same projector file.
+    This function is called instead of 'load_projector' when sharing of machines is enabled.
+    In this base class implementation, it simply calls 'load_projector'.
+    Derived classes might use the functions in facereclib.utils.shared to implement this function.
+    """
+    self.load_projector(projector_file)
+
+
   def train_enroller(self, training_features, enroller_file):
     """This function can be overwritten to train the model enroller.
     If you do this, please also register the function by calling this base class constructor
@@ -211,3 +259,12 @@ class Tool:
     In this base class implementation, it does nothing.
     """
     pass
+
+
+  def load_shared_enroller(self, enroller_file):
+    """Loads the parameters required for model enrollment from file,
+    such that large parameter arrays are shared (read-only) between all processes that load the same enroller file.
+    This function is called instead of 'load_enroller' when sharing of machines is enabled.
+    In this base class implementation, it simply calls 'load_enroller'.
+    """
+    self.load_enroller(enroller_file)
@@ -4,9 +4,13 @@
 
 import bob
 import numpy
+import os
+import glob
+import shutil
+import tempfile
 
 from .Tool import Tool
-from .. import utils
+from .. import utils, trainers
 
 class UBMGMM (Tool):
   """Tool for computing Universal Background Models and Gaussian Mixture Models of the features"""
@@ -24,11 +28,19 @@ class UBMGMM (Tool):
       update_means = True,
       update_variances = True,
       normalize_before_k_means = True,  # Normalize the input features before running K-Means
+      k_means_initialization = 'random', # The initialization of K-Means: 'random' samples, or 'k-means++' seeding on a random subset of the training data
+      training_threads = 1,              # If greater than 1, the E-steps of K-Means and GMM training are computed on chunks of the training data using this number of threads
+      mini_batch_size = None,            # If given, K-Means and GMM are trained with stepwise (online) EM on mini-batches of this number of feature vectors, which are read from file one at a time
+      mini_batch_passes = 2,             # The number of passes over the training data in the mini-batch training
+      mini_batch_check_interval = 10,    # The number of mini-batches after which the average distance or log-likelihood of all training data is computed to check for convergence
+      checkpoint_interval = None,        # If given, the K-Means, GMM (and ISV, JFA or total variability) trainings write their machine every this number of iterations next to the projector (or enroller) file, and a restarted training resumes from there
       # parameters of the GMM enrollment
       relevance_factor = 4,         # Relevance factor as described in Reynolds paper
       gmm_enroll_iterations = 1,    # Number of iterations for the enrollment phase
       responsibility_threshold = 0, # If set, the weight of a particular Gaussian will at least be greater than this threshold. In the case the real weight is lower, the prior mean value will be used to estimate the current mean and variance.
       INIT_SEED = 5489,
+      # parameters of the projection
+      top_k_gaussians = None,       # If given, each feature vector contributes only to the GMM statistics of this number of Gaussians with the highest responsibilities, and the statistics are stored sparsely
       # scoring
       scoring_function = bob.machine.linear_scoring
   ):
@@ -49,14 +61,24 @@ class UBMGMM (Tool):
         update_means = update_means,
         update_variances = update_variances,
         normalize_before_k_means = normalize_before_k_means,
+        k_means_initialization = k_means_initialization,
+        training_threads = training_threads,
+        mini_batch_size = mini_batch_size,
+        mini_batch_passes = mini_batch_passes,
+        mini_batch_check_interval = mini_batch_check_interval,
+        checkpoint_interval = checkpoint_interval,
         relevance_factor = relevance_factor,
         gmm_enroll_iterations = gmm_enroll_iterations,
         responsibility_threshold = responsibility_threshold,
         INIT_SEED = INIT_SEED,
+        top_k_gaussians = top_k_gaussians,
         scoring_function = str(scoring_function),
 
         multiple_model_scoring = None,
-        multiple_probe_scoring = 'average'
+        multiple_probe_scoring = 'average',
+        # the mini-batches are read from file only when they are accessed
+        stream_training_features = mini_batch_size is not None,
+        block_scoring = True
     )
 
     # copy parameters
@@ -69,70 +91,232 @@ class UBMGMM (Tool):
     self.m_update_means = update_means
     self.m_update_variances = update_variances
     self.m_normalize_before_k_means = normalize_before_k_means
+    self.m_k_means_initialization = k_means_initialization
+    self.m_training_threads = training_threads
+    self.m_mini_batch_size = mini_batch_size
+    self.m_mini_batch_passes = mini_batch_passes
+    self.m_mini_batch_check_interval = mini_batch_check_interval
+    self.m_checkpoint_interval = checkpoint_interval
+    # the projector or enroller file that is currently trained, see __start_checkpoints__
+    self.m_checkpoint_prefix = None
+    # the projector and enroller files that were attached to shared arrays, see load_shared_projector
+    self.m_shared_projector_file = None
+    self.m_shared_enroller_file = None
     self.m_relevance_factor = relevance_factor
     self.m_gmm_enroll_iterations = gmm_enroll_iterations
     self.m_init_seed = INIT_SEED
     self.m_responsibility_threshold = responsibility_threshold
+    self.m_top_k_gaussians = top_k_gaussians
     self.m_scoring_function = scoring_function
     
 
 
   #######################################################
   ################ UBM training #########################
-  def __normalize_std_array__(self, array):
-    """Applies a unit variance normalization to an array"""
 
-    # Initializes variables
-    n_samples = array.shape[0]
-    length = array.shape[1]
-    mean = numpy.ndarray((length,), 'float64')
-    std = numpy.ndarray((length,), 'float64')
-
-    mean.fill(0)
-    std.fill(0)
-
-    # Computes mean and variance
-    for k in range(n_samples):
-      x = array[k,:].astype('float64')
-      mean += x
-      std += (x ** 2)
-
-    mean /= n_samples
-    std /= n_samples
-    std -= (mean ** 2)
-    std = std ** 0.5 # sqrt(std)
-
-    ar_std_list = []
-    for k in range(n_samples):
-      ar_std_list.append(array[k,:].astype('float64') / std)
-    ar_std = numpy.vstack(ar_std_list)
+  def __split_array__(self, array, maximum_chunk_size = 10000):
+    """Splits the given array into chunks (views) for the parallel or mini-batch training.
+    For the parallel training, each thread gets at least one chunk and the chunks are not too large.
+    For the mini-batch training, the chunks are the mini-batches."""
+    if self.m_mini_batch_size:
+      maximum_chunk_size = self.m_mini_batch_size
+    number_of_chunks = max(self.m_training_threads, int(numpy.ceil(array.shape[0] / float(maximum_chunk_size))))
+    return numpy.array_split(array, number_of_chunks)
+
+  def __split_features__(self, features):
+    """Splits the given list (or LazyList) of features into the mini-batches of the mini-batch training.
+    Each mini-batch contains consecutive features of about m_mini_batch_size feature vectors in total, where the number of feature vectors per feature is estimated from the first feature.
+    The mini-batches of a LazyList are LazyLists, so that only one of them needs to be in memory at a time."""
+    if not len(features):
+      return []
+    features_per_batch = max(1, int(round(self.m_mini_batch_size / float(len(features[0])))))
+    return utils.streaming.split(features, features_per_batch)
+
+  def __split_list__(self, items):
+    """Splits the given list (e.g. of clients or of GMM statistics) into one contiguous chunk per training thread for the parallel training of the subspaces."""
+    number_of_chunks = min(self.m_training_threads, len(items))
+    bounds = numpy.linspace(0, len(items), number_of_chunks + 1).astype(int)
+    return [items[bounds[i] : bounds[i+1]] for i in range(number_of_chunks)]
+
+  def __start_checkpoints__(self, machine_file):
+    """Registers the projector or enroller file that is trained next; the checkpoints of the trainings are written next to it."""
+    self.m_checkpoint_prefix = os.path.splitext(machine_file)[0]
+
+  def __checkpoint_file__(self, stage):
+    """Returns the checkpoint file of the given training stage (e.g. 'kmeans' or 'gmm'), or None if no checkpoints are written."""
+    if not self.m_checkpoint_interval or self.m_checkpoint_prefix is None:
+      return None
+    return "%s_%s_checkpoint.hdf5" % (self.m_checkpoint_prefix, stage)
+
+  def __remove_checkpoints__(self):
+    """Removes the checkpoints of all training stages after the projector or enroller file has been written."""
+    if self.m_checkpoint_prefix is not None:
+      for filename in glob.glob(self.m_checkpoint_prefix + "_*_checkpoint.hdf5*"):
+        os.remove(filename)
+    self.m_checkpoint_prefix = None
+
+  def __train_em_with_checkpoints__(self, stage, trainer, machine, data, number_of_iterations, subspaces, latent_variables, parameters, step = ''):
+    """Executes the EM iterations of the given bob trainer (e.g. a bob.trainer.ISVTrainer) one by one, so that the exact bob training can be checkpointed; the trainer needs to be initialized already.
+    The steps 'e_step<step>' and 'm_step<step>' of the trainer are used, e.g., step '1' trains the V subspace with the bob.trainer.JFATrainer.
+    Every m_checkpoint_interval iterations and after the last iteration, the given subspaces of the machine (e.g. 'u' and 'd') and the given latent variables of the trainer (e.g. '__X__' and '__Z__') are written to the checkpoint file of the given stage.
+    If this file exists and was written by a training with the same parameters, the training resumes after the stored number of iterations."""
+    e_step, m_step = getattr(trainer, 'e_step' + step), getattr(trainer, 'm_step' + step)
+    checkpoint_file = self.__checkpoint_file__(stage)
+    fingerprint = "%s%s with %s on %d training items" % (trainer.__class__.__name__, parameters, ", ".join("%s%s" % (name, getattr(machine, name).shape) for name in subspaces), len(data))
+    first_iteration = 0
+    if os.path.exists(checkpoint_file):
+      hdf5file = bob.io.HDF5File(checkpoint_file)
+      if not hdf5file.has_key('fingerprint') or hdf5file.read('fingerprint') != fingerprint:
+        utils.warn("Ignoring checkpoint '%s', which was written by a training with different parameters" % checkpoint_file)
+      else:
+        first_iteration = int(hdf5file.read('iteration'))
+        for name in subspaces:
+          setattr(machine, name, hdf5file.read(name))
+        for name in latent_variables:
+          setattr(trainer, name, [hdf5file.read('%s_%d' % (name.strip('_'), index)) for index in range(len(data))])
+        utils.info("  -> Resuming %s training after %d iterations from checkpoint '%s'" % (stage, first_iteration, checkpoint_file))
+
+    for iteration in range(first_iteration, number_of_iterations):
+      e_step(machine, data)
+      m_step(machine, data)
+      utils.debug("  -> Iteration %d of %s training" % (iteration + 1, stage))
+      if (iteration + 1) % self.m_checkpoint_interval == 0 or iteration + 1 == number_of_iterations:
+        # write to a temporary file first, so that a job that is killed while writing does not destroy the previous checkpoint
+        hdf5file = bob.io.HDF5File(checkpoint_file + '.tmp', 'w')
+        hdf5file.set('iteration', iteration + 1)
+        hdf5file.set('fingerprint', fingerprint)
+        for name in subspaces:
+          hdf5file.set(name, getattr(machine, name))
+        for name in latent_variables:
+          for index, value in enumerate(getattr(trainer, name)):
+            hdf5file.set('%s_%d' % (name.strip('_'), index), value)
+        del hdf5file
+        os.rename(checkpoint_file + '.tmp', checkpoint_file)
+
+  def __train__(self, trainer, chunks, machine = None, stage = None):
+    """Trains the given map-reduce trainer either with full-batch EM using several threads, or with mini-batch EM.
+    The full-batch training of the given stage is checkpointed, if desired."""
+    if self.m_mini_batch_size:
+      return trainer.train_mini_batch(chunks, self.m_mini_batch_passes, check_interval = self.m_mini_batch_check_interval, machine = machine, parallel = self.m_training_threads, seed = self.m_init_seed)
+    return trainer.train(chunks, parallel = self.m_training_threads, machine = machine, use_threads = True, checkpoint_file = self.__checkpoint_file__(stage), checkpoint_interval = self.m_checkpoint_interval)
+
+
+  def __kmeans_trainer__(self):
+    """Returns the map-reduce trainer for the K-Means."""
+    return trainers.KMeans(self.m_gaussians, self.m_k_means_training_iterations, self.m_training_threshold, seed = self.m_init_seed, initialization = self.m_k_means_initialization)
+
+  def __gmm_trainer__(self):
+    """Returns the map-reduce trainer for the ML GMM training."""
+    return trainers.GMM(
+        self.m_gaussians,
+        number_of_iterations = self.m_gmm_training_iterations,
+        convergence_threshold = self.m_training_threshold,
+        variance_threshold = self.m_variance_threshold,
+        update_weights = self.m_update_weights,
+        update_means = self.m_update_means,
+        update_variances = self.m_update_variances)
+
+
+  def _train_projector_using_trainers(self, array):
+    """Trains the UBM with K-Means and ML GMM training using the map-reduce trainers,
+    where the E-steps are computed on several threads, or on mini-batches."""
+    utils.debug(" .... Training with %d feature vectors using %d threads" % (array.shape[0], self.m_training_threads))
+
+    # Normalizes the array in place if required; the normalization is undone after the K-Means training
+    if self.m_normalize_before_k_means:
+      array, std_array = utils.normalization.normalize_std_array(array, in_place = True, dtype = numpy.float64)
+    normalized_chunks = self.__split_array__(array)
 
-    return (ar_std,std)
+    # Trains the K-Means
+    utils.info("  -> Training K-Means")
+    means = self.__train__(self.__kmeans_trainer__(), normalized_chunks, stage = 'kmeans')
 
+    # Initializes the GMM with the means, variances and weights of the K-Means clusters
+    gmm_trainer = self.__gmm_trainer__()
+    machine = gmm_trainer.initialize_from_means(means, normalized_chunks)
+    del normalized_chunks
 
-  def __multiply_vectors_by_factors__(self, matrix, vector):
-    """Used to unnormalize some data"""
-    for i in range(0, matrix.shape[0]):
-      for j in range(0, matrix.shape[1]):
-        matrix[i, j] *= vector[j]
+    # Undoes the normalization
+    if self.m_normalize_before_k_means:
+      utils.normalization.multiply_by_factors(array, std_array)
+      machine['means'] *= std_array
+      machine['variances'] = numpy.maximum(machine['variances'] * std_array ** 2, machine['variance_thresholds'])
 
+    # Trains the GMM
+    utils.info("  -> Training GMM")
+    machine = self.__train__(gmm_trainer, self.__split_array__(array), machine, stage = 'gmm')
+    self.m_ubm = gmm_trainer.bob_machine(machine)
+
+
+  def __cache_chunks__(self, chunks, cache_directory):
+    """Reads and stacks each of the given chunks once, writes it to an .npy file in the given directory and returns the list of the memory-mapped arrays of these files."""
+    cached_chunks = []
+    for index, chunk in enumerate(chunks):
+      cache_file = os.path.join(cache_directory, "chunk_%05d.npy" % index)
+      numpy.save(cache_file, numpy.asarray(numpy.vstack(chunk), numpy.float64))
+      cached_chunks.append(numpy.load(cache_file, mmap_mode = 'r'))
+    return cached_chunks
+
+  def _train_projector_using_chunks(self, chunks):
+    """Trains the UBM with K-Means and ML GMM training using the map-reduce trainers on the given list of chunks, each of which is a list of 2D arrays of feature vectors.
+    The chunks might read the features from file only when they are accessed (see utils.streaming.LazyList), so that the training data is never stacked into one array.
+    Instead, each chunk is read and stacked only once and cached in a memory-mapped file next to the projector (or enroller) file, which is used in all iterations (or mini-batches) and removed afterwards."""
+    utils.debug(" .... Training with %d chunks of features using %d threads" % (len(chunks), self.m_training_threads))
+
+    # the cache is written next to the projector (or enroller) file, if known
+    cache_parent = os.path.dirname(self.m_checkpoint_prefix) if self.m_checkpoint_prefix is not None else None
+    cache_directory = tempfile.mkdtemp(prefix = 'ubm_training_cache_', dir = cache_parent or None)
+    try:
+      chunks = self.__cache_chunks__(chunks, cache_directory)
+
+      # Normalizes each chunk when it is accessed; the normalization of the K-Means means and variances is undone after the K-Means training
+      normalized_chunks = chunks
+      if self.m_normalize_before_k_means:
+        std_array = utils.normalization.standard_deviation(*utils.normalization.moments(chunks))
+        normalized_chunks = utils.streaming.LazyList(range(len(chunks)), lambda index: chunks[int(index)] / std_array)
+
+      # Trains the K-Means
+      utils.info("  -> Training K-Means")
+      means = self.__train__(self.__kmeans_trainer__(), normalized_chunks, stage = 'kmeans')
+
+      # Initializes the GMM with the means, variances and weights of the K-Means clusters
+      gmm_trainer = self.__gmm_trainer__()
+      machine = gmm_trainer.initialize_from_means(means, normalized_chunks)
+      if self.m_normalize_before_k_means:
+        machine['means'] *= std_array
+        machine['variances'] = numpy.maximum(machine['variances'] * std_array ** 2, machine['variance_thresholds'])
+
+      # Trains the GMM
+      utils.info("  -> Training GMM")
+      machine = self.__train__(gmm_trainer, chunks, machine, stage = 'gmm')
+      self.m_ubm = gmm_trainer.bob_machine(machine)
+    finally:
+      shutil.rmtree(cache_directory)
+
+
+  def _train_projector_using_features(self, features):
+    """Trains the UBM from the given list of features, each of which is a 2D array of feature vectors.
+    In the mini-batch training, the features are split into mini-batches that are stacked one at a time; otherwise, all features are stacked into one array."""
+    if self.m_mini_batch_size:
+      return self._train_projector_using_chunks(self.__split_features__(features))
+    return self._train_projector_using_array(numpy.vstack(features))
 
-  #######################################################
-  ################ UBM training #########################
 
   def _train_projector_using_array(self, array):
 
+    # the bob.trainer.KMeansTrainer supports only the random initialization; checkpoints are written by the map-reduce trainers only
+    if self.m_training_threads > 1 or self.m_mini_batch_size or self.m_k_means_initialization != 'random' or self.m_checkpoint_interval:
+      return self._train_projector_using_trainers(array)
+
     utils.debug(" .... Training with %d feature vectors" % array.shape[0])
 
     # Computes input size
     input_size = array.shape[1]
 
-    # Normalizes the array if required
-    utils.debug(" .... Normalizing the array")
-    if not self.m_normalize_before_k_means:
-      normalized_array = array
-    else:
-      normalized_array, std_array = self.__normalize_std_array__(array)
+    # Normalizes the array in place if required; the normalization is undone after the K-Means training
+    if self.m_normalize_before_k_means:
+      utils.debug(" .... Normalizing the array")
+      array, std_array = utils.normalization.normalize_std_array(array, in_place = True, dtype = numpy.float64)
 
 
     # Creates the machines (KMeans and GMM)
@@ -144,20 +328,21 @@ class UBMGMM (Tool):
     kmeans_trainer = bob.trainer.KMeansTrainer()
     kmeans_trainer.rng = bob.core.random.mt19937(self.m_init_seed)
     kmeans_trainer.convergence_threshold = self.m_training_threshold
-    kmeans_trainer.max_iterations = self.m_gmm_training_iterations
+    kmeans_trainer.max_iterations = self.m_k_means_training_iterations
 
     # Trains using the KMeansTrainer
     utils.info("  -> Training K-Means")
-    kmeans_trainer.train(kmeans, normalized_array)
+    kmeans_trainer.train(kmeans, array)
 
-    [variances, weights] = kmeans.get_variances_and_weights_for_each_cluster(normalized_array)
+    [variances, weights] = kmeans.get_variances_and_weights_for_each_cluster(array)
     means = kmeans.means
 
     # Undoes the normalization
-    utils.debug(" .... Undoing normalization")
     if self.m_normalize_before_k_means:
-      self.__multiply_vectors_by_factors__(means, std_array)
-      self.__multiply_vectors_by_factors__(variances, std_array ** 2)
+      utils.debug(" .... Undoing normalization")
+      utils.normalization.multiply_by_factors(array, std_array)
+      means *= std_array
+      variances *= std_array ** 2
 
     # Initializes the GMM
     self.m_ubm.means = means
@@ -186,12 +371,11 @@ class UBMGMM (Tool):
 
     utils.info("  -> Training UBM model with %d training files" % len(train_features))
 
-    # Loads the data into an array
-    array = numpy.vstack(train_features)
-
-    self._train_projector_using_array(array)
+    self.__start_checkpoints__(projector_file)
+    self._train_projector_using_features(train_features)
 
     self._save_projector(projector_file)
+    self.__remove_checkpoints__()
 
 
   #######################################################
@@ -216,11 +400,61 @@ class UBMGMM (Tool):
     self.m_gmm_stats = bob.machine.GMMStats(self.m_ubm.dim_c, self.m_ubm.dim_d)
 
 
+  def __supports_sharing__(self):
+    """Checks if the loaded machines can be replaced by shared arrays; the scoring of the UBM-GMM tool requires the linear scoring for this."""
+    return self.m_scoring_function is bob.machine.linear_scoring
+
+  def __shared_projector_arrays__(self):
+    """Returns the arrays of the loaded projector that are shared between processes, i.e., the UBM and the precomputed terms of its log-likelihoods."""
+    arrays = utils.shared.with_prefix('ubm_', utils.shared.SharedGMMMachine.arrays(self.m_ubm))
+    arrays.update(utils.shared.with_prefix('log_likelihoods_', utils.gmm.from_machines(self.m_ubm).precomputed_arrays()))
+    return arrays
+
+  def __read_shared_projector_arrays__(self, projector_file):
+    """Loads the projector from the given file and returns the arrays that are shared between processes"""
+    self.load_projector(projector_file)
+    return self.__shared_projector_arrays__()
+
+  def __attach_shared_projector__(self, arrays):
+    """Replaces the bob machines of the projector by the given shared arrays (see __shared_projector_arrays__)"""
+    self.m_ubm = utils.shared.SharedGMMMachine(**utils.shared.without_prefix('ubm_', arrays))
+    self.m_ubm_log_likelihoods = utils.gmm.GMMLogLikelihoods(precomputed = utils.shared.without_prefix('log_likelihoods_', arrays))
+    self.m_gmm_stats = bob.machine.GMMStats(self.m_ubm.dim_c, self.m_ubm.dim_d)
+    # the trainer for the enrollment is created when the bob machines are loaded, see __require_bob_machines__
+    self.m_trainer = None
+
+  def load_shared_projector(self, projector_file):
+    """Attaches the UBM (and the subspaces of derived tools) to memory-mapped arrays, which are shared between all processes.
+    The GMM statistics, the linear scores and the U x estimation are computed with facereclib.utils.gmm on the shared arrays.
+    The bob machines, which copy their parameters, are loaded only when a model is enrolled (see __require_bob_machines__)."""
+    if not self.__supports_sharing__():
+      return self.load_projector(projector_file)
+    self.__attach_shared_projector__(utils.shared.load(projector_file, self.__read_shared_projector_arrays__))
+    self.m_shared_projector_file = projector_file
+
+  def __require_bob_machines__(self):
+    """Loads the bob machines that are required for the enrollment, if the projector or the enroller have been attached to shared arrays only."""
+    if self.m_shared_projector_file is not None:
+      projector_file, self.m_shared_projector_file = self.m_shared_projector_file, None
+      self.load_projector(projector_file)
+    if self.m_shared_enroller_file is not None:
+      enroller_file, self.m_shared_enroller_file = self.m_shared_enroller_file, None
+      self.load_enroller(enroller_file)
+
+
   def _project_using_array(self, array):
     utils.debug(" .... Projecting %d feature vectors" % array.shape[0])
     # Accumulates statistics
     self.m_gmm_stats.init()
-    self.m_ubm.acc_statistics(array, self.m_gmm_stats)
+    if isinstance(self.m_ubm, utils.shared.SharedGMMMachine):
+      # the statistics of all (or the top-k) Gaussians are computed on the shared arrays of the UBM
+      n, sum_px, sum_pxx, log_likelihood = utils.gmm.top_k_statistics(self.m_ubm_log_likelihoods, array, self.m_top_k_gaussians or self.m_ubm.dim_c)
+      self._set_statistics(self.m_gmm_stats, n, sum_px, sum_pxx, array.shape[0], log_likelihood)
+    elif self.m_top_k_gaussians is None:
+      self.m_ubm.acc_statistics(array, self.m_gmm_stats)
+    else:
+      n, sum_px, sum_pxx, log_likelihood = utils.gmm.top_k_statistics(utils.gmm.from_machines(self.m_ubm), array, self.m_top_k_gaussians)
+      self._set_statistics(self.m_gmm_stats, n, sum_px, sum_pxx, array.shape[0], log_likelihood)
 
     # return the resulting statistics
     return self.m_gmm_stats
@@ -231,8 +465,53 @@ class UBMGMM (Tool):
 
     return self._project_using_array(feature_array)
 
+  def _set_statistics(self, statistics, n, sum_px, sum_pxx, t, log_likelihood):
+    """Sets the contents of the given bob.machine.GMMStats object and returns it."""
+    statistics.n = n
+    statistics.sum_px = sum_px
+    statistics.sum_pxx = sum_pxx
+    statistics.t = int(t)
+    statistics.log_likelihood = float(log_likelihood)
+    return statistics
+
+  def _save_statistics(self, statistics, hdf5file):
+    """Writes the given GMM statistics to the given bob.io.HDF5File.
+    When only the top-k Gaussians are used in the projection, only the statistics of the Gaussians with non-zero responsibility are written."""
+    if self.m_top_k_gaussians is None:
+      statistics.save(hdf5file)
+      return
+    n = numpy.array(statistics.n)
+    indices = numpy.nonzero(n)[0]
+    hdf5file.set('sparse_gaussians', indices.astype(numpy.int64))
+    hdf5file.set('number_of_gaussians', statistics.dim_c)
+    hdf5file.set('feature_dimension', statistics.dim_d)
+    hdf5file.set('n', n[indices])
+    hdf5file.set('sum_px', numpy.array(statistics.sum_px)[indices])
+    hdf5file.set('sum_pxx', numpy.array(statistics.sum_pxx)[indices])
+    hdf5file.set('T', statistics.t)
+    hdf5file.set('log_likelihood', statistics.log_likelihood)
+
+  def _read_statistics(self, hdf5file):
+    """Reads GMM statistics from the given bob.io.HDF5File, which might have been written sparsely."""
+    if not hdf5file.has_key('sparse_gaussians'):
+      return bob.machine.GMMStats(hdf5file)
+    statistics = bob.machine.GMMStats(int(hdf5file.read('number_of_gaussians')), int(hdf5file.read('feature_dimension')))
+    indices = hdf5file.read('sparse_gaussians')
+    n = numpy.zeros((statistics.dim_c,), numpy.float64)
+    n[indices] = hdf5file.read('n')
+    sum_px = numpy.zeros((statistics.dim_c, statistics.dim_d), numpy.float64)
+    sum_px[indices] = hdf5file.read('sum_px')
+    sum_pxx = numpy.zeros((statistics.dim_c, statistics.dim_d), numpy.float64)
+    sum_pxx[indices] = hdf5file.read('sum_pxx')
+    return self._set_statistics(statistics, n, sum_px, sum_pxx, hdf5file.read('T'), hdf5file.read('log_likelihood'))
+
+  def save_feature(self, feature, feature_file):
+    """Writes the GMM statistics of the projected feature, sparsely when only the top-k Gaussians are used"""
+    self._save_statistics(feature, bob.io.HDF5File(feature_file, "w"))
+
   def _enroll_using_array(self, array):
     utils.debug(" .... Enrolling with %d feature vectors" % array.shape[0])
+    self.__require_bob_machines__()
 
     gmm = bob.machine.GMMMachine(self.m_ubm)
     gmm.set_variance_thresholds(self.m_variance_threshold)
@@ -254,17 +533,34 @@ class UBMGMM (Tool):
 
   def read_probe(self, probe_file):
     """Read the type of features that we require, namely GMM_Stats"""
-    return bob.machine.GMMStats(bob.io.HDF5File(probe_file))
+    return self._read_statistics(bob.io.HDF5File(probe_file))
 
   def score(self, model, probe):
     """Computes the score for the given model and the given probe using the scoring function from the config file"""
+    if isinstance(self.m_ubm, utils.shared.SharedGMMMachine):
+      return float(self.score_block([model], [probe])[0,0])
     return self.m_scoring_function([model], self.m_ubm, [probe], [], frame_length_normalisation = True)[0][0]
 
   def score_for_multiple_probes(self, model, probes):
     """This function computes the score between the given model and several given probe files."""
     utils.warn("Please verify that this function is correct")
+    if isinstance(self.m_ubm, utils.shared.SharedGMMMachine):
+      return self.m_probe_fusion_function(self.score_block([model], probes))
     return self.m_probe_fusion_function(self.m_scoring_function([model], self.m_ubm, probes, [], frame_length_normalisation = True))
 
+  def score_block(self, models, probes):
+    """Computes the scores of all given models and probes at once.
+    For the linear scoring, the mean supervectors of all models are stacked and multiplied with the first order statistics of all probes."""
+    if self.m_scoring_function is not bob.machine.linear_scoring:
+      return Tool.score_block(self, models, probes)
+    return utils.gmm.linear_scoring(numpy.vstack([model.mean_supervector for model in models]), self.m_ubm, probes)
+
+  def score_block_for_multiple_probes(self, models, probe_sets):
+    """Computes the scores of all given models and probe sets, where the scores of all probes of all sets are computed with a single call to 'score_block' and fused per probe set."""
+    scores = self.score_block(models, [probe for probes in probe_sets for probe in probes])
+    bounds = numpy.cumsum([0] + [len(probes) for probes in probe_sets])
+    return numpy.array([[self.m_probe_fusion_function(scores[i, bounds[j] : bounds[j+1]]) for j in range(len(probe_sets))] for i in range(len(models))], numpy.float64).reshape((len(models), len(probe_sets)))
+
 
 
 
@@ -278,7 +574,7 @@ class UBMGMMRegular (UBMGMM):
     # initialize the UBMGMM base class
     UBMGMM.__init__(self, **kwargs)
     # register a different set of functions in the Tool base class
-    Tool.__init__(self, requires_enroller_training = True)
+    Tool.__init__(self, requires_enroller_training = True, stream_training_features = self.m_mini_batch_size is not None, block_scoring = True)
 
 
 
@@ -294,8 +590,17 @@ class UBMGMMRegular (UBMGMM):
   ############## GMM training using UBM #################
 
   def load_enroller(self, enroller_file):
-    """Reads the UBM model from file"""
-    return self.load_projector(enroller_file)
+    """Reads the UBM model from file and precomputes the constants to compute the log-likelihoods of the UBM"""
+    self.load_projector(enroller_file)
+    self.m_ubm_log_likelihoods = utils.gmm.from_machines(self.m_ubm)
+
+  def __supports_sharing__(self):
+    """The log-likelihood scoring does not depend on the scoring function"""
+    return True
+
+  def load_shared_enroller(self, enroller_file):
+    """Attaches the UBM to memory-mapped arrays, which are shared between all processes"""
+    self.load_shared_projector(enroller_file)
 
 
   ######################################################
@@ -310,10 +615,19 @@ class UBMGMMRegular (UBMGMM):
        Therefore, the log of the likelihood ratio is obtained by computing the following difference."""
 
     utils.warn("This class must be checked. Please verify that I didn't do any mistake here. For identical tests, this function gives a different score than the normal UBMGMM (see test_tools.py:test06a)")
-    score = 0
-    for i in range(probe.shape[0]):
-      score += model.forward(probe[i,:]) - self.m_ubm.forward(probe[i,:])
-    return score/probe.shape[0]
+    return float(self.score_models([model], probe)[0])
+
+
+  def score_models(self, models, probe):
+    """Computes the scores for all of the given models and the given probe at once.
+    The log-likelihoods of all probe frames are computed for the UBM only once and for all models in a single batch.
+    Returns a 1D array with one score for each model."""
+    ubm_log_likelihood = self.m_ubm_log_likelihoods.average_log_likelihoods(probe)[0]
+    return utils.gmm.from_machines(models).average_log_likelihoods(probe) - ubm_log_likelihood
+
+  def score_block(self, models, probes):
+    """Computes the scores of all given models and probes, where the log-likelihoods of each probe are computed for all models in a single batch."""
+    return numpy.vstack([self.score_models(models, probe) for probe in probes]).T
 
 
 
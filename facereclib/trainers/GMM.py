@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+import os
+import bob
+import numpy
+
+from .Trainer import Trainer
+from .KMeans import KMeans, closest_means
+from .. import utils
+
+def weighted_log_likelihoods(data, machine):
+  """Returns the 2D array of the weighted log-likelihoods log(w_c N(x_n | m_c, S_c)) of all samples x_n (rows of data) and all Gaussians c of the given machine with diagonal covariances."""
+  return utils.gmm.GMMLogLikelihoods(machine['weights'][None, :], machine['means'][None, :, :], machine['variances'][None, :, :]).weighted_log_likelihoods(data)[:, 0, :]
+
+
+
+class GMM (Trainer):
+  """Map-reduce trainer for Gaussian mixture models with diagonal covariances using maximum likelihood estimation.
+  The machine is a dictionary with the 'weights', 'means', 'variances' and 'variance_thresholds' of the Gaussians.
+  The map step computes the GMM statistics (E-step), the update step computes the new parameters (M-step)."""
+
+  def __init__(
+      self,
+      number_of_gaussians,
+      number_of_iterations = 25,
+      convergence_threshold = 5e-4,
+      variance_threshold = 5e-4,
+      update_weights = True,
+      update_means = True,
+      update_variances = True,
+      responsibility_threshold = 0., # the means and variances of Gaussians with a lower accumulated responsibility are not updated
+      kmeans_trainer = None # the trainer to compute the initial means; if not given, a default KMeans trainer is used
+  ):
+    Trainer.__init__(self, number_of_iterations, convergence_threshold)
+    self.m_number_of_gaussians = number_of_gaussians
+    self.m_variance_threshold = variance_threshold
+    self.m_update_weights = update_weights
+    self.m_update_means = update_means
+    self.m_update_variances = update_variances
+    self.m_responsibility_threshold = responsibility_threshold
+    self.m_kmeans_trainer = kmeans_trainer if kmeans_trainer is not None else KMeans(number_of_gaussians)
+
+
+  def initialize(self, chunks):
+    """Trains the K-Means on the given chunks and initializes the GMM with the result."""
+    return self.initialize_from_means(self.m_kmeans_trainer.train(chunks), chunks)
+
+  def initialize_from_means(self, means, chunks):
+    """Initializes the GMM using the given (K-Means) means, and the variances and weights of the samples closest to each of the means."""
+    counts = numpy.zeros((means.shape[0],), numpy.float64)
+    first = numpy.zeros(means.shape, numpy.float64)
+    second = numpy.zeros(means.shape, numpy.float64)
+    for chunk in chunks:
+      data = self.read_chunk(chunk)
+      indices = closest_means(data, means)[0]
+      for c in numpy.unique(indices):
+        assigned = data[indices == c]
+        counts[c] += assigned.shape[0]
+        first[c] += numpy.sum(assigned, axis = 0)
+        second[c] += numpy.sum(assigned ** 2, axis = 0)
+    assigned = counts > 0
+    variances = numpy.ones(means.shape, numpy.float64)
+    variances[assigned] = second[assigned] / counts[assigned, None] - (first[assigned] / counts[assigned, None]) ** 2
+    thresholds = numpy.ones(means.shape, numpy.float64) * self.m_variance_threshold
+    return {
+        'weights' : counts / numpy.sum(counts),
+        'means' : numpy.array(means, numpy.float64),
+        'variances' : numpy.maximum(variances, thresholds),
+        'variance_thresholds' : thresholds
+    }
+
+
+  def map(self, machine, data):
+    """Computes the zeroth, first and second order statistics of the given data (E-step)."""
+    log_likelihoods = weighted_log_likelihoods(data, machine)
+    log_sums = utils.gmm.log_sum_exp(log_likelihoods)
+    responsibilities = numpy.exp(log_likelihoods - log_sums[:, None])
+    return {
+        'n' : numpy.sum(responsibilities, axis = 0),
+        'sum_px' : numpy.dot(responsibilities.T, data),
+        'sum_pxx' : numpy.dot(responsibilities.T, data ** 2),
+        'log_likelihood' : numpy.sum(log_sums),
+        'T' : float(data.shape[0])
+    }
+
+
+  def update(self, machine, statistics):
+    """Computes the maximum likelihood estimates of the parameters from the given statistics (M-step).
+    The average log-likelihood of the training samples is returned as the value."""
+    n = statistics['n']
+    machine = dict((key, value.copy()) for key, value in machine.iteritems())
+    if self.m_update_weights:
+      machine['weights'] = n / numpy.sum(n)
+    # only Gaussians with enough responsibility are updated
+    updated = n > max(self.m_responsibility_threshold, 0.)
+    means = statistics['sum_px'][updated] / n[updated, None]
+    if self.m_update_means:
+      machine['means'][updated] = means
+    if self.m_update_variances:
+      machine['variances'][updated] = numpy.maximum(statistics['sum_pxx'][updated] / n[updated, None] - machine['means'][updated] ** 2, machine['variance_thresholds'][updated])
+    return machine, float(numpy.sum(statistics['log_likelihood']) / numpy.sum(statistics['T']))
+
+
+  def number_of_samples(self, statistics):
+    """Returns the number of samples, from which the given statistics were computed."""
+    return statistics['T']
+
+
+  def save_machine(self, machine, filename):
+    """Writes the machine as a bob.machine.GMMMachine."""
+    utils.ensure_dir(os.path.dirname(filename))
+    self.bob_machine(machine).save(bob.io.HDF5File(filename, 'w'))
+
+  def load_machine(self, filename):
+    """Reads the parameters of a bob.machine.GMMMachine."""
+    gmm = bob.machine.GMMMachine(bob.io.HDF5File(filename))
+    return {
+        'weights' : numpy.array(gmm.weights),
+        'means' : numpy.array(gmm.means),
+        'variances' : numpy.array(gmm.variances),
+        'variance_thresholds' : numpy.array(gmm.variance_thresholds)
+    }
+
+  def bob_machine(self, machine):
+    """Returns a bob.machine.GMMMachine with the parameters of the given machine."""
+    gmm = bob.machine.GMMMachine(machine['means'].shape[0], machine['means'].shape[1])
+    gmm.weights = machine['weights']
+    gmm.means = machine['means']
+    gmm.variances = machine['variances']
+    gmm.set_variance_thresholds(machine['variance_thresholds'])
+    return gmm
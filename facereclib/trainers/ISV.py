@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+import bob
+import numpy
+
+from .Trainer import Trainer
+from .. import utils
+
+def random_subspace(variances, subspace_dimension, random):
+  """Returns a random initial subspace matrix (supervector dimension x subspace dimension), whose rows are scaled with the standard deviations of the given variance supervector."""
+  return random.normal(0., 0.1, (variances.shape[0], subspace_dimension)) * numpy.sqrt(variances)[:, None]
+
+
+def accumulate_second_order(zeroth, covariances, factors):
+  """Returns sum_n N_nc (Cov_n + x_n x_n^T) for each Gaussian c as a 2D array (number of Gaussians x subspace dimension^2),
+  given the zeroth order statistics (number of statistics x number of Gaussians), and the posterior covariance matrices and means of the latent factors x_n."""
+  second_order = covariances + factors[:, :, None] * factors[:, None, :]
+  return numpy.dot(zeroth.T, second_order.reshape((second_order.shape[0], -1)))
+
+
+def update_subspace(second_order, first_order, dimension):
+  """Computes the new subspace from the accumulated statistics, i.e., the rows of Gaussian c are A2_c A1_c^-1,
+  where the A1_c are given as returned by 'accumulate_second_order', and A2 as a 2D array (supervector dimension x subspace dimension)."""
+  rank = first_order.shape[1]
+  blocks = second_order.reshape((second_order.shape[0], rank, rank))
+  # A1_c is symmetric, so that A2_c A1_c^-1 = (A1_c^-1 A2_c^T)^T
+  return numpy.vstack([numpy.linalg.solve(blocks[c], first_order[c * dimension : (c+1) * dimension].T).T for c in range(blocks.shape[0])])
+
+
+
+class ISV (Trainer):
+  """Map-reduce trainer for the U subspace of the inter-session variability modelling.
+  The training data is split into chunks of clients, where each client is a list of the bob.machine.GMMStats of its training files.
+  The machine is a dictionary with the subspace 'u' and the diagonal 'd', which is fixed to sqrt(S / relevance_factor) as in bob.trainer.ISVTrainer.
+  The map step estimates the latent session factors x of each file and the latent factors z of each client and accumulates the statistics of U (E-step),
+  the update step computes the new U (M-step).
+  The latent factors are not kept between the iterations; instead, their estimation is alternated latent_iterations times in each map step, starting with z = 0."""
+
+  def __init__(
+      self,
+      ubm, # the bob.machine.GMMMachine
+      subspace_dimension,
+      number_of_iterations = 10,
+      relevance_factor = 4.,
+      latent_iterations = 2,
+      seed = 5489
+  ):
+    Trainer.__init__(self, number_of_iterations)
+    self.m_ubm = ubm
+    self.m_subspace_dimension = subspace_dimension
+    self.m_relevance_factor = relevance_factor
+    self.m_latent_iterations = latent_iterations
+    self.m_seed = seed
+
+
+  def initialize(self, chunks):
+    """Initializes U randomly and D with sqrt(S / relevance_factor)."""
+    variances = numpy.array(self.m_ubm.variance_supervector, numpy.float64)
+    return {
+        'u' : random_subspace(variances, self.m_subspace_dimension, numpy.random.RandomState(self.m_seed)),
+        'd' : numpy.sqrt(variances / self.m_relevance_factor)
+    }
+
+
+  def read_chunk(self, chunk):
+    """Returns the zeroth and first order statistics (see utils.gmm.statistics_arrays) of each client in the given chunk, which is a list of lists of bob.machine.GMMStats."""
+    return [utils.gmm.statistics_arrays(client) for client in chunk]
+
+
+  def map(self, machine, clients):
+    """Estimates the latent factors of the given clients and accumulates the statistics for the U update."""
+    estimator = utils.gmm.UxEstimator(self.m_ubm, machine['u'])
+    means = numpy.array(self.m_ubm.mean_supervector, numpy.float64)
+    scaled_d = machine['d'] / numpy.array(self.m_ubm.variance_supervector, numpy.float64)
+    second_order = numpy.zeros((self.m_ubm.dim_c, self.m_subspace_dimension ** 2), numpy.float64)
+    first_order = numpy.zeros(machine['u'].shape, numpy.float64)
+    for zeroth, first in clients:
+      expanded = numpy.repeat(zeroth, self.m_ubm.dim_d, axis = 1)
+      centered = first - expanded * means
+      z = numpy.zeros(means.shape, numpy.float64)
+      for i in range(self.m_latent_iterations):
+        x, covariances = estimator.posteriors(zeroth, first, machine['d'] * z)
+        # since D is diagonal, the posterior of z is computed elementwise
+        z = scaled_d * numpy.sum(centered - expanded * numpy.dot(x, machine['u'].T), axis = 0) / (1. + scaled_d * machine['d'] * numpy.sum(expanded, axis = 0))
+      second_order += accumulate_second_order(zeroth, covariances, x)
+      first_order += numpy.dot((centered - expanded * (machine['d'] * z)).T, x)
+    return {'second_order' : second_order, 'first_order' : first_order}
+
+
+  def update(self, machine, statistics):
+    """Computes the new U; the Frobenius norm of U is returned as the value."""
+    u = update_subspace(statistics['second_order'], statistics['first_order'], self.m_ubm.dim_d)
+    return {'u' : u, 'd' : machine['d']}, float(numpy.sqrt(numpy.sum(u ** 2)))
+
+
+  def bob_machine(self, machine):
+    """Returns a bob.machine.ISVBase with the UBM and the given U and D."""
+    isv_base = bob.machine.ISVBase(self.m_ubm, self.m_subspace_dimension)
+    isv_base.u = machine['u']
+    isv_base.d = machine['d']
+    return isv_base
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+import bob
+import numpy
+
+from .Trainer import Trainer
+from .ISV import random_subspace, accumulate_second_order, update_subspace
+from .. import utils
+
+class IVector (Trainer):
+  """Map-reduce trainer for the total variability matrix T of the i-vector extraction.
+  The training data is split into chunks, each of which is a list of bob.machine.GMMStats.
+  The machine is a dictionary with the total variability matrix 't' and the variance supervector 'sigma'.
+  The map step computes the posterior distribution of the i-vector w of each file and accumulates the statistics of bob.trainer.IVectorTrainer (E-step):
+  sum N_c (Cov + w w^T), sum (F_c - N_c m_c) w^T and, if the variances are updated, sum N_c and the centered second order statistics.
+  The update step computes the new T and, optionally, the new variances (M-step)."""
+
+  def __init__(
+      self,
+      ubm, # the bob.machine.GMMMachine
+      subspace_dimension,
+      number_of_iterations = 25,
+      update_sigma = True,
+      variance_threshold = 1e-5,
+      seed = 5489
+  ):
+    Trainer.__init__(self, number_of_iterations)
+    self.m_ubm = ubm
+    self.m_subspace_dimension = subspace_dimension
+    self.m_update_sigma = update_sigma
+    self.m_variance_threshold = variance_threshold
+    self.m_seed = seed
+
+
+  def initialize(self, chunks):
+    """Initializes T randomly and the variances with the ones of the UBM."""
+    variances = numpy.array(self.m_ubm.variance_supervector, numpy.float64)
+    return {
+        't' : random_subspace(variances, self.m_subspace_dimension, numpy.random.RandomState(self.m_seed)),
+        'sigma' : variances
+    }
+
+
+  def read_chunk(self, chunk):
+    """Returns the zeroth, first (and second) order statistics of the given list of bob.machine.GMMStats (see utils.gmm.statistics_arrays)."""
+    return utils.gmm.statistics_arrays(chunk, self.m_update_sigma)
+
+
+  def map(self, machine, data):
+    """Estimates the i-vectors of the given statistics and accumulates the statistics for the update of T."""
+    zeroth, first = data[:2]
+    means = numpy.array(self.m_ubm.mean_supervector, numpy.float64)
+    w, covariances = utils.gmm.UxEstimator(self.m_ubm, machine['t'], machine['sigma']).posteriors(zeroth, first)
+    expanded = numpy.repeat(zeroth, self.m_ubm.dim_d, axis = 1)
+    statistics = {
+        'second_order' : accumulate_second_order(zeroth, covariances, w),
+        'first_order' : numpy.dot((first - expanded * means).T, w)
+    }
+    if self.m_update_sigma:
+      statistics['zeroth_order'] = numpy.sum(expanded, axis = 0)
+      statistics['centered_second_order'] = numpy.sum(data[2] - 2. * first * means + expanded * means ** 2, axis = 0)
+    return statistics
+
+
+  def update(self, machine, statistics):
+    """Computes the new T and, if desired, the new variances; the Frobenius norm of T is returned as the value."""
+    t = update_subspace(statistics['second_order'], statistics['first_order'], self.m_ubm.dim_d)
+    sigma = machine['sigma']
+    if self.m_update_sigma:
+      sigma = sigma.copy()
+      updated = statistics['zeroth_order'] > 0
+      sigma[updated] = (statistics['centered_second_order'][updated] - numpy.sum(t * statistics['first_order'], axis = 1)[updated]) / statistics['zeroth_order'][updated]
+      sigma = numpy.maximum(sigma, self.m_variance_threshold)
+    return {'t' : t, 'sigma' : sigma}, float(numpy.sqrt(numpy.sum(t ** 2)))
+
+
+  def bob_machine(self, machine):
+    """Returns a bob.machine.IVectorMachine with the UBM and the given T and variances."""
+    ivector_machine = bob.machine.IVectorMachine(self.m_ubm, self.m_subspace_dimension)
+    ivector_machine.variance_threshold = self.m_variance_threshold
+    ivector_machine.t = machine['t']
+    ivector_machine.sigma = machine['sigma']
+    return ivector_machine
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+import bob
+import numpy
+
+from .Trainer import Trainer
+from .ISV import random_subspace, accumulate_second_order, update_subspace
+from .. import utils
+
+class JFA (Trainer):
+  """Map-reduce trainer for the joint factor analysis.
+  The training data is split into chunks of clients, where each client is a list of the bob.machine.GMMStats of its training files.
+  The machine is a dictionary with the subspaces 'u' and 'v' and the diagonal 'd'.
+  As in bob.trainer.JFATrainer, the training is performed in three stages, which are selected in the constructor:
+  first V is trained (with U = 0 and D = 0), then U, and finally D.
+  In each map step, the latent factors y of each client, x of each file and z of each client are estimated as required by the current stage (E-step),
+  and the update step computes the new V, U or D (M-step)."""
+
+  def __init__(
+      self,
+      ubm, # the bob.machine.GMMMachine
+      subspace_dimension_of_u,
+      subspace_dimension_of_v,
+      stage = 'v', # the stage of the training: 'v', 'u' or 'd'
+      number_of_iterations = 10,
+      seed = 5489
+  ):
+    Trainer.__init__(self, number_of_iterations)
+    if stage not in ('v', 'u', 'd'):
+      raise ValueError("The JFA training stage '%s' is not known; use 'v', 'u' or 'd'." % stage)
+    self.m_ubm = ubm
+    self.m_subspace_dimension_of_u = subspace_dimension_of_u
+    self.m_subspace_dimension_of_v = subspace_dimension_of_v
+    self.m_stage = stage
+    self.m_seed = seed
+
+
+  def initialize(self, chunks):
+    """Initializes U, V and D randomly."""
+    variances = numpy.array(self.m_ubm.variance_supervector, numpy.float64)
+    random = numpy.random.RandomState(self.m_seed)
+    return {
+        'u' : random_subspace(variances, self.m_subspace_dimension_of_u, random),
+        'v' : random_subspace(variances, self.m_subspace_dimension_of_v, random),
+        'd' : numpy.abs(random_subspace(variances, 1, random)[:, 0])
+    }
+
+
+  def read_chunk(self, chunk):
+    """Returns the zeroth and first order statistics (see utils.gmm.statistics_arrays) of each client in the given chunk, which is a list of lists of bob.machine.GMMStats."""
+    return [utils.gmm.statistics_arrays(client) for client in chunk]
+
+
+  def map(self, machine, clients):
+    """Estimates the latent factors of the given clients and accumulates the statistics for the update of the current stage."""
+    means = numpy.array(self.m_ubm.mean_supervector, numpy.float64)
+    variances = numpy.array(self.m_ubm.variance_supervector, numpy.float64)
+    v_estimator = utils.gmm.UxEstimator(self.m_ubm, machine['v'])
+    if self.m_stage != 'v':
+      u_estimator = utils.gmm.UxEstimator(self.m_ubm, machine['u'])
+    if self.m_stage == 'd':
+      second_order = numpy.zeros(means.shape, numpy.float64)
+      first_order = numpy.zeros(means.shape, numpy.float64)
+    else:
+      subspace = machine[self.m_stage]
+      second_order = numpy.zeros((self.m_ubm.dim_c, subspace.shape[1] ** 2), numpy.float64)
+      first_order = numpy.zeros(subspace.shape, numpy.float64)
+
+    for zeroth, first in clients:
+      expanded = numpy.repeat(zeroth, self.m_ubm.dim_d, axis = 1)
+      centered = first - expanded * means
+      # the client factors y are estimated from the statistics of all files of the client
+      y, covariances = v_estimator.posteriors(numpy.sum(zeroth, axis = 0)[None, :], numpy.sum(first, axis = 0)[None, :])
+      if self.m_stage == 'v':
+        second_order += accumulate_second_order(numpy.sum(zeroth, axis = 0)[None, :], covariances, y)
+        first_order += numpy.dot(numpy.sum(centered, axis = 0)[:, None], y)
+        continue
+
+      # the session factors x are estimated for each file, given the client offset V y
+      vy = numpy.dot(machine['v'], y[0])
+      x, covariances = u_estimator.posteriors(zeroth, first, vy)
+      if self.m_stage == 'u':
+        second_order += accumulate_second_order(zeroth, covariances, x)
+        first_order += numpy.dot((centered - expanded * vy).T, x)
+        continue
+
+      # the client factors z are estimated elementwise (D is diagonal), given V y and U x
+      residual = numpy.sum(centered - expanded * (vy + numpy.dot(x, machine['u'].T)), axis = 0)
+      total = numpy.sum(expanded, axis = 0)
+      precision = 1. + machine['d'] ** 2 * total / variances
+      z = machine['d'] / variances * residual / precision
+      second_order += total * (1. / precision + z ** 2)
+      first_order += z * residual
+
+    return {'second_order' : second_order, 'first_order' : first_order}
+
+
+  def update(self, machine, statistics):
+    """Computes the new V, U or D, depending on the stage; the Frobenius norm of the updated parameter is returned as the value."""
+    machine = dict(machine)
+    if self.m_stage == 'd':
+      updated = statistics['second_order'] > 0
+      machine['d'] = machine['d'].copy()
+      machine['d'][updated] = statistics['first_order'][updated] / statistics['second_order'][updated]
+    else:
+      machine[self.m_stage] = update_subspace(statistics['second_order'], statistics['first_order'], self.m_ubm.dim_d)
+    return machine, float(numpy.sqrt(numpy.sum(machine[self.m_stage] ** 2)))
+
+
+  def bob_machine(self, machine):
+    """Returns a bob.machine.JFABase with the UBM and the given U, V and D."""
+    jfa_base = bob.machine.JFABase(self.m_ubm, self.m_subspace_dimension_of_u, self.m_subspace_dimension_of_v)
+    jfa_base.u = machine['u']
+    jfa_base.v = machine['v']
+    jfa_base.d = machine['d']
+    return jfa_base
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+import os
+import bob
+import numpy
+import scipy.sparse
+
+from .Trainer import Trainer
+from .. import utils
+
+def closest_means(data, means):
+  """Returns the index of the closest mean and the squared Euclidean distance to it for each row of the given data."""
+  # ||x-m||^2 = ||x||^2 - 2 x.m + ||m||^2, computed for all samples and means at once
+  distances = numpy.sum(data ** 2, axis = 1)[:, None] - 2. * numpy.dot(data, means.T) + numpy.sum(means ** 2, axis = 1)[None, :]
+  indices = numpy.argmin(distances, axis = 1)
+  return indices, numpy.maximum(distances[numpy.arange(data.shape[0]), indices], 0.)
+
+
+def reservoir_sample(chunks, number_of_samples, random):
+  """Draws a uniformly distributed random subset of number_of_samples rows from the given iterable of 2D arrays using reservoir sampling.
+  Each array is visited only once and only the subset is kept in memory, so the arrays might be read one after the other from file.
+  If fewer rows are given, all of them are returned."""
+  reservoir = None
+  seen = 0
+  for data in chunks:
+    if reservoir is None:
+      reservoir = numpy.ndarray((number_of_samples, data.shape[1]), numpy.float64)
+    # the first rows fill the reservoir
+    fill = min(max(number_of_samples - seen, 0), data.shape[0])
+    reservoir[seen : seen + fill] = data[:fill]
+    # each later row with global index t replaces a random element of the reservoir with probability number_of_samples / (t+1)
+    # when several rows of this chunk replace the same element, the last one is kept, as in the sequential algorithm
+    positions = numpy.arange(seen + fill, seen + data.shape[0])
+    replacements = (random.random_sample(positions.shape[0]) * (positions + 1)).astype(numpy.int64)
+    replaced = replacements < number_of_samples
+    reservoir[replacements[replaced]] = data[fill:][replaced]
+    seen += data.shape[0]
+  if reservoir is None:
+    raise ValueError("No training data was given to sample from.")
+  return reservoir[:min(seen, number_of_samples)]
+
+
+def kmeans_plus_plus(data, number_of_means, random):
+  """Selects the initial means from the rows of the given data using the k-means++ seeding:
+  the first mean is selected uniformly, and each further mean is selected with a probability proportional to the squared distance to the closest mean selected so far."""
+  means = numpy.ndarray((number_of_means, data.shape[1]), numpy.float64)
+  means[0] = data[random.randint(data.shape[0])]
+  distances = numpy.sum((data - means[0]) ** 2, axis = 1)
+  for k in range(1, number_of_means):
+    total = numpy.sum(distances)
+    if total > 0.:
+      index = min(numpy.searchsorted(numpy.cumsum(distances), random.random_sample() * total, side = 'right'), data.shape[0] - 1)
+    else:
+      # all samples coincide with the selected means
+      index = random.randint(data.shape[0])
+    means[k] = data[index]
+    distances = numpy.minimum(distances, numpy.sum((data - means[k]) ** 2, axis = 1))
+  return means
+
+
+class KMeans (Trainer):
+  """Map-reduce trainer for the K-Means clustering.
+  The machine is the 2D array of means.
+  The map step assigns each sample to its closest mean, the update step computes the new means as the averages of the assigned samples."""
+
+  def __init__(
+      self,
+      number_of_means,
+      number_of_iterations = 25,
+      convergence_threshold = 5e-4,
+      limit_training_examples = None, # if given, only this number of (quasi-randomly selected) chunks is used for initialization
+      seed = 5489,
+      initialization = 'random', # 'random' selects random samples as initial means, 'k-means++' uses the k-means++ seeding
+      initialization_samples = 100000 # the maximum number of samples that is used for the k-means++ initialization; it is drawn from the chunks using reservoir sampling
+  ):
+    Trainer.__init__(self, number_of_iterations, convergence_threshold)
+    if initialization not in ('random', 'k-means++'):
+      raise ValueError("The K-Means initialization '%s' is not known; use 'random' or 'k-means++'." % initialization)
+    self.m_number_of_means = number_of_means
+    self.m_limit_training_examples = limit_training_examples
+    self.m_seed = seed
+    self.m_initialization = initialization
+    self.m_initialization_samples = initialization_samples
+
+
+  def initialize(self, chunks):
+    """Initializes the means with randomly selected samples from the given chunks, or using the k-means++ seeding on a random subset of the samples."""
+    indices = utils.quasi_random_indices(len(chunks), self.m_limit_training_examples)
+    if self.m_initialization == 'k-means++':
+      random = numpy.random.RandomState(self.m_seed)
+      # the chunks are read one after the other and only the subset is kept in memory
+      subset = reservoir_sample((self.read_chunk(chunks[index]) for index in indices), max(self.m_initialization_samples, self.m_number_of_means), random)
+      if subset.shape[0] < self.m_number_of_means:
+        raise ValueError("At least %d training samples are required to initialize the K-Means, but only %d were given." % (self.m_number_of_means, subset.shape[0]))
+      return kmeans_plus_plus(subset, self.m_number_of_means, random)
+
+    selected = [self.read_chunk(chunks[index]) for index in indices]
+    offsets = numpy.cumsum([0] + [data.shape[0] for data in selected])
+    if offsets[-1] < self.m_number_of_means:
+      raise ValueError("At least %d training samples are required to initialize the K-Means, but only %d were given." % (self.m_number_of_means, offsets[-1]))
+    random = numpy.random.RandomState(self.m_seed)
+    # collect the randomly selected samples from the chunks without stacking the chunks
+    indices = random.choice(offsets[-1], self.m_number_of_means, replace = False)
+    chunk_indices = numpy.searchsorted(offsets, indices, side = 'right') - 1
+    return numpy.vstack([selected[c][i - offsets[c]] for c, i in zip(chunk_indices, indices)]).astype(numpy.float64)
+
+
+  def map(self, means, data):
+    """Computes the number of samples, the sum of the samples and the sum of distances for each mean."""
+    indices, distances = closest_means(data, means)
+    zeros = numpy.bincount(indices, minlength = means.shape[0]).astype(numpy.float64)
+    # sum up the samples for each mean using a sparse assignment matrix
+    assignment = scipy.sparse.csr_matrix((numpy.ones(data.shape[0]), (indices, numpy.arange(data.shape[0]))), shape = (means.shape[0], data.shape[0]))
+    first = numpy.asarray(assignment.dot(data), numpy.float64)
+    return {'zeros' : zeros, 'first' : first, 'dist' : numpy.sum(distances), 'nsamples' : float(data.shape[0])}
+
+
+  def update(self, means, statistics):
+    """Computes the new means; means without any assigned samples are kept.
+    The average distance of the samples to their closest mean is returned as the value."""
+    assigned = statistics['zeros'] > 0
+    means = means.copy()
+    means[assigned] = statistics['first'][assigned] / statistics['zeros'][assigned, None]
+    return means, float(numpy.sum(statistics['dist']) / numpy.sum(statistics['nsamples']))
+
+
+  def number_of_samples(self, statistics):
+    """Returns the number of samples, from which the given statistics were computed."""
+    return statistics['nsamples']
+
+
+  def save_machine(self, means, filename):
+    """Writes the means as a bob.machine.KMeansMachine."""
+    utils.ensure_dir(os.path.dirname(filename))
+    self.bob_machine(means).save(bob.io.HDF5File(filename, 'w'))
+
+  def load_machine(self, filename):
+    """Reads the means of a bob.machine.KMeansMachine."""
+    return bob.machine.KMeansMachine(bob.io.HDF5File(filename)).means
+
+  def bob_machine(self, means):
+    """Returns a bob.machine.KMeansMachine with the given means."""
+    machine = bob.machine.KMeansMachine(means.shape[0], means.shape[1])
+    machine.means = means
+    return machine
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+import numpy
+
+from .PCA import PCA
+from .. import utils
+
+class LDA (PCA):
+  """Map-reduce trainer for the Fisher linear discriminant analysis.
+  Each chunk needs to contain the data of exactly one class (client).
+  The map step accumulates the statistics of the class, which are collected in the reduce step.
+  The update step solves the generalized eigenvalue problem of between-class and within-class scatter matrices,
+  the resulting machine is a pair of a bob.machine.LinearMachine and the eigenvalues.
+  Only a single iteration is required."""
+
+  def __init__(self, subspace_dimension = None, pca_machine = None):
+    """If subspace_dimension is given, the machine is limited to the given number of eigenvectors, otherwise to the number of classes - 1.
+    If a pca_machine is given, the data is projected into the PCA subspace before computing the LDA."""
+    PCA.__init__(self, subspace_dimension)
+    self.m_pca_machine = pca_machine
+
+  def map(self, machine, data):
+    """Accumulates the statistics of the class given by the data."""
+    if self.m_pca_machine is not None:
+      data = utils.project_batch(self.m_pca_machine, data)
+    return PCA.map(self, machine, data)
+
+  def reduce(self, statistics):
+    """Collects the statistics of all classes; statistics of already reduced sets of classes are supported as well."""
+    result = None
+    for other in statistics:
+      if 'class_counts' not in other:
+        # statistics of a single class
+        part = utils.streaming.ScatterStatistics(other['mean'].shape[0])
+        part.n, part.mean, part.scatter = int(numpy.sum(other['n'])), other['mean'], other['scatter']
+        if result is None:
+          result = utils.streaming.ClassScatterStatistics(part.mean.shape[0])
+        result.add_class(part)
+      else:
+        # statistics of several classes
+        part = self.__class_statistics__(other)
+        if result is None:
+          result = part
+        else:
+          result.merge(part)
+    return {
+        'n' : float(result.total.n),
+        'mean' : result.total.mean,
+        'scatter' : result.total.scatter,
+        'within_scatter' : result.within_scatter,
+        'class_counts' : numpy.array(result.class_counts, numpy.float64),
+        'class_means' : numpy.vstack(result.class_means)
+    }
+
+  def __class_statistics__(self, statistics):
+    """Converts the given reduced statistics into a utils.streaming.ClassScatterStatistics object."""
+    result = utils.streaming.ClassScatterStatistics(statistics['mean'].shape[0])
+    result.total.n, result.total.mean, result.total.scatter = int(numpy.sum(statistics['n'])), statistics['mean'], statistics['scatter']
+    result.within_scatter = statistics['within_scatter']
+    result.class_counts = [int(n) for n in statistics['class_counts']]
+    result.class_means = list(statistics['class_means'])
+    return result
+
+  def update(self, machine, statistics):
+    """Computes the LDA; the sum of the kept eigenvalues is returned as the value."""
+    machine, eigen_values = utils.streaming.lda(self.__class_statistics__(statistics), strip_to_rank = self.m_subspace_dimension is None)
+    if self.m_subspace_dimension is not None:
+      machine.resize(machine.shape[0], self.m_subspace_dimension)
+      eigen_values = eigen_values[:self.m_subspace_dimension].copy()
+    return (machine, eigen_values), float(numpy.sum(eigen_values))
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+import os
+import bob
+import numpy
+
+from .Trainer import Trainer
+from .. import utils
+
+class PCA (Trainer):
+  """Map-reduce trainer for the principal component analysis.
+  The map step accumulates the mean and scatter matrix of each chunk, which are merged in the reduce step.
+  The update step computes the eigenvectors of the covariance matrix, the resulting machine is a pair of a bob.machine.LinearMachine and the eigenvalues.
+  Only a single iteration is required."""
+
+  def __init__(self, subspace_dimension = None):
+    """If subspace_dimension is given, the machine is limited to the given number of eigenvectors."""
+    Trainer.__init__(self, 1)
+    self.m_subspace_dimension = subspace_dimension
+
+  def initialize(self, chunks):
+    """No initialization is required for the PCA."""
+    return None
+
+  def read_chunk(self, chunk):
+    """Returns the data of the given chunk as a 2D numpy.ndarray, where each (e.g. 2D) feature of a list of features is flattened into one row."""
+    if isinstance(chunk, numpy.ndarray):
+      return chunk
+    return numpy.vstack([feature.flatten() for feature in chunk])
+
+  def map(self, machine, data):
+    """Accumulates the mean and the scatter matrix of the given data."""
+    statistics = utils.streaming.ScatterStatistics(data.shape[1])
+    statistics.accumulate(data)
+    return {'n' : float(statistics.n), 'mean' : statistics.mean, 'scatter' : statistics.scatter}
+
+  def reduce(self, statistics):
+    """Merges the given statistics one after the other into a single scatter matrix, using the numerically stable pairwise update."""
+    result = None
+    for other in statistics:
+      part = utils.streaming.ScatterStatistics(other['mean'].shape[0])
+      part.n, part.mean, part.scatter = int(numpy.sum(other['n'])), other['mean'], other['scatter']
+      if result is None:
+        result = utils.streaming.ScatterStatistics(part.mean.shape[0])
+      result.merge(part)
+    return {'n' : float(result.n), 'mean' : result.mean, 'scatter' : result.scatter}
+
+  def update(self, machine, statistics):
+    """Computes the PCA; the sum of the kept eigenvalues is returned as the value."""
+    scatter = utils.streaming.ScatterStatistics(statistics['mean'].shape[0])
+    scatter.n, scatter.mean, scatter.scatter = int(numpy.sum(statistics['n'])), statistics['mean'], statistics['scatter']
+    machine, eigen_values = utils.streaming.pca(scatter)
+    if self.m_subspace_dimension is not None:
+      machine.resize(machine.shape[0], self.m_subspace_dimension)
+      eigen_values = eigen_values[:self.m_subspace_dimension].copy()
+    return (machine, eigen_values), float(numpy.sum(eigen_values))
+
+  def save_machine(self, machine, filename):
+    """Writes the eigenvalues and the machine in the same format as the facereclib.tools.PCA projector."""
+    utils.ensure_dir(os.path.dirname(filename))
+    f = bob.io.HDF5File(filename, 'w')
+    f.set("Eigenvalues", machine[1])
+    f.create_group("Machine")
+    f.cd("/Machine")
+    machine[0].save(f)
+
+  def load_machine(self, filename):
+    """Reads the machine and the eigenvalues as written by 'save_machine'."""
+    f = bob.io.HDF5File(filename)
+    eigen_values = f.read("Eigenvalues")
+    f.cd("/Machine")
+    return (bob.machine.LinearMachine(f), eigen_values)
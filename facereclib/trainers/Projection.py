@@ -0,0 +1,24 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+from .Trainer import Trainer
+
+class Projection (Trainer):
+  """Map-only trainer that applies the given function to each item of a chunk, e.g., to compute the GMM statistics of the training features of each client,
+  or to project and write a batch of files, in parallel worker processes using 'map_chunks'.
+  Each chunk is a list of items (e.g. features, or file indices), and the map step returns the list of the results of the function.
+  The function is inherited by the worker processes and does not need to be pickable, but its results need to be, since they are sent back.
+  There is no machine, and this trainer cannot be trained."""
+
+  def __init__(self, function):
+    Trainer.__init__(self)
+    self.m_function = function
+
+
+  def read_chunk(self, chunk):
+    """The items of the chunk are passed to the function as they are."""
+    return chunk
+
+  def map(self, machine, items):
+    """Returns the list of the results of the function for the given items; the machine is ignored."""
+    return [self.m_function(item) for item in items]
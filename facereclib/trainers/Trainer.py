@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+import os
+import multiprocessing
+import multiprocessing.pool
+import bob
+import numpy
+
+from .. import utils
+
+# The trainer and the data chunks of the currently running local training.
+# They are set before the worker processes are started, so that the workers inherit them (or share them, when threads are used) and only the chunk indices need to be sent.
+_current_training = None
+
+def _map_chunk(arguments):
+  """Executes the map step of the current training on the chunk with the given index."""
+  index, machine = arguments
+  trainer, chunks = _current_training
+  return trainer.map(machine, trainer.read_chunk(chunks[index]))
+
+
+
+class Trainer:
+  """This is the base class for all map-reduce trainers.
+  The training data is split into chunks.
+  In each iteration, the map step computes sufficient statistics for each chunk independently (e.g. an E-step),
+  the statistics of all chunks are reduced into one, and the update step computes the new machine from them (e.g. an M-step).
+  The same trainer can be executed on a local process pool (see 'train') or distributed in the grid (see 'map_to_file' and 'reduce_files').
+
+  Machines and statistics need to be pickable, so that they can be sent to worker processes.
+  By default, statistics are dictionaries of numpy.ndarray's that are reduced by summing them up.
+  """
+
+  def __init__(
+      self,
+      number_of_iterations = 1, # the maximum number of map-reduce iterations
+      convergence_threshold = None # if given, the training stops when the relative change of the value returned by 'update' is below this threshold
+  ):
+    self.m_number_of_iterations = number_of_iterations
+    self.m_convergence_threshold = convergence_threshold
+
+
+  ############################################################
+  ### functions that must be overwritten in derived classes
+  ############################################################
+
+  def initialize(self, chunks):
+    """Returns the initial machine, e.g., by using some of the given data chunks.
+    It must be overwritten by derived classes."""
+    raise NotImplementedError("Please overwrite this function in your derived class")
+
+  def map(self, machine, data):
+    """Computes and returns the statistics of the given data (usually a 2D numpy.ndarray) using the current machine.
+    It must be overwritten by derived classes."""
+    raise NotImplementedError("Please overwrite this function in your derived class")
+
+  def update(self, machine, statistics):
+    """Computes the new machine from the reduced statistics.
+    It returns the new machine and a value (e.g. the average distance or the log-likelihood), which is used to check the convergence of the training.
+    It must be overwritten by derived classes."""
+    raise NotImplementedError("Please overwrite this function in your derived class")
+
+
+  ############################################################
+  ### Special functions that might be overwritten on need
+  ############################################################
+
+  def read_chunk(self, chunk):
+    """Returns the data of the given chunk as a 2D numpy.ndarray.
+    A chunk might be a 2D array, or a (lazy) list of features, which are stacked."""
+    if isinstance(chunk, numpy.ndarray):
+      return chunk
+    return numpy.vstack([numpy.atleast_2d(feature) for feature in chunk])
+
+  def reduce(self, statistics):
+    """Reduces the given list (or iterator) of statistics into one.
+    The statistics are folded one after the other, so that an iterator never needs to keep more than one of them in memory.
+    In this base class implementation, the statistics are dictionaries, whose elements are summed up."""
+    result = None
+    for other in statistics:
+      if result is None:
+        result = dict((key, numpy.array(value, numpy.float64)) for key, value in other.iteritems())
+      else:
+        for key in result:
+          result[key] += other[key]
+    return result
+
+  def save_statistics(self, statistics, filename):
+    """Writes the given statistics (as returned by 'map') to the given HDF5 file."""
+    utils.ensure_dir(os.path.dirname(filename))
+    f = bob.io.HDF5File(filename, 'w')
+    for key, value in statistics.iteritems():
+      f.set(key, numpy.atleast_1d(numpy.array(value, numpy.float64)))
+
+  def load_statistics(self, filename):
+    """Reads the statistics (as written by 'save_statistics') from the given HDF5 file."""
+    f = bob.io.HDF5File(filename)
+    return dict((os.path.basename(key), f.read(key)) for key in f.keys())
+
+  def save_machine(self, machine, filename):
+    """Writes the given machine to the given HDF5 file.
+    In this base class implementation, the machine is a dictionary of numpy.ndarray's."""
+    utils.ensure_dir(os.path.dirname(filename))
+    f = bob.io.HDF5File(filename, 'w')
+    for key, value in machine.iteritems():
+      f.set(key, value)
+
+  def load_machine(self, filename):
+    """Reads the machine (as written by 'save_machine') from the given HDF5 file."""
+    f = bob.io.HDF5File(filename)
+    return dict((os.path.basename(key), f.read(key)) for key in f.keys())
+
+  def number_of_samples(self, statistics):
+    """Returns the number of samples that the given statistics were computed from.
+    This function is required for the mini-batch training, it must be overwritten by derived classes that support it."""
+    raise NotImplementedError("Please overwrite this function in your derived class")
+
+  def relative_change(self, old_value, new_value):
+    """Returns the relative change of the values returned by 'update', or None if there is no (non-zero) old value."""
+    if old_value is None or old_value == 0:
+      return None
+    return abs((new_value - old_value) / float(old_value))
+
+  def is_converged(self, old_value, new_value):
+    """Checks if the training has converged, i.e., if the relative change of the values returned by 'update' is below the convergence threshold."""
+    if self.m_convergence_threshold is None or old_value is None:
+      return False
+    if old_value == 0:
+      return new_value == 0
+    return self.relative_change(old_value, new_value) < self.m_convergence_threshold
+
+  def __fingerprint__(self, chunks):
+    """Returns a string that identifies the parameters of this trainer and the number of the given training chunks.
+    The number of iterations is not part of it, so that a training can be resumed with more iterations."""
+    parameters = sorted((key, value) for key, value in self.__dict__.iteritems() if key.startswith('m_') and key != 'm_number_of_iterations' and isinstance(value, (int, long, float, str, tuple, type(None))))
+    return "%s(%s) on %d chunks" % (self.__class__.__name__, ", ".join("%s=%s" % (key[2:], value) for key, value in parameters), len(chunks))
+
+  def save_checkpoint(self, machine, iteration, value, converged, filename, fingerprint = None):
+    """Writes the given machine to the given checkpoint file (using 'save_machine'), and the state of the training to the file 'filename.state':
+    the number of finished iterations, the value returned by the last 'update', whether the training has converged and the fingerprint of the training (see '__fingerprint__').
+    Both files are written to temporary files first and renamed afterwards, so that a job that is killed while writing does not destroy the previous checkpoint."""
+    self.save_machine(machine, filename + '.tmp')
+    f = bob.io.HDF5File(filename + '.state.tmp', 'w')
+    f.set('iteration', iteration)
+    f.set('converged', int(converged))
+    if value is not None:
+      f.set('value', float(value))
+    if fingerprint is not None:
+      f.set('fingerprint', fingerprint)
+    del f
+    os.rename(filename + '.tmp', filename)
+    os.rename(filename + '.state.tmp', filename + '.state')
+
+  def load_checkpoint(self, filename, fingerprint = None):
+    """Reads the checkpoint (as written by 'save_checkpoint') from the given file.
+    It returns the machine, the number of finished iterations, the last value and the convergence flag, or None if there is no checkpoint.
+    If a fingerprint is given, a checkpoint that was written with a different fingerprint, i.e., by a training with different parameters, is ignored."""
+    if not os.path.exists(filename) or not os.path.exists(filename + '.state'):
+      return None
+    f = bob.io.HDF5File(filename + '.state')
+    if fingerprint is not None and (not f.has_key('fingerprint') or f.read('fingerprint') != fingerprint):
+      utils.warn("Ignoring checkpoint '%s', which was written by a training with different parameters" % filename)
+      return None
+    value = f.read('value') if f.has_key('value') else None
+    return self.load_machine(filename), int(f.read('iteration')), value, bool(f.read('converged'))
+
+
+  ############################################################
+  ### Execution of the training
+  ############################################################
+
+  def __start_pool__(self, chunks, parallel, use_threads = False):
+    """Starts and returns a pool of the given number of worker processes (or threads) for the map steps on the given chunks, or returns None if no pool is required.
+    The worker processes inherit the trainer and the chunks."""
+    global _current_training
+    if parallel <= 1 or len(chunks) <= 1:
+      return None
+    _current_training = (self, chunks)
+    if use_threads:
+      return multiprocessing.pool.ThreadPool(min(parallel, len(chunks)))
+    return multiprocessing.Pool(min(parallel, len(chunks)))
+
+  def __stop_pool__(self, pool):
+    """Stops the given pool started by __start_pool__, if any."""
+    global _current_training
+    if pool is not None:
+      pool.close()
+      pool.join()
+      _current_training = None
+
+  def __map_reduce__(self, machine, chunks, pool):
+    """Computes the reduced statistics of all chunks, either in the current process or using the given pool.
+    The statistics of each chunk are handed to 'reduce' as soon as they are computed, instead of collecting the statistics of all chunks first."""
+    if pool is None:
+      statistics = (self.map(machine, self.read_chunk(chunk)) for chunk in chunks)
+    else:
+      statistics = pool.imap(_map_chunk, [(index, machine) for index in range(len(chunks))])
+    return self.reduce(statistics)
+
+  def map_chunks(self, machine, chunks, parallel = 1, use_threads = False):
+    """Executes only the map step on each of the given chunks and returns the list of the (unreduced) statistics of the chunks.
+    If parallel is greater than 1, the map steps are executed on a pool of the given number of processes (or threads, if use_threads is enabled), as in 'train'."""
+    pool = self.__start_pool__(chunks, parallel, use_threads)
+    try:
+      if pool is None:
+        return [self.map(machine, self.read_chunk(chunk)) for chunk in chunks]
+      return pool.map(_map_chunk, [(index, machine) for index in range(len(chunks))])
+    finally:
+      self.__stop_pool__(pool)
+
+  def train(self, chunks, parallel = 1, machine = None, use_threads = False, checkpoint_file = None, checkpoint_interval = 1):
+    """Trains the machine using the given list of data chunks and returns it.
+    If parallel is greater than 1, the map steps are executed on a pool of the given number of processes.
+    If use_threads is enabled, a pool of threads is used instead, which share the chunks (e.g. views into one large array) without copying them;
+    this is efficient since numpy releases the global interpreter lock during the expensive array operations.
+    If no initial machine is given, it is obtained by calling 'initialize'.
+    If a checkpoint_file is given, the machine is written to it every checkpoint_interval iterations and when the training finishes (see 'save_checkpoint').
+    When the checkpoint exists already, e.g., because the job was killed during the training, the training is resumed from the stored machine,
+    and a finished training is not repeated at all; checkpoints of a training with different parameters or a different number of chunks are ignored."""
+    first_iteration, value = 0, None
+    fingerprint = self.__fingerprint__(chunks)
+    checkpoint = self.load_checkpoint(checkpoint_file, fingerprint) if checkpoint_file is not None else None
+    if checkpoint is not None:
+      machine, first_iteration, value, converged = checkpoint
+      utils.info("  -> Resuming %s training after %d iterations from checkpoint '%s'" % (self.__class__.__name__, first_iteration, checkpoint_file))
+      if converged or first_iteration >= self.m_number_of_iterations:
+        return machine
+    elif machine is None:
+      machine = self.initialize(chunks)
+
+    pool = self.__start_pool__(chunks, parallel, use_threads)
+    try:
+      for iteration in range(first_iteration, self.m_number_of_iterations):
+        statistics = self.__map_reduce__(machine, chunks, pool)
+        machine, new_value = self.update(machine, statistics)
+        change = self.relative_change(value, new_value)
+        utils.debug("  -> Iteration %d of %s training: %s%s" % (iteration + 1, self.__class__.__name__, new_value, "" if change is None else " (relative change: %g)" % change))
+        converged = self.is_converged(value, new_value)
+        if checkpoint_file is not None and (converged or (iteration + 1) % checkpoint_interval == 0 or iteration + 1 == self.m_number_of_iterations):
+          self.save_checkpoint(machine, iteration + 1, new_value, converged, checkpoint_file, fingerprint)
+        if converged:
+          utils.info("  -> %s training converged after %d iterations" % (self.__class__.__name__, iteration + 1))
+          break
+        value = new_value
+    finally:
+      self.__stop_pool__(pool)
+
+    return machine
+
+
+  def train_mini_batch(self, batches, number_of_passes = 1, step_offset = 2., step_exponent = 0.6, check_interval = None, machine = None, parallel = 1, seed = 5489):
+    """Trains the machine using stepwise (online) EM on the given list of mini-batches and returns it.
+    Instead of computing the statistics of all data in each iteration, the machine is updated after each mini-batch,
+    using running statistics that are interpolated with the statistics of the current mini-batch:
+    s = (1 - eta) * s + eta * s_batch, where the step size eta = (k + step_offset) ** -step_exponent decays with the number k of processed mini-batches.
+    The statistics are normalized by the number of samples, so this works for all trainers whose 'update' depends only on ratios of the summed statistics.
+    The mini-batches are processed in random order in each of the number_of_passes passes, so that only one mini-batch needs to be in memory at a time.
+    If check_interval is given, every check_interval mini-batches the value of the full data is computed (using parallel processes, if desired) to check for convergence.
+    If no initial machine is given, it is obtained by calling 'initialize'."""
+    if machine is None:
+      machine = self.initialize(batches)
+
+    # the pool is only used to compute the value of all data
+    pool = self.__start_pool__(batches, parallel) if check_interval else None
+
+    random = numpy.random.RandomState(seed)
+    running = None
+    step = 0
+    value = None
+    try:
+      for current_pass in range(number_of_passes):
+        for index in random.permutation(len(batches)):
+          statistics = self.map(machine, self.read_chunk(batches[index]))
+          samples = float(numpy.sum(self.number_of_samples(statistics)))
+          eta = (step + step_offset) ** -step_exponent
+          if running is None:
+            running = dict((key, numpy.array(value, numpy.float64) / samples) for key, value in statistics.iteritems())
+          else:
+            for key in running:
+              running[key] = (1. - eta) * running[key] + eta * numpy.array(statistics[key], numpy.float64) / samples
+          machine = self.update(machine, running)[0]
+          step += 1
+
+          if check_interval and step % check_interval == 0:
+            new_value = self.update(machine, self.__map_reduce__(machine, batches, pool))[1]
+            utils.debug("  -> Mini-batch %d of %s training: %s" % (step, self.__class__.__name__, new_value))
+            if self.is_converged(value, new_value):
+              utils.info("  -> %s mini-batch training converged after %d mini-batches" % (self.__class__.__name__, step))
+              return machine
+            value = new_value
+    finally:
+      self.__stop_pool__(pool)
+
+    return machine
+
+
+  def map_to_file(self, machine_file, chunk, statistics_file):
+    """Executes the map step on the given chunk using the machine stored in machine_file, and writes the statistics to statistics_file.
+    This function is designed to be executed in parallel grid jobs."""
+    machine = self.load_machine(machine_file)
+    self.save_statistics(self.map(machine, self.read_chunk(chunk)), statistics_file)
+
+  def reduce_files(self, machine_file, statistics_files, new_machine_file):
+    """Reduces the statistics stored in the given statistics_files, updates the machine stored in machine_file and writes the result to new_machine_file.
+    The value returned by 'update' is returned.
+    This function is designed to be executed in a single grid job after all 'map_to_file' jobs of the iteration finished."""
+    machine = self.load_machine(machine_file)
+    statistics = self.reduce(self.load_statistics(statistics_file) for statistics_file in statistics_files)
+    machine, value = self.update(machine, statistics)
+    self.save_machine(machine, new_machine_file)
+    return value
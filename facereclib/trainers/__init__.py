@@ -0,0 +1,17 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Map-reduce trainers, which can be executed on a local process pool or in the grid.
+
+Note that there is no trainer for PLDA (yet): the M-step of the bob.trainer.PLDATrainer requires the posteriors of each single training sample, which cannot be reduced into sufficient statistics of fixed size.
+Hence, facereclib.tools.PLDA trains its PLDA base with bob in a single process; only its PCA is trained with the PCA trainer."""
+
+from Trainer import Trainer
+from KMeans import KMeans
+from GMM import GMM
+from PCA import PCA
+from LDA import LDA
+from ISV import ISV
+from JFA import JFA
+from IVector import IVector
+from Projection import Projection
@@ -7,9 +7,15 @@ import video
 import histogram
 import tests
 import resources
+import shared
+import streaming
+import normalization
+import gmm
+import plda
 from logger import add_logger_command_line_option, set_verbosity_level, add_bob_handlers, debug, info, warn, error
 from annotations import read_annotations
 from grid import GridParameters
+from streaming import project_batch
 
 import os
 import bob
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Vectorized computation of the log-likelihoods of many feature vectors (frames) for Gaussian mixture models with diagonal covariances.
+Instead of evaluating the GMMs frame by frame, the log-likelihoods of all frames for all Gaussians are computed with two matrix multiplications."""
+
+import numpy
+import scipy.sparse
+
+def log_sum_exp(values, axis = -1):
+  """Computes log(sum(exp(values))) along the given axis of the given array in a numerically stable way."""
+  maximum = numpy.max(values, axis = axis)
+  return maximum + numpy.log(numpy.sum(numpy.exp(values - numpy.expand_dims(maximum, axis)), axis = axis))
+
+
+class GMMLogLikelihoods:
+  """Computes the log-likelihoods of frames for one or several GMMs with diagonal covariances.
+  The per-Gaussian constants (the log weights, the normalization terms and the squared means) are precomputed once,
+  so that the weighted log-likelihoods log(w_c N(x | m_c, S_c)) of all frames x and all Gaussians c of all GMMs are obtained at once by:
+
+    log(w_c) - 0.5 * (D log(2 pi) + log|S_c| + m_c^T S_c^-1 m_c) - 0.5 * x^T S_c^-1 x + x^T S_c^-1 m_c
+
+  The weights need to be given as a 2D array (number of GMMs x number of Gaussians),
+  the means and variances as 3D arrays (number of GMMs x number of Gaussians x feature dimension).
+  Use the 'from_machines' function to create this object from bob.machine.GMMMachine's.
+  Alternatively, the precomputed arrays (see 'precomputed_arrays') can be given, which are used without copying them, e.g., the memory-mapped arrays of utils.shared."""
+
+  def __init__(self, weights = None, means = None, variances = None, precomputed = None):
+    if precomputed is not None:
+      self.m_shape = tuple(int(s) for s in precomputed['shape'])
+      self.m_inverse = precomputed['inverse']
+      self.m_scaled_means = precomputed['scaled_means']
+      self.m_constants = precomputed['constants']
+      return
+    self.m_shape = weights.shape
+    dimension = means.shape[-1]
+    means = numpy.reshape(means, (-1, dimension))
+    inverse = 1. / numpy.reshape(variances, (-1, dimension))
+    self.m_inverse = inverse
+    self.m_scaled_means = means * inverse
+    with numpy.errstate(divide = 'ignore'):
+      # Gaussians with zero weight get a log weight of -inf
+      log_weights = numpy.log(numpy.reshape(weights, (-1,)))
+    self.m_constants = log_weights - 0.5 * (dimension * numpy.log(2. * numpy.pi) - numpy.sum(numpy.log(inverse), axis = 1) + numpy.sum(means * self.m_scaled_means, axis = 1))
+
+  def precomputed_arrays(self):
+    """Returns the dictionary of precomputed arrays, from which this object can be recreated (e.g. to share them between processes)."""
+    return {'shape' : numpy.array(self.m_shape), 'inverse' : self.m_inverse, 'scaled_means' : self.m_scaled_means, 'constants' : self.m_constants}
+
+  def weighted_log_likelihoods(self, data):
+    """Returns the weighted log-likelihoods of all frames (rows of the given 2D data) for all Gaussians of all GMMs as a 3D array (number of frames x number of GMMs x number of Gaussians)."""
+    values = self.m_constants[None, :] - 0.5 * numpy.dot(data ** 2, self.m_inverse.T) + numpy.dot(data, self.m_scaled_means.T)
+    return values.reshape((data.shape[0],) + self.m_shape)
+
+  def log_likelihoods(self, data, maximum_chunk_size = 10000000):
+    """Returns the log-likelihoods of all frames (rows of the given 2D data) for all GMMs as a 2D array (number of frames x number of GMMs).
+    The frames are processed in chunks, so that the intermediate array of weighted log-likelihoods contains at most maximum_chunk_size elements."""
+    frames_per_chunk = max(1, maximum_chunk_size // (self.m_shape[0] * self.m_shape[1]))
+    result = numpy.ndarray((data.shape[0], self.m_shape[0]), numpy.float64)
+    for i in range(0, data.shape[0], frames_per_chunk):
+      result[i : i + frames_per_chunk] = log_sum_exp(self.weighted_log_likelihoods(data[i : i + frames_per_chunk]))
+    return result
+
+  def average_log_likelihoods(self, data):
+    """Returns the log-likelihoods of the given frames averaged over all frames, one value for each GMM."""
+    return numpy.mean(self.log_likelihoods(data), axis = 0)
+
+
+def from_machines(machines):
+  """Creates the GMMLogLikelihoods object for the given bob.machine.GMMMachine or list of bob.machine.GMMMachine's, which all need to have the same number of Gaussians."""
+  if not isinstance(machines, (list, tuple)):
+    machines = [machines]
+  return GMMLogLikelihoods(
+      numpy.array([machine.weights for machine in machines], numpy.float64),
+      numpy.array([machine.means for machine in machines], numpy.float64),
+      numpy.array([machine.variances for machine in machines], numpy.float64)
+  )
+
+
+def linear_scoring(model_supervectors, ubm, probe_statistics, channel_offsets = None, frame_length_normalisation = True):
+  """Computes the linear scores (as bob.machine.linear_scoring does) of all given models with all given probes with a single matrix multiplication.
+  The models are given as a 2D array with one mean supervector per row, the probes as a list of bob.machine.GMMStats computed with the given UBM.
+  If given, the channel_offsets (e.g., the U x of ISV or JFA) are a 2D array with one supervector for each probe.
+  Returns a 2D array of scores (models x probes)."""
+  dimension = ubm.dim_d
+  means = ubm.mean_supervector
+  # the first order statistics of the probes centered around the UBM means (plus the channel offsets)
+  zeroth, first = statistics_arrays(probe_statistics)
+  zeroth = numpy.repeat(zeroth, dimension, axis = 1)
+  offsets = means[None, :] if channel_offsets is None else means[None, :] + channel_offsets
+  centered = first - zeroth * offsets
+  scores = numpy.dot((model_supervectors - means[None, :]) / ubm.variance_supervector[None, :], centered.T)
+  if frame_length_normalisation:
+    scores /= numpy.array([statistics.t for statistics in probe_statistics], numpy.float64)[None, :]
+  return scores
+
+
+def top_k_statistics(log_likelihoods, data, number_of_gaussians, maximum_chunk_size = 10000000):
+  """Computes the zeroth, first and second order GMM statistics of the given frames (rows of the given 2D data), where each frame contributes only to the number_of_gaussians Gaussians with the highest responsibilities.
+  The responsibilities of these Gaussians are renormalized to sum up to one, while the responsibilities of all other Gaussians are set to zero, so that the statistics of Gaussians that are not among the top-k of any frame are exactly zero.
+  The log_likelihoods need to be a GMMLogLikelihoods object of a single GMM (the UBM); the log-likelihood of the frames is computed using all Gaussians.
+  Returns the statistics n (number of Gaussians), sum_px and sum_pxx (number of Gaussians x feature dimension), and the total log-likelihood."""
+  gaussians = log_likelihoods.m_shape[1]
+  k = min(number_of_gaussians, gaussians)
+  n = numpy.zeros((gaussians,), numpy.float64)
+  sum_px = numpy.zeros((gaussians, data.shape[1]), numpy.float64)
+  sum_pxx = numpy.zeros((gaussians, data.shape[1]), numpy.float64)
+  log_likelihood = 0.
+  frames_per_chunk = max(1, maximum_chunk_size // gaussians)
+  for i in range(0, data.shape[0], frames_per_chunk):
+    chunk = data[i : i + frames_per_chunk]
+    values = log_likelihoods.weighted_log_likelihoods(chunk)[:, 0, :]
+    log_likelihood += numpy.sum(log_sum_exp(values))
+    # the indices and renormalized responsibilities of the k best Gaussians of each frame
+    rows = numpy.arange(chunk.shape[0])[:, None]
+    top = numpy.argpartition(-values, k - 1, axis = 1)[:, :k]
+    top_values = values[rows, top]
+    responsibilities = numpy.exp(top_values - log_sum_exp(top_values)[:, None])
+    # accumulate the statistics using a sparse matrix of responsibilities (Gaussians x frames)
+    assignment = scipy.sparse.csr_matrix((responsibilities.ravel(), (top.ravel(), numpy.repeat(rows.ravel(), k))), shape = (gaussians, chunk.shape[0]))
+    n += numpy.bincount(top.ravel(), weights = responsibilities.ravel(), minlength = gaussians)
+    sum_px += assignment.dot(chunk)
+    sum_pxx += assignment.dot(chunk ** 2)
+  return n, sum_px, sum_pxx, log_likelihood
+
+
+def statistics_arrays(statistics, second_order = False):
+  """Returns the zeroth order statistics (number of statistics x number of Gaussians) and the first order statistics (number of statistics x supervector dimension) of the given list of bob.machine.GMMStats as 2D arrays.
+  If second_order is enabled, the second order statistics (number of statistics x supervector dimension) are returned as well."""
+  zeroth = numpy.array([s.n for s in statistics], numpy.float64)
+  first = numpy.array([s.sum_px.flatten() for s in statistics], numpy.float64)
+  if second_order:
+    return zeroth, first, numpy.array([s.sum_pxx.flatten() for s in statistics], numpy.float64)
+  return zeroth, first
+
+
+class UxEstimator:
+  """Estimates the session offsets U x of ISV (or JFA) for many GMM statistics at once.
+  For the statistics with zeroth order N_c and first order F_c, the latent session factors are:
+
+    x = (I + sum_c N_c U_c^T S_c^-1 U_c)^-1 sum_c U_c^T S_c^-1 (F_c - N_c m_c)
+
+  The per-Gaussian blocks U_c^T S_c^-1 U_c and the scaled subspace S^-1 U are precomputed once when this object is created,
+  so that the estimation of a batch of statistics requires only a few matrix multiplications and one small linear system per statistics.
+  The ubm is a bob.machine.GMMMachine, u the 2D subspace matrix (supervector dimension x subspace dimension), e.g., of a bob.machine.ISVBase.
+  If given, the variances supervector replaces the variances of the UBM (e.g., the variances updated by the total variability training).
+  Alternatively, the precomputed arrays (see 'precomputed_arrays') can be given, which are used without copying them, e.g., the memory-mapped arrays of utils.shared."""
+
+  def __init__(self, ubm = None, u = None, variances = None, precomputed = None):
+    if precomputed is not None:
+      self.m_dimension = int(precomputed['dimension'][0])
+      self.m_means = precomputed['means']
+      self.m_u = precomputed['u']
+      self.m_scaled_u = precomputed['scaled_u']
+      self.m_blocks = precomputed['blocks']
+      return
+    self.m_dimension = ubm.dim_d
+    self.m_means = numpy.array(ubm.mean_supervector, numpy.float64)
+    self.m_u = numpy.array(u, numpy.float64)
+    self.m_scaled_u = self.m_u / numpy.array(ubm.variance_supervector if variances is None else variances, numpy.float64)[:, None]
+    rank = self.m_u.shape[1]
+    # the flattened blocks U_c^T S_c^-1 U_c (number of Gaussians x subspace dimension^2)
+    blocks = numpy.einsum('cdr,cds->crs', self.m_u.reshape((ubm.dim_c, self.m_dimension, rank)), self.m_scaled_u.reshape((ubm.dim_c, self.m_dimension, rank)))
+    self.m_blocks = blocks.reshape((ubm.dim_c, rank * rank))
+
+  def precomputed_arrays(self):
+    """Returns the dictionary of precomputed arrays, from which this object can be recreated (e.g. to share them between processes)."""
+    return {'dimension' : numpy.array([self.m_dimension]), 'means' : self.m_means, 'u' : self.m_u, 'scaled_u' : self.m_scaled_u, 'blocks' : self.m_blocks}
+
+  def __system__(self, zeroth, first, offsets):
+    """Returns the right hand sides and the precision matrices of the linear systems for the latent factors of the given 2D arrays of statistics."""
+    rank = self.m_u.shape[1]
+    means = self.m_means if offsets is None else self.m_means + offsets
+    projected = numpy.dot(first - numpy.repeat(zeroth, self.m_dimension, axis = 1) * numpy.atleast_2d(means), self.m_scaled_u)
+    precisions = numpy.dot(zeroth, self.m_blocks).reshape((zeroth.shape[0], rank, rank)) + numpy.eye(rank)[None, :, :]
+    return projected, precisions
+
+  def posteriors(self, zeroth, first, offsets = None):
+    """Returns the means (number of statistics x subspace dimension) and the covariance matrices (number of statistics x subspace dimension x subspace dimension) of the posterior distributions of the latent factors,
+    for the given zeroth and first order statistics as returned by 'statistics_arrays'.
+    If given, the offsets are added to the UBM means; they might be a supervector or a 2D array with one supervector per statistics."""
+    projected, precisions = self.__system__(zeroth, first, offsets)
+    covariances = numpy.array([numpy.linalg.inv(precision) for precision in precisions])
+    return numpy.einsum('nrs,ns->nr', covariances, projected), covariances
+
+  def estimate_x(self, probe_statistics, offsets = None):
+    """Returns the latent session factors x of all given bob.machine.GMMStats as a 2D array (number of statistics x subspace dimension).
+    If given, the offsets supervector (e.g., D z of an enrolled model) is added to the UBM means."""
+    projected, precisions = self.__system__(*(statistics_arrays(probe_statistics) + (offsets,)))
+    return numpy.array([numpy.linalg.solve(precision, vector) for precision, vector in zip(precisions, projected)])
+
+  def estimate_ux(self, probe_statistics, offsets = None):
+    """Returns the session offsets U x of all given bob.machine.GMMStats as a 2D array (number of statistics x supervector dimension)."""
+    return numpy.dot(self.estimate_x(probe_statistics, offsets), self.m_u.T)
@@ -45,6 +45,10 @@ class GridParameters:
     number_of_projected_features_per_job = 1000,
     number_of_enrolled_models_per_job = 50,
     number_of_models_per_scoring_job = 50,
+    # if set, the score matrix is split into tiles of models x probes
+    number_of_probes_per_scoring_job = None,
+    # number of clients that one E-step job of the ISV training should handle
+    number_of_training_clients_per_job = 50,
 
     # queue setup for the SGE grid (only used if grid = 'sge', the default)
     training_queue = '8G',
@@ -66,6 +70,8 @@ class GridParameters:
     self.number_of_projected_features_per_job = number_of_projected_features_per_job
     self.number_of_enrolled_models_per_job = number_of_enrolled_models_per_job
     self.number_of_models_per_scoring_job = number_of_models_per_scoring_job
+    self.number_of_probes_per_scoring_job = number_of_probes_per_scoring_job
+    self.number_of_training_clients_per_job = number_of_training_clients_per_job
     # the queues
     self.training_queue = self.queue(training_queue)
     self.preprocessing_queue = self.queue(preprocessing_queue)
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Vectorized functions to normalize large training data sets (e.g., millions of DCT feature vectors) to unit variance.
+The data is processed in chunks of rows, so that no temporary copies of the whole data need to be created."""
+
+import numpy
+
+def __chunks__(data, chunk_size):
+  """Returns the given 2D array split into chunks (views) of at most chunk_size rows, or the given list of chunks."""
+  if isinstance(data, numpy.ndarray):
+    return [data[i : i + chunk_size] for i in range(0, data.shape[0], chunk_size)]
+  return data
+
+
+def moments(data, chunk_size = 100000):
+  """Computes the number of rows, the sum and the sum of squares of the rows of the given 2D array, or of all 2D arrays in the given list.
+  The sums are accumulated in float64, independent of the data type of the data."""
+  n = 0
+  sum_x = sum_xx = 0.
+  for chunk in __chunks__(data, chunk_size):
+    n += chunk.shape[0]
+    sum_x += numpy.sum(chunk, axis = 0, dtype = numpy.float64)
+    # the sum of squares without creating the squared chunk
+    sum_xx += numpy.einsum('ij,ij->j', chunk, chunk, dtype = numpy.float64)
+  return n, sum_x, sum_xx
+
+
+def standard_deviation(n, sum_x, sum_xx):
+  """Computes the standard deviation from the number of samples, their sum and their sum of squares (as returned by the 'moments' function)."""
+  mean = sum_x / float(n)
+  return numpy.sqrt(numpy.maximum(sum_xx / float(n) - mean ** 2, 0.))
+
+
+def normalize_std_array(array, std = None, in_place = False, dtype = None, chunk_size = 100000):
+  """Normalizes the rows of the given 2D array to unit variance by dividing them by the standard deviation, which is computed when not given.
+  If in_place is enabled and the given array has a floating point data type, the array itself is normalized.
+  Otherwise, a new array of the given dtype (by default, float64) is filled chunk by chunk; use numpy.float32 to halve the memory.
+  Returns the normalized array and the standard deviation."""
+  if std is None:
+    std = standard_deviation(*moments(array, chunk_size))
+  if in_place and array.dtype.kind == 'f' and (dtype is None or numpy.dtype(dtype) == array.dtype):
+    normalized = array
+  else:
+    normalized = numpy.ndarray(array.shape, dtype or numpy.float64)
+  for i in range(0, array.shape[0], chunk_size):
+    numpy.divide(array[i : i + chunk_size], std, out = normalized[i : i + chunk_size], casting = 'unsafe')
+  return normalized, std
+
+
+def multiply_by_factors(matrix, factors, chunk_size = 100000):
+  """Multiplies each row of the given 2D array by the given factors in place, e.g., to undo the normalization; the matrix is returned."""
+  for i in range(0, matrix.shape[0], chunk_size):
+    matrix[i : i + chunk_size] *= factors
+  return matrix
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Vectorized computation of the PLDA log-likelihood ratios of many models and probes.
+Instead of calling bob.machine.PLDAMachine.forward for each pair of model and probe, the scores of all models and all probes are computed with a few matrix multiplications."""
+
+import numpy
+
+class PLDALogLikelihoodRatios:
+  """Computes the log-likelihood ratios of the PLDA model x = mu + F h + G w + e (with diagonal covariance S of e) for many models and probes at once.
+  With beta = (S + G G^T)^-1 and gamma_a = (I + a F^T beta F)^-1, the log-likelihood ratio of a model enrolled from a samples and a set of p probe samples is:
+
+    0.5 * (log|gamma_{a+p}| - log|gamma_a| - log|gamma_p|) + 0.5 * ((u_m + u_p)^T gamma_{a+p} (u_m + u_p) - u_m^T gamma_a u_m - u_p^T gamma_p u_p)
+
+  where u_m and u_p are the sums of F^T beta (x - mu) over the enrollment and probe samples; u_m is stored in the bob.machine.PLDAMachine as weighted_sum.
+  The matrix F^T beta is precomputed once when this object is created, and the gamma_a are computed once for each required number of samples.
+  Alternatively, the precomputed arrays (see 'precomputed_arrays') can be given instead of the bob.machine.PLDABase, which are used without copying them, e.g., the memory-mapped arrays of utils.shared."""
+
+  def __init__(self, plda_base = None, precomputed = None):
+    self.m_gammas = {}
+    if precomputed is not None:
+      self.m_mu = precomputed['mu']
+      self.m_ft_beta = precomputed['ft_beta']
+      self.m_ft_beta_f = precomputed['ft_beta_f']
+      return
+    self.m_mu = numpy.array(plda_base.mu, numpy.float64)
+    f = numpy.array(plda_base.f, numpy.float64)
+    g = numpy.array(plda_base.g, numpy.float64)
+    inverse_sigma = 1. / numpy.array(plda_base.sigma, numpy.float64)
+    # beta = S^-1 - S^-1 G (I + G^T S^-1 G)^-1 G^T S^-1
+    scaled_g = g * inverse_sigma[:, None]
+    alpha = numpy.linalg.inv(numpy.eye(g.shape[1]) + numpy.dot(g.T, scaled_g))
+    beta = numpy.diag(inverse_sigma) - numpy.dot(numpy.dot(scaled_g, alpha), scaled_g.T)
+    self.m_ft_beta = numpy.dot(f.T, beta)
+    self.m_ft_beta_f = numpy.dot(self.m_ft_beta, f)
+
+  def precomputed_arrays(self):
+    """Returns the dictionary of precomputed arrays, from which this object can be recreated (e.g. to share them between processes)."""
+    return {'mu' : self.m_mu, 'ft_beta' : self.m_ft_beta, 'ft_beta_f' : self.m_ft_beta_f}
+
+  def gamma(self, number_of_samples):
+    """Returns gamma_a and log|gamma_a| for the given number of samples a; the results are cached."""
+    if number_of_samples not in self.m_gammas:
+      gamma = numpy.linalg.inv(numpy.eye(self.m_ft_beta_f.shape[0]) + number_of_samples * self.m_ft_beta_f)
+      self.m_gammas[number_of_samples] = (gamma, numpy.linalg.slogdet(gamma)[1])
+    return self.m_gammas[number_of_samples]
+
+  def project(self, data):
+    """Returns F^T beta (x - mu) for all samples x in the rows of the given 2D array."""
+    return numpy.dot(data - self.m_mu, self.m_ft_beta.T)
+
+  def scores(self, numbers_of_samples, weighted_sums, probes):
+    """Returns the log-likelihood ratios (models x probes) of all given models and all given single probe samples.
+    The models are given by their number of enrollment samples and their weighted sums u_m (2D array with one model per row), the probes as a 2D array with one sample per row.
+    The models are processed in groups with the same number of enrollment samples."""
+    projected = self.project(probes)
+    gamma_1, log_det_1 = self.gamma(1)
+    scores = numpy.ndarray((len(numbers_of_samples), probes.shape[0]), numpy.float64)
+    numbers_of_samples = numpy.array(numbers_of_samples)
+    for a in numpy.unique(numbers_of_samples):
+      indices = numpy.flatnonzero(numbers_of_samples == a)
+      gamma_a, log_det_a = self.gamma(int(a))
+      gamma_a1, log_det_a1 = self.gamma(int(a) + 1)
+      sums = weighted_sums[indices]
+      # the terms that depend only on the model or only on the probe
+      model_terms = 0.5 * (log_det_a1 - log_det_a - log_det_1) + 0.5 * numpy.sum(numpy.dot(sums, gamma_a1 - gamma_a) * sums, axis = 1)
+      probe_terms = 0.5 * numpy.sum(numpy.dot(projected, gamma_a1 - gamma_1) * projected, axis = 1)
+      scores[indices] = model_terms[:, None] + numpy.dot(numpy.dot(sums, gamma_a1), projected.T) + probe_terms[None, :]
+    return scores
+
+  def joint_score(self, number_of_samples, weighted_sum, probes):
+    """Returns the log-likelihood ratio of the given model and all samples of the given 2D array of probes, which are assumed to stem from the same identity."""
+    probe_sum = numpy.sum(self.project(probes), axis = 0)
+    gamma_a, log_det_a = self.gamma(number_of_samples)
+    gamma_p, log_det_p = self.gamma(probes.shape[0])
+    gamma_ap, log_det_ap = self.gamma(number_of_samples + probes.shape[0])
+    total = weighted_sum + probe_sum
+    return 0.5 * (log_det_ap - log_det_a - log_det_p) + 0.5 * (numpy.dot(total, numpy.dot(gamma_ap, total)) - numpy.dot(weighted_sum, numpy.dot(gamma_a, weighted_sum)) - numpy.dot(probe_sum, numpy.dot(gamma_p, probe_sum)))
+
+
+class PLDAModel:
+  """The parameters of an enrolled bob.machine.PLDAMachine that are required by PLDALogLikelihoodRatios, i.e., the number of enrollment samples and the weighted sum u_m.
+  They are read from the given bob.io.HDF5File of the model, without attaching the bob.machine.PLDABase."""
+
+  def __init__(self, hdf5file):
+    self.n_samples = int(hdf5file.read('n_samples'))
+    self.weighted_sum = hdf5file.read('weighted_sum')
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Helper functions to share the (read-only) parameter arrays of trained machines between several processes.
+The arrays are exported only once into memory-mapped .npy files, to which all processes attach read-only.
+This way, the operating system keeps only a single copy of the arrays in memory,
+independent of the number of processes that use them."""
+
+import os
+import bob
+import numpy
+
+def shared_directory(filename):
+  """Returns the directory, in which the shared arrays of the given machine file are stored."""
+  return filename + ".shared"
+
+
+def __index_file__(filename):
+  return os.path.join(shared_directory(filename), "index.txt")
+
+
+def is_exported(filename):
+  """Checks if the shared arrays for the given machine file were exported after the file has been written last."""
+  index_file = __index_file__(filename)
+  return os.path.exists(index_file) and os.path.exists(filename) and os.path.getmtime(index_file) >= os.path.getmtime(filename)
+
+
+def export(filename, arrays):
+  """Exports the given dictionary of arrays into the shared directory of the given machine file.
+  The files are first written to temporary files and then moved,
+  so that several processes can export the same arrays at the same time."""
+  directory = shared_directory(filename)
+  if not os.path.isdir(directory):
+    try:
+      os.makedirs(directory)
+    except OSError:
+      # might have been created by another process in the meantime
+      if not os.path.isdir(directory):
+        raise
+  suffix = ".%d.tmp" % os.getpid()
+  for name, array in arrays.iteritems():
+    array_file = os.path.join(directory, name + ".npy")
+    # numpy.save would append another .npy extension to the temporary file name otherwise
+    temp_file = os.path.join(directory, name + suffix + ".npy")
+    numpy.save(temp_file, numpy.ascontiguousarray(array))
+    os.rename(temp_file, array_file)
+  # the index file is written last, so that it is only present when all arrays are there
+  index_file = __index_file__(filename)
+  with open(index_file + suffix, 'w') as f:
+    f.write("\n".join(sorted(arrays.keys())) + "\n")
+  os.rename(index_file + suffix, index_file)
+
+
+def attach(filename):
+  """Returns the dictionary of shared arrays of the given machine file as read-only memory maps."""
+  directory = shared_directory(filename)
+  with open(__index_file__(filename)) as f:
+    names = [line.strip() for line in f if line.strip()]
+  return dict((name, numpy.load(os.path.join(directory, name + ".npy"), mmap_mode = 'r')) for name in names)
+
+
+def load(filename, read_function):
+  """Returns the shared arrays of the given machine file as read-only memory maps.
+  If the arrays have not been exported yet (or the machine file has changed since), read_function(filename) is called,
+  which needs to return a dictionary of arrays that is exported before attaching to it."""
+  if not is_exported(filename):
+    export(filename, read_function(filename))
+  return attach(filename)
+
+
+def with_prefix(prefix, arrays):
+  """Returns the given dictionary of arrays with the given prefix prepended to all names, so that the arrays of several machines can be exported into the same directory."""
+  return dict((prefix + name, array) for name, array in arrays.iteritems())
+
+
+def without_prefix(prefix, arrays):
+  """Returns the arrays of the given dictionary whose names start with the given prefix, with the prefix removed from their names."""
+  return dict((name[len(prefix):], array) for name, array in arrays.iteritems() if name.startswith(prefix))
+
+
+def read_linear_projector_arrays(projector_file):
+  """Reads the arrays of a PCA or LDA projector file, i.e., the 'Eigenvalues' and the parameters of the bob.machine.LinearMachine in the 'Machine' group."""
+  f = bob.io.HDF5File(projector_file)
+  arrays = {'Eigenvalues' : f.read("Eigenvalues")}
+  f.cd("/Machine")
+  arrays.update(SharedLinearMachine.arrays(bob.machine.LinearMachine(f)))
+  return arrays
+
+
+def load_linear_projector(projector_file):
+  """Returns the eigenvalues and the SharedLinearMachine of the given PCA or LDA projector file, both attached to the shared memory-mapped arrays."""
+  arrays = load(projector_file, read_linear_projector_arrays)
+  return arrays['Eigenvalues'], SharedLinearMachine(arrays['weights'], arrays['biases'], arrays['input_subtract'], arrays['input_divide'])
+
+
+
+class SharedLinearMachine:
+  """A read-only replacement for the bob.machine.LinearMachine with identity activation,
+  whose parameters are taken from (shared) arrays instead of being copied into the machine."""
+
+  def __init__(self, weights, biases = None, input_subtract = None, input_divide = None):
+    self.weights = weights
+    self.biases = biases if biases is not None else numpy.zeros((weights.shape[1],), numpy.float64)
+    self.input_subtract = input_subtract if input_subtract is not None else numpy.zeros((weights.shape[0],), numpy.float64)
+    self.input_divide = input_divide if input_divide is not None else numpy.ones((weights.shape[0],), numpy.float64)
+    self.shape = weights.shape
+
+  @staticmethod
+  def arrays(machine):
+    """Returns the dictionary of parameter arrays of the given bob.machine.LinearMachine."""
+    return {
+        'weights' : machine.weights,
+        'biases' : machine.biases,
+        'input_subtract' : machine.input_subtract,
+        'input_divide' : machine.input_divide
+    }
+
+  def __call__(self, input, output = None):
+    """Projects the given input (which might be a 2D array of several inputs in its rows) into the given output array, which is returned."""
+    result = numpy.dot((input - self.input_subtract) / self.input_divide, self.weights) + self.biases
+    if output is None:
+      return result
+    output[:] = result
+    return output
+
+
+
+class SharedGMMMachine:
+  """A read-only replacement for the bob.machine.GMMMachine, whose parameters are taken from (shared) arrays instead of being copied into the machine.
+  It provides the attributes that the functions in facereclib.utils.gmm require, e.g., for the linear scoring or the U x estimation."""
+
+  def __init__(self, weights, means, variances):
+    self.weights = weights
+    self.means = means
+    self.variances = variances
+    self.dim_c, self.dim_d = means.shape
+    self.mean_supervector = means.reshape((-1,))
+    self.variance_supervector = variances.reshape((-1,))
+
+  @staticmethod
+  def arrays(machine):
+    """Returns the dictionary of parameter arrays of the given bob.machine.GMMMachine."""
+    return {
+        'weights' : machine.weights,
+        'means' : machine.means,
+        'variances' : machine.variances
+    }
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Helper classes and functions to train linear machines on data that is too large to be kept in memory at once.
+The training data is read chunk by chunk, and only sufficient statistics (like the mean and the scatter matrix) are accumulated."""
+
+import bob
+import numpy
+import scipy.linalg
+
+class LazyList:
+  """A read-only list of files, which are read using the given read_function only when they are accessed.
+  Iterating over this list reads the files one after the other, so that only one of them needs to be kept in memory."""
+
+  def __init__(self, files, read_function):
+    self.m_files = files
+    self.m_read_function = read_function
+
+  def __len__(self):
+    return len(self.m_files)
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      # a slice is a LazyList of the selected files
+      return LazyList(self.m_files[index], self.m_read_function)
+    return self.m_read_function(str(self.m_files[index]))
+
+  def __iter__(self):
+    for filename in self.m_files:
+      yield self.m_read_function(str(filename))
+
+
+def project_batch(machine, data):
+  """Projects all rows of the given 2D data array using the given linear machine (with identity activation) in a single matrix multiplication.
+  The machine might be a bob.machine.LinearMachine or any object providing the same parameter arrays.
+  A new 2D array is returned, which contains one projected vector per row."""
+  return numpy.dot((data - machine.input_subtract) / machine.input_divide, machine.weights) + machine.biases
+
+
+def split(features, chunk_size = 100):
+  """Splits the given list (or LazyList) of features into a list of consecutive parts of (at most) chunk_size features, e.g., the chunks of the map-reduce trainers in facereclib.trainers.
+  The parts of a LazyList are LazyLists themselves, so that no feature is read before it is accessed."""
+  return [features[i : i + chunk_size] for i in range(0, len(features), chunk_size)]
+
+
+def chunks(features, chunk_size = 100):
+  """Generates 2D arrays, each containing the flattened versions of (at most) chunk_size of the given features in its rows."""
+  chunk = []
+  for feature in features:
+    chunk.append(feature.flatten())
+    if len(chunk) == chunk_size:
+      yield numpy.vstack(chunk)
+      chunk = []
+  if chunk:
+    yield numpy.vstack(chunk)
+
+
+
+class ScatterStatistics:
+  """Accumulates the number of samples, the mean and the scatter matrix of the data that is added chunk by chunk.
+  Statistics accumulated on different parts of the data can be merged, which gives the same result as accumulating all data at once."""
+
+  def __init__(self, dimension):
+    self.n = 0
+    self.mean = numpy.zeros((dimension,), numpy.float64)
+    self.scatter = numpy.zeros((dimension, dimension), numpy.float64)
+
+  def __merge__(self, n, mean, scatter):
+    """Merges the statistics of another part of the data using the pairwise update formula, which is numerically stable."""
+    if not n:
+      return
+    total = self.n + n
+    delta = mean - self.mean
+    self.scatter += scatter + numpy.outer(delta, delta) * (float(self.n) * n / total)
+    self.mean += delta * (float(n) / total)
+    self.n = total
+
+  def accumulate(self, data):
+    """Adds the samples stored in the rows of the given 2D array."""
+    data = numpy.asarray(data, numpy.float64)
+    mean = numpy.mean(data, axis = 0)
+    centered = data - mean
+    self.__merge__(data.shape[0], mean, numpy.dot(centered.T, centered))
+
+  def merge(self, other):
+    """Adds the statistics accumulated in the given other ScatterStatistics object."""
+    self.__merge__(other.n, other.mean, other.scatter)
+
+  def covariance(self):
+    """Returns the (unbiased) covariance matrix of all data accumulated so far."""
+    return self.scatter / (self.n - 1)
+
+
+
+def pca(statistics):
+  """Computes the PCA from the given ScatterStatistics.
+  Returns a bob.machine.LinearMachine and the eigenvalues, ordered by decreasing eigenvalue, as the bob.trainer.PCATrainer does.
+  As for the PCATrainer, at most n-1 components are kept, where n is the number of accumulated samples."""
+  if statistics.n < 2:
+    raise ValueError("At least two training samples are required to compute the PCA, but only %d were given." % statistics.n)
+  eigen_values, eigen_vectors = numpy.linalg.eigh(statistics.covariance())
+  # sort by decreasing eigenvalues and keep only the eigenvectors of the data subspace
+  rank = min(statistics.n - 1, len(eigen_values))
+  order = numpy.argsort(eigen_values)[::-1][:rank]
+  machine = bob.machine.LinearMachine(numpy.ascontiguousarray(eigen_vectors[:, order]))
+  machine.input_subtract = statistics.mean
+  return machine, numpy.ascontiguousarray(eigen_values[order])
+
+
+def train_pca(features, chunk_size = 100):
+  """Trains a PCA on the given features, which might be a LazyList or any other iterable of arrays.
+  The features are flattened and processed in chunks of chunk_size, so that only a single chunk is kept in memory.
+  The memory consumption is dominated by the scatter matrix, which has the squared size of the feature dimension."""
+  statistics = None
+  for chunk in chunks(features, chunk_size):
+    if statistics is None:
+      statistics = ScatterStatistics(chunk.shape[1])
+    statistics.accumulate(chunk)
+  if statistics is None:
+    raise ValueError("No training data was given to compute the PCA.")
+  return pca(statistics)
+
+
+
+class ClassScatterStatistics:
+  """Accumulates the statistics required to train a Fisher LDA, i.e., the statistics of all data and the within-class scatter matrix, together with the number of samples and the mean of each class.
+  Each class is added by its own ScatterStatistics, which might have been computed in parallel; statistics of disjoint sets of classes can be merged."""
+
+  def __init__(self, dimension):
+    self.total = ScatterStatistics(dimension)
+    self.within_scatter = numpy.zeros((dimension, dimension), numpy.float64)
+    self.class_counts = []
+    self.class_means = []
+
+  def add_class(self, statistics):
+    """Adds the ScatterStatistics of all samples of one class."""
+    self.total.merge(statistics)
+    self.within_scatter += statistics.scatter
+    self.class_counts.append(statistics.n)
+    self.class_means.append(statistics.mean.copy())
+
+  def merge(self, other):
+    """Adds the statistics of the (disjoint) classes accumulated in the given other ClassScatterStatistics object."""
+    self.total.merge(other.total)
+    self.within_scatter += other.within_scatter
+    self.class_counts.extend(other.class_counts)
+    self.class_means.extend(other.class_means)
+
+  def between_scatter(self):
+    """Returns the between-class scatter matrix."""
+    differences = numpy.vstack(self.class_means) - self.total.mean
+    return numpy.dot(differences.T * numpy.array(self.class_counts, numpy.float64), differences)
+
+
+
+def lda(statistics, strip_to_rank = True):
+  """Computes the Fisher LDA from the given ClassScatterStatistics by solving the generalized eigenvalue problem of the between-class and the within-class scatter matrices.
+  Returns a bob.machine.LinearMachine with normalized eigenvectors and the eigenvalues, ordered by decreasing eigenvalue.
+  If strip_to_rank is enabled, only the (number of classes - 1) eigenvectors with non-vanishing eigenvalues are kept, as the bob.trainer.FisherLDATrainer does."""
+  if len(statistics.class_counts) < 2:
+    raise ValueError("At least two classes are required to compute the LDA, but only %d were given." % len(statistics.class_counts))
+  eigen_values, eigen_vectors = scipy.linalg.eigh(statistics.between_scatter(), statistics.within_scatter)
+  order = numpy.argsort(eigen_values)[::-1]
+  if strip_to_rank:
+    order = order[:len(statistics.class_counts) - 1]
+  eigen_vectors = eigen_vectors[:, order]
+  eigen_vectors /= numpy.sqrt(numpy.sum(eigen_vectors ** 2, axis = 0))
+  machine = bob.machine.LinearMachine(numpy.ascontiguousarray(eigen_vectors))
+  machine.input_subtract = statistics.total.mean
+  return machine, numpy.ascontiguousarray(eigen_values[order])
+
+
+def class_statistics(client_features, machine = None, chunk_size = 100):
+  """Accumulates the ScatterStatistics of the given features of one class, reading them chunk by chunk.
+  If a (PCA) machine is given, the features are projected with it before the statistics are accumulated."""
+  statistics = None
+  for chunk in chunks(client_features, chunk_size):
+    if machine is not None:
+      chunk = project_batch(machine, chunk)
+    if statistics is None:
+      statistics = ScatterStatistics(chunk.shape[1])
+    statistics.accumulate(chunk)
+  return statistics
+
+
+def train_lda(training_set, machine = None, strip_to_rank = True, chunk_size = 100):
+  """Trains a Fisher LDA on the given training set, which is a list of (lazy) lists of features, one for each class.
+  The classes are processed one after the other, and the features of each class are read in chunks of chunk_size.
+  If a (PCA) machine is given, the LDA is computed in the subspace of this machine."""
+  statistics = None
+  for client_features in training_set:
+    client_statistics = class_statistics(client_features, machine, chunk_size)
+    if statistics is None:
+      statistics = ClassScatterStatistics(client_statistics.mean.shape[0])
+    statistics.add_class(client_statistics)
+  if statistics is None:
+    raise ValueError("No training data was given to compute the LDA.")
+  return lda(statistics, strip_to_rank)